@@ -0,0 +1,98 @@
+# Comet VOEvent Broker.
+# Event database benchmarks.
+
+"""
+Measure the rate at which `Event_DB.check_event` processes events.
+
+Run from the top of the source tree::
+
+  $ PYTHONPATH=. python benchmarks/bench_event_db.py
+
+Each configuration is presented with the same stream of unique events spread
+over a number of streams, followed by the same stream again (so that every
+event is a duplicate). "Batched" configurations pass events to
+`check_keys` in groups, as an `EventDBWorker` does.
+"""
+
+import shutil
+import tempfile
+import time
+from argparse import ArgumentParser
+
+from comet.testutils import DummyEvent
+from comet.utility.event_db import BATCH_SIZE, Event_DB, MmapEvent_DB
+from comet.utility.event_db import SQLiteEvent_DB
+
+
+def make_events(n_events, n_streams):
+    return [
+        DummyEvent(b"ivo://comet.broker/stream%d#%d" % (i % n_streams, i))
+        for i in range(n_events)
+    ]
+
+
+def run(events, cls, batch_size=0, **kwargs):
+    root = tempfile.mkdtemp()
+    try:
+        event_db = cls(root, **kwargs)
+        keys = [event_db._get_event_details(event) for event in events]
+        results = []
+        for label in ("unseen", "seen"):
+            start = time.perf_counter()
+            if batch_size:
+                for first in range(0, len(keys), batch_size):
+                    last = first + batch_size
+                    event_db.check_keys(keys[first:last])
+            else:
+                for event in events:
+                    event_db.check_event(event)
+            results.append((label, len(events) / (time.perf_counter() - start)))
+        event_db.close()
+        return results
+    finally:
+        shutil.rmtree(root)
+
+
+def main():
+    parser = ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--events", type=int, default=2000)
+    parser.add_argument("--streams", type=int, default=10)
+    args = parser.parse_args()
+
+    events = make_events(args.events, args.streams)
+    configurations = [
+        ("open per event", Event_DB, {}),
+        ("cached handles", Event_DB, {"max_handles": args.streams}),
+        (
+            "cached handles (LRU churn)",
+            Event_DB,
+            {"max_handles": max(1, args.streams // 2)},
+        ),
+        (
+            "cached handles + Bloom filter",
+            Event_DB,
+            {"max_handles": args.streams, "bloom_capacity": args.events},
+        ),
+        (
+            "cached handles, batched",
+            Event_DB,
+            {"max_handles": args.streams, "batch_size": BATCH_SIZE},
+        ),
+        ("SQLite", SQLiteEvent_DB, {}),
+        ("SQLite, batched", SQLiteEvent_DB, {"batch_size": BATCH_SIZE}),
+        ("mmap hash table", MmapEvent_DB, {}),
+        ("mmap hash table, batched", MmapEvent_DB, {"batch_size": BATCH_SIZE}),
+        (
+            "mmap hash table (resizing)",
+            MmapEvent_DB,
+            {"capacity": 8},
+        ),
+    ]
+    print(f"{args.events} events over {args.streams} streams")
+    for name, cls, kwargs in configurations:
+        for label, rate in run(events, cls, **kwargs):
+            print(f"{name:>30s} {label:>8s}: {rate:10.0f} events/s")
+
+
+if __name__ == "__main__":
+    main()
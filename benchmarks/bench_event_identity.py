@@ -0,0 +1,58 @@
+# Comet VOEvent Broker.
+# Event identity benchmarks.
+
+"""
+Measure the cost of deriving an event database key for each event identity.
+
+Run from the top of the source tree::
+
+  $ PYTHONPATH=. python benchmarks/bench_event_identity.py
+
+Events of several sizes are generated by padding a minimal VOEvent. For each
+identity, the time taken to calculate a key is reported per event and per
+kilobyte of event.
+"""
+
+import time
+from argparse import ArgumentParser
+
+from comet.testutils import DummyEvent
+from comet.utility.event_db import IDENTITIES
+
+
+def make_event(size):
+    event = DummyEvent()
+    padding = max(0, size - len(event.raw_bytes) - len(b"<!--  -->"))
+    event.raw_bytes += b"<!-- " + b"x" * padding + b" -->"
+    return event
+
+
+def run(event, identity, repeat):
+    key = IDENTITIES[identity]
+    ivorn, raw_bytes = event.element.attrib["ivorn"], event.raw_bytes
+    start = time.perf_counter()
+    for _ in range(repeat):
+        key(ivorn, raw_bytes)
+    return (time.perf_counter() - start) / repeat
+
+
+def main():
+    parser = ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--repeat", type=int, default=2000)
+    parser.add_argument("--sizes", type=int, nargs="+", default=[1, 10, 100, 1000])
+    args = parser.parse_args()
+
+    for size in args.sizes:
+        event = make_event(size * 1024)
+        print(f"{len(event.raw_bytes) / 1024:.0f} KB events")
+        for identity in sorted(IDENTITIES):
+            elapsed = run(event, identity, args.repeat)
+            per_kb = elapsed * 1024 / len(event.raw_bytes)
+            print(
+                f"{identity:>12s}: {elapsed * 1e6:10.2f} us/event "
+                f"{per_kb * 1e9:10.1f} ns/KB"
+            )
+
+
+if __name__ == "__main__":
+    main()
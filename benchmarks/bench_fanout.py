@@ -0,0 +1,93 @@
+# Comet VOEvent Broker.
+# Event fan-out benchmarks.
+
+"""
+Measure the latency of sending an event to many subscribers.
+
+Run from the top of the source tree::
+
+  $ PYTHONPATH=. python benchmarks/bench_fanout.py
+
+Each event is sent to every subscriber connected to a
+`VOEventBroadcasterFactory` by its ``send_event`` method, and the time until
+every subscriber has either been sent the event or rejected it is reported.
+Subscribers may have no filters, in which case events are sent immediately;
+filters which are cheap enough to be evaluated in the reactor thread; or
+filters which are evaluated in the reactor thread pool.
+"""
+
+import time
+from argparse import ArgumentParser
+
+from twisted.internet import defer, task
+from twisted.test import proto_helpers
+
+from comet.protocol.broadcaster import VOEventBroadcasterFactory
+from comet.testutils import DUMMY_SERVICE_IVOID, DummyEvent
+
+FILTERS = ['/*[local-name()="VOEvent" and @role="test"]', "//Param", "//Who"]
+
+PATHS = [
+    ("unfiltered", [], None),
+    ("inline", FILTERS, 1.0),
+    ("threaded", FILTERS, 0),
+]
+
+
+def make_factory(n_subscribers, filters, inline_threshold):
+    factory = VOEventBroadcasterFactory(DUMMY_SERVICE_IVOID.decode(), 0)
+    if inline_threshold is not None:
+        factory.filter_registry.inline_threshold = inline_threshold
+    for i in range(n_subscribers):
+        proto = factory.buildProtocol(("127.0.0.1", 0))
+        proto.makeConnection(proto_helpers.StringTransport())
+        proto.filters = [
+            factory.filter_registry.install(filters[(i + j) % len(filters)])
+            for j in range(min(len(filters), 2))
+        ]
+        proto.filter_mask = factory.filter_registry.mask(proto.filters)
+    return factory
+
+
+@defer.inlineCallbacks
+def run(factory, n_events):
+    # Filter costs are measured by the first event.
+    yield factory.send_event(DummyEvent())
+    latencies = []
+    for _ in range(n_events):
+        for broadcaster in factory.broadcasters:
+            broadcaster.transport.clear()
+        start = time.perf_counter()
+        yield factory.send_event(DummyEvent())
+        latencies.append(time.perf_counter() - start)
+    latencies.sort()
+    sent = sum(
+        len(broadcaster.transport.value()) > 0 for broadcaster in factory.broadcasters
+    )
+    return latencies, sent
+
+
+@defer.inlineCallbacks
+def benchmark(reactor, args):
+    print(f"{args.subscribers} subscribers, {args.events} events")
+    for label, filters, inline_threshold in PATHS:
+        factory = make_factory(args.subscribers, filters, inline_threshold)
+        latencies, sent = yield run(factory, args.events)
+        median = latencies[len(latencies) // 2]
+        worst = latencies[-1]
+        print(
+            f"{label:>12s}: {median * 1e3:8.2f} ms median "
+            f"{worst * 1e3:8.2f} ms worst, sent to {sent} subscribers"
+        )
+
+
+def main():
+    parser = ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--subscribers", type=int, default=1000)
+    parser.add_argument("--events", type=int, default=50)
+    args = parser.parse_args()
+    task.react(benchmark, [args])
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,99 @@
+# Comet VOEvent Broker.
+# Message framing benchmarks.
+
+"""
+Measure the bytes copied when an event is sent to many subscribers.
+
+Run from the top of the source tree::
+
+  $ PYTHONPATH=. python benchmarks/bench_frames.py
+
+A large VOEvent is sent to each of a number of `ElementSender` protocols,
+whose transports retain what is written to them without copying it. The
+event is framed once by `ElementSender.frame` and the frame written to every
+subscriber, as `VOEventBroadcasterFactory.send_event` does, and, as in earlier
+versions, framed afresh for every subscriber with ``sendString``. The time
+taken and the memory allocated by Python for the frames are reported.
+"""
+
+import time
+import tracemalloc
+from argparse import ArgumentParser
+
+from twisted.internet.protocol import ServerFactory
+from twisted.test import proto_helpers
+
+from comet.protocol.base import ElementSender
+from comet.testutils import DUMMY_VOEVENT
+from comet.utility import VOEventMessage
+
+
+class Transport(proto_helpers.StringTransport):
+    def write(self, data):
+        self.written.append(data)
+
+
+def make_large_voevent(size):
+    param = b'<Param name="param" value="0" unit="ct" ucd="phot.count"/>'
+    params = param * (size // len(param))
+    return VOEventMessage(
+        DUMMY_VOEVENT.replace(
+            b"</voe:VOEvent>", b"<What>" + params + b"</What></voe:VOEvent>"
+        )
+    )
+
+
+def make_senders(n_subscribers):
+    factory = ServerFactory()
+    factory.protocol = ElementSender
+    senders = []
+    for _ in range(n_subscribers):
+        sender = factory.buildProtocol(("127.0.0.1", 0))
+        sender.makeConnection(Transport())
+        sender.transport.written = []
+        senders.append(sender)
+    return senders
+
+
+def per_subscriber(senders, event):
+    # As events were sent before frames were shared.
+    for sender in senders:
+        sender.sendString(event.raw_bytes)
+
+
+def shared(senders, event):
+    frame = ElementSender.frame(event)
+    for sender in senders:
+        sender.transport.write(frame)
+
+
+def run(func, senders, event):
+    tracemalloc.start()
+    start = time.perf_counter()
+    func(senders, event)
+    elapsed = time.perf_counter() - start
+    allocated, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return elapsed, allocated
+
+
+def main():
+    parser = ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--subscribers", type=int, default=200)
+    parser.add_argument("--size", type=int, default=1, help="Event size in MB")
+    args = parser.parse_args()
+
+    event = make_large_voevent(args.size * 2**20)
+    print(
+        f"{len(event.raw_bytes) / 2 ** 20:.1f} MB event, {args.subscribers} subscribers"
+    )
+    for label, func in [("per subscriber", per_subscriber), ("shared", shared)]:
+        elapsed, allocated = run(func, make_senders(args.subscribers), event)
+        print(
+            f"{label:>16s}: {elapsed * 1e3:8.1f} ms "
+            f"{allocated / 2 ** 20:10.1f} MB copied"
+        )
+
+
+if __name__ == "__main__":
+    main()
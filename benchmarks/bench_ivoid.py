@@ -0,0 +1,73 @@
+# Comet VOEvent Broker.
+# IVOID parsing benchmarks.
+
+"""
+Measure the cost of parsing event IVORNs.
+
+Run from the top of the source tree::
+
+  $ PYTHONPATH=. python benchmarks/bench_ivoid.py
+
+IVORNs are drawn from a number of streams, with a few busy streams accounting
+for most events, as is typical of a broker's traffic. Each is parsed by
+`parse_ivoid`, which caches the authority and resource key of each stream,
+and by the original implementation, which matched the whole IVORN against a
+single expression every time.
+"""
+
+import random
+import time
+from argparse import ArgumentParser
+
+from comet.utility.voevent import IVOID_RE, _parse_prefix, parse_ivoid
+
+
+def original_parse_ivoid(ivoid):
+    groups = IVOID_RE.match(ivoid).groups()
+    rsrc = groups[1] if groups[1] is not None else ""
+    for forbidden in ["//", "/../", "/./"]:
+        assert forbidden not in rsrc
+    assert not rsrc.endswith("/")
+    return groups[0], rsrc, groups[2]
+
+
+def make_ivorns(n_events, n_streams):
+    streams = [
+        "ivo://broker%d.example/stream/%s_%d" % (i % 5, "alerts", i)
+        for i in range(n_streams)
+    ]
+    # Stream popularity follows Zipf's law.
+    weights = [1 / (rank + 1) for rank in range(n_streams)]
+    return [
+        "%s#%s-%d" % (stream, time.strftime("%Y-%m-%dT%H:%M:%S"), i)
+        for i, stream in enumerate(random.choices(streams, weights, k=n_events))
+    ]
+
+
+def run(func, ivorns):
+    start = time.perf_counter()
+    for ivorn in ivorns:
+        func(ivorn)
+    return (time.perf_counter() - start) / len(ivorns)
+
+
+def main():
+    parser = ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--events", type=int, default=100000)
+    parser.add_argument("--streams", type=int, default=50)
+    args = parser.parse_args()
+
+    ivorns = make_ivorns(args.events, args.streams)
+    for ivorn in ivorns:
+        assert parse_ivoid(ivorn) == original_parse_ivoid(ivorn)
+    print(f"{args.events} events over {args.streams} streams")
+    _parse_prefix.cache_clear()
+    for label, func in [("original", original_parse_ivoid), ("cached", parse_ivoid)]:
+        elapsed = run(func, ivorns)
+        print(f"{label:>12s}: {elapsed * 1e9:8.0f} ns/event")
+    info = _parse_prefix.cache_info()
+    print(f"cache: {info.hits} hits, {info.misses} misses")
+
+
+if __name__ == "__main__":
+    main()
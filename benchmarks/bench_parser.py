@@ -0,0 +1,86 @@
+# Comet VOEvent Broker.
+# XML parser throughput benchmarks.
+
+"""
+Measure XML parse throughput for small and large VOEvents.
+
+Run from the top of the source tree::
+
+  $ PYTHONPATH=. python benchmarks/bench_parser.py
+
+Each payload is parsed by `xml_document` using parsers from a `ParserPool`
+with a range of options, and, for comparison, by a new parser constructed for
+every message as in earlier versions. Throughput is reported in messages and
+megabytes per second.
+"""
+
+import time
+from argparse import ArgumentParser
+
+import lxml.etree as ElementTree
+
+from comet.testutils import DUMMY_VOEVENT
+from comet.utility import parser_pool, xml_document
+
+CONFIGURATIONS = [
+    ("default", {}),
+    ("collect_ids=True", {"collect_ids": True}),
+    ("remove_blank_text=True", {"remove_blank_text": True}),
+    ("huge_tree=True", {"huge_tree": True}),
+]
+
+
+def make_large_voevent(n_params):
+    params = b"".join(
+        b'\n    <Param name="param%d" value="%d" unit="ct" ucd="phot.count"/>' % (i, i)
+        for i in range(n_params)
+    )
+    return DUMMY_VOEVENT.replace(
+        b"</voe:VOEvent>", b"<What>" + params + b"\n</What></voe:VOEvent>"
+    )
+
+
+def new_parser(raw_bytes):
+    # As xml_document parsed messages before parsers were pooled.
+    parser = ElementTree.XMLParser(resolve_entities=False)
+    element = ElementTree.fromstring(raw_bytes, parser=parser)
+    list(element.iter(ElementTree.Entity))
+    return element
+
+
+def run(func, raw_bytes, repeat):
+    start = time.perf_counter()
+    for _ in range(repeat):
+        func(raw_bytes)
+    return (time.perf_counter() - start) / repeat
+
+
+def report(label, raw_bytes, elapsed):
+    print(
+        f"{label:>24s}: {1 / elapsed:10.0f} messages/s "
+        f"{len(raw_bytes) / elapsed / 1e6:8.1f} MB/s"
+    )
+
+
+def main():
+    parser = ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--repeat", type=int, default=2000)
+    parser.add_argument("--params", type=int, default=1000)
+    args = parser.parse_args()
+
+    payloads = [
+        ("small VOEvent", DUMMY_VOEVENT),
+        ("large VOEvent", make_large_voevent(args.params)),
+    ]
+    for name, raw_bytes in payloads:
+        print(f"{name} ({len(raw_bytes)} bytes)")
+        repeat = max(1, args.repeat * 1000 // max(1000, len(raw_bytes)))
+        report("new parser", raw_bytes, run(new_parser, raw_bytes, repeat))
+        for label, options in CONFIGURATIONS:
+            parser_pool.configure(**options)
+            report(label, raw_bytes, run(xml_document, raw_bytes, repeat))
+        parser_pool.configure()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,97 @@
+# Comet VOEvent Broker.
+# Shared event database contention benchmarks.
+
+"""
+Measure contention on an event database shared between processes.
+
+Run from the top of the source tree::
+
+  $ PYTHONPATH=. python benchmarks/bench_shared_event_db.py
+
+Several processes simultaneously present the same stream of events to a
+single shared `SQLiteEvent_DB`, as would a group of brokers subscribed to the
+same upstream. Each event should be accepted exactly once across all
+processes. The aggregate rate at which checks are made is reported, both for
+individual checks and for batches as made by an `EventDBWorker`.
+"""
+
+import shutil
+import tempfile
+import time
+from argparse import ArgumentParser
+from multiprocessing import Barrier, Process, Queue
+
+from comet.testutils import DummyEvent
+from comet.utility.event_db import BATCH_SIZE, SQLiteEvent_DB
+
+
+def make_keys(n_events, n_streams):
+    return [
+        SQLiteEvent_DB._get_event_details(
+            DummyEvent(b"ivo://comet.broker/stream%d#%d" % (i % n_streams, i))
+        )
+        for i in range(n_events)
+    ]
+
+
+def check(root, keys, batch_size, barrier, results):
+    event_db = SQLiteEvent_DB(root, shared=True)
+    barrier.wait()
+    accepted = 0
+    if batch_size:
+        for first in range(0, len(keys), batch_size):
+            last = first + batch_size
+            accepted += sum(
+                result for _, result in event_db.check_keys(keys[first:last])
+            )
+    else:
+        for db_path, key in keys:
+            accepted += event_db.check_key(db_path, key)
+    event_db.close()
+    results.put(accepted)
+
+
+def run(keys, n_processes, batch_size):
+    root = tempfile.mkdtemp()
+    try:
+        # Create the database before timing starts.
+        SQLiteEvent_DB(root, shared=True).close()
+        barrier, results = Barrier(n_processes + 1), Queue()
+        processes = [
+            Process(target=check, args=(root, keys, batch_size, barrier, results))
+            for _ in range(n_processes)
+        ]
+        for process in processes:
+            process.start()
+        barrier.wait()
+        start = time.perf_counter()
+        accepted = sum(results.get() for _ in processes)
+        elapsed = time.perf_counter() - start
+        for process in processes:
+            process.join()
+        return accepted, n_processes * len(keys) / elapsed
+    finally:
+        shutil.rmtree(root)
+
+
+def main():
+    parser = ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--events", type=int, default=1000)
+    parser.add_argument("--streams", type=int, default=10)
+    parser.add_argument("--processes", type=int, nargs="+", default=[1, 2, 4, 8, 16])
+    args = parser.parse_args()
+
+    keys = make_keys(args.events, args.streams)
+    print(f"{args.events} events over {args.streams} streams")
+    for batch_size in (0, BATCH_SIZE):
+        label = f"batches of {batch_size}" if batch_size else "single checks"
+        for n_processes in args.processes:
+            accepted, rate = run(keys, n_processes, batch_size)
+            print(
+                f"{label:>16s} {n_processes:3d} processes: "
+                f"{rate:10.0f} checks/s, {accepted} accepted"
+            )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,87 @@
+# Comet VOEvent Broker.
+# Streaming receive benchmarks.
+
+"""
+Measure the cost of receiving very large VOEvents.
+
+Run from the top of the source tree::
+
+  $ PYTHONPATH=. python benchmarks/bench_stream.py
+
+A VOEvent containing a large table of parameters is delivered to an
+`EventHandler` in chunks, as it would arrive from the network. It is received
+both by buffering the whole message before parsing it, as happens for
+messages of up to ``MAX_LENGTH`` bytes, and by streaming it to the parser as
+it arrives. The time taken and the peak memory allocated by Python while
+receiving are reported; memory allocated by libxml2 for the tree itself is
+not included. The same is reported for a message of the same size which is
+not a VOEvent, and is therefore rejected.
+"""
+
+import struct
+import time
+import tracemalloc
+from argparse import ArgumentParser
+
+from twisted.internet.protocol import ServerFactory
+from twisted.test import proto_helpers
+
+from comet.protocol.base import EventHandler
+from comet.testutils import DUMMY_VOEVENT
+
+
+class Receiver(EventHandler):
+    def messageReceived(self, incoming):
+        self.incoming = incoming
+
+
+def make_large_voevent(size, role=b"test"):
+    param = b'<Param name="param" value="0" unit="ct" ucd="phot.count"/>'
+    params = param * (size // len(param))
+    return DUMMY_VOEVENT.replace(
+        b"</voe:VOEvent>", b"<What>" + params + b"</What></voe:VOEvent>"
+    ).replace(b'role="test"', b'role="%s"' % (role,))
+
+
+def run(frame, max_length, chunk_size):
+    factory = ServerFactory()
+    factory.protocol = Receiver
+    proto = factory.buildProtocol(("127.0.0.1", 0))
+    proto.MAX_LENGTH = max_length
+    proto.MAX_STREAM_LENGTH = len(frame)
+    proto.makeConnection(proto_helpers.StringTransport())
+    tracemalloc.start()
+    start = time.perf_counter()
+    for offset in range(0, len(frame), chunk_size):
+        end = offset + chunk_size
+        proto.dataReceived(frame[offset:end])
+    elapsed = time.perf_counter() - start
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return elapsed, peak
+
+
+def main():
+    parser = ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--sizes", type=int, nargs="+", default=[1, 4, 8])
+    parser.add_argument("--chunk-size", type=int, default=65536)
+    args = parser.parse_args()
+
+    for size in args.sizes:
+        for name, role in [("VOEvent", b"test"), ("non-VOEvent", b"unknown")]:
+            raw_bytes = make_large_voevent(size * 2**20, role)
+            frame = struct.pack("!I", len(raw_bytes)) + raw_bytes
+            print(f"{len(raw_bytes) / 2 ** 20:.1f} MB {name}")
+            for label, max_length in [
+                ("buffered", len(raw_bytes)),
+                ("streamed", EventHandler.MAX_LENGTH),
+            ]:
+                elapsed, peak = run(frame, max_length, args.chunk_size)
+                print(
+                    f"{label:>12s}: {elapsed * 1e3:8.1f} ms "
+                    f"{peak / 2 ** 20:8.1f} MB peak"
+                )
+
+
+if __name__ == "__main__":
+    main()
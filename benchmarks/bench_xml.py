@@ -0,0 +1,150 @@
+# Comet VOEvent Broker.
+# XML message handling benchmarks.
+
+"""
+Measure the cost of constructing messages from incoming payloads.
+
+Run from the top of the source tree::
+
+  $ PYTHONPATH=. python benchmarks/bench_xml.py
+
+Payloads are transport messages, a minimal VOEvent, and a large VOEvent
+containing a table of parameters. For each, the time taken by
+`xml_document.infer_type` is reported, along with that of a single full
+parse and of the original implementation, which parsed the payload twice.
+Transport messages which need not be parsed are recognized by
+`xml_document.sniff_role`.
+
+The time taken to generate the bytes of outgoing transport messages is also
+reported, both from templates, as `TransportMessage` does, and by building and
+serializing an element tree, as in earlier versions. An ack is sent for every
+event received.
+
+Finally, the size of each locally generated message is reported, both
+compact, as sent on the wire, and pretty printed.
+"""
+
+import time
+from argparse import ArgumentParser
+
+import lxml.etree as ElementTree
+
+from comet.protocol import TransportMessage
+from comet.testutils import (
+    DUMMY_AUTHENTICATE,
+    DUMMY_EVENT_IVOID,
+    DUMMY_IAMALIVE,
+    DUMMY_SERVICE_IVOID,
+    DUMMY_VOEVENT,
+)
+from comet.utility import VOEventMessage, xml_document
+from comet.utility.xml import TRANSPORT_ROLES, VOEVENT_ROLES
+
+
+def make_large_voevent(n_params):
+    params = b"".join(
+        b'<Param name="param%d" value="%d" unit="ct" ucd="phot.count"/>' % (i, i)
+        for i in range(n_params)
+    )
+    return DUMMY_VOEVENT.replace(
+        b"</voe:VOEvent>", b"<What>" + params + b"</What></voe:VOEvent>"
+    )
+
+
+def double_parse(raw_bytes):
+    xmldoc = xml_document(raw_bytes)
+    if xmldoc.role in VOEVENT_ROLES:
+        return VOEventMessage(raw_bytes)
+    elif xmldoc.role in TRANSPORT_ROLES:
+        return TransportMessage(raw_bytes)
+
+
+def serialize(build):
+    return lambda: build().raw_bytes
+
+
+def tree(role, local_ivo, remote_ivo, result=None):
+    # As TransportMessage built messages before templates were introduced.
+    root_element = TransportMessage._origin_response_element(local_ivo, remote_ivo)
+    root_element.set("role", role)
+    if result:
+        meta = ElementTree.SubElement(root_element, "Meta")
+        ElementTree.SubElement(meta, "Result").text = result
+    return TransportMessage(root_element)
+
+
+def run(func, raw_bytes, repeat):
+    start = time.perf_counter()
+    for _ in range(repeat):
+        func(raw_bytes)
+    return (time.perf_counter() - start) / repeat
+
+
+def main():
+    parser = ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--repeat", type=int, default=2000)
+    parser.add_argument("--params", type=int, default=1000)
+    args = parser.parse_args()
+
+    payloads = [
+        ("iamalive", DUMMY_IAMALIVE),
+        ("authenticate", DUMMY_AUTHENTICATE),
+        ("small VOEvent", DUMMY_VOEVENT),
+        ("large VOEvent", make_large_voevent(args.params)),
+    ]
+    methods = [
+        ("double parse", double_parse),
+        ("full parse", xml_document),
+        ("infer_type", xml_document.infer_type),
+    ]
+    for name, raw_bytes in payloads:
+        print(f"{name} ({len(raw_bytes)} bytes)")
+        repeat = max(1, args.repeat * 1000 // max(1000, len(raw_bytes)))
+        for label, func in methods:
+            elapsed = run(func, raw_bytes, repeat)
+            print(f"{label:>24s}: {elapsed * 1e6:10.1f} us/message")
+
+    local_ivo, remote_ivo = DUMMY_SERVICE_IVOID.decode(), DUMMY_EVENT_IVOID.decode()
+    result = "Event rejected: reason"
+    outgoing = [
+        (
+            "ack",
+            lambda: TransportMessage.ack(local_ivo, remote_ivo),
+            lambda: tree("ack", local_ivo, remote_ivo),
+        ),
+        (
+            "nak",
+            lambda: TransportMessage.nak(local_ivo, remote_ivo, result),
+            lambda: tree("nak", local_ivo, remote_ivo, result),
+        ),
+    ]
+    for name, template_build, tree_build in outgoing:
+        print(f"outgoing {name}")
+        for label, build in [("template", template_build), ("tree", tree_build)]:
+            elapsed = run(lambda _: serialize(build)(), None, args.repeat)
+            print(f"{label:>24s}: {elapsed * 1e6:10.1f} us/message")
+
+    generated = [
+        ("iamalive", lambda: TransportMessage.iamalive(local_ivo)),
+        ("ack", lambda: TransportMessage.ack(local_ivo, remote_ivo)),
+        ("nak", lambda: TransportMessage.nak(local_ivo, remote_ivo, result)),
+        (
+            "authenticateresponse",
+            lambda: TransportMessage.authenticateresponse(
+                local_ivo, remote_ivo, ["//Param"]
+            ),
+        ),
+        ("broker test event", lambda: VOEventMessage.broker_test(local_ivo)),
+    ]
+    print("message sizes")
+    for name, build in generated:
+        sizes = []
+        for pretty_print in (False, True):
+            xml_document.pretty_print = pretty_print
+            sizes.append(len(build().raw_bytes))
+        xml_document.pretty_print = False
+        print(f"{name:>24s}: {sizes[0]:6d} bytes compact, {sizes[1]:6d} bytes pretty")
+
+
+if __name__ == "__main__":
+    main()
@@ -19,5 +19,4 @@ class EventRelay(object):
         self.broadcaster_factory = broadcaster_factory
 
     def __call__(self, event):
-        for broadcaster in self.broadcaster_factory.broadcasters:
-            broadcaster.send_event(event)
+        return self.broadcaster_factory.send_event(event)
@@ -9,17 +9,13 @@ from comet.handler import EventRelay
 DUMMY_EVENT = "Dummy Event Text"
 
 
-class DummyBroadcaster(object):
+class DummyFactory(object):
     received_event = None
 
     def send_event(self, event):
         self.received_event = event
 
 
-class DummyFactory(object):
-    broadcasters = [DummyBroadcaster(), DummyBroadcaster()]
-
-
 class EventRelayTestCase(unittest.TestCase):
     def test_interface(self):
         self.assertTrue(IHandler.implementedBy(EventRelay))
@@ -31,5 +27,4 @@ class EventRelayTestCase(unittest.TestCase):
         factory = DummyFactory()
         relay = EventRelay(factory)
         relay(DUMMY_EVENT)
-        for broadcaster in factory.broadcasters:
-            self.assertEqual(broadcaster.received_event, DUMMY_EVENT)
+        self.assertEqual(factory.received_event, DUMMY_EVENT)
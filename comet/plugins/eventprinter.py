@@ -23,7 +23,7 @@ class EventPrinter(object):
         """
         Print an event to standard output.
         """
-        print(ElementTree.tounicode(event.element))
+        print(ElementTree.tounicode(event.element, pretty_print=True))
 
 
 # This instance of the handler is what actually constitutes our plugin.
@@ -11,6 +11,7 @@ from twisted.python import lockfile
 
 from comet.icomet import IHandler, IHasOptions
 import comet.log as log
+from comet.utility import VOEventHeader
 
 # Used when building filenames to avoid over-writing.
 FILENAME_PAD = "_"
@@ -71,7 +72,7 @@ class EventWriter(object):
         """
         if not os.path.exists(self.directory):
             os.makedirs(self.directory)
-        with event_file(event.element.attrib["ivorn"], self.directory) as f:
+        with event_file(VOEventHeader.of(event).ivorn, self.directory) as f:
             log.debug("Writing to %s" % (f.name,))
             f.write(event.raw_bytes.decode(event.encoding))
 
@@ -16,7 +16,7 @@ from twisted.plugin import IPlugin
 from comet.icomet import IHandler
 from comet.plugins.eventprinter import EventPrinter
 
-DUMMY_XML = u"<xml/>"
+DUMMY_XML = u"<xml><child/></xml>"
 
 
 class DummyEvent(object):
@@ -38,6 +38,7 @@ class EventPrinterTestCase(unittest.TestCase):
             sys.stdout = StringIO()
             event_printer(DummyEvent())
             sys.stdout.seek(0)
-            self.assertEqual(sys.stdout.read().strip(), DUMMY_XML)
+            # Events are pretty printed for human consumption.
+            self.assertEqual(sys.stdout.read().strip(), u"<xml>\n  <child/>\n</xml>")
         finally:
             sys.stdout = old_stdout
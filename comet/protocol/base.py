@@ -1,6 +1,9 @@
 # Comet VOEvent Broker.
 # Basic protocol building-blocks.
 
+# Python standard library
+import struct
+
 # Twisted protocol definition
 from twisted.internet import defer
 from twisted.protocols.basic import Int32StringReceiver
@@ -8,6 +11,8 @@ from twisted.protocols.basic import Int32StringReceiver
 # Comet
 import comet.log as log
 from comet.protocol.messages import TransportMessage
+from comet.utility import ParseError, StreamingParser, VOEventHeader, xml_document
+from comet.utility.xml import VOEVENT_ROLES
 
 
 class ElementSender(Int32StringReceiver):
@@ -16,11 +21,20 @@ class ElementSender(Int32StringReceiver):
     deserialized from ET elements.
     """
 
+    @classmethod
+    def frame(cls, document):
+        """
+        Return the raw bytes of document prefixed with their length, ready to
+        be written to the transport.
+        """
+        raw_bytes = document.raw_bytes
+        return struct.pack(cls.structFormat, len(raw_bytes)) + raw_bytes
+
     def send_xml(self, document):
         """
         Takes an xml_document and sends it as text.
         """
-        self.sendString(document.raw_bytes)
+        self.transport.write(self.frame(document))
 
     def lengthLimitExceeded(self, length):
         """
@@ -37,8 +51,81 @@ class EventHandler(ElementSender):
     """
     Superclass for protocols which will receive events (ie, Subscriber and
     Receiver) providing event handling support.
+
+    Subclasses implement `messageReceived`, which is called with each message
+    received. Messages longer than ``MAX_LENGTH``, but no longer than
+    ``MAX_STREAM_LENGTH``, are parsed incrementally as they arrive, rather
+    than being buffered in full first. Streamed messages which turn out not to
+    be VOEvents are discarded as soon as their root element has been read.
+    By default, ``MAX_STREAM_LENGTH`` is 0, and longer messages are refused.
     """
 
+    MAX_STREAM_LENGTH = 0
+
+    # Bytes of the message being streamed which remain to be received, and
+    # the parser to which they are fed (or None, if it is being discarded).
+    _stream_remaining = 0
+    _stream = None
+
+    def stringReceived(self, data):
+        try:
+            incoming = xml_document.infer_type(data)
+        except ParseError:
+            incoming = None
+        return self.messageReceived(incoming)
+
+    def messageReceived(self, incoming):
+        """
+        Called with each message received, or None if it could not be parsed.
+        """
+        raise NotImplementedError
+
+    def dataReceived(self, data):
+        if self._stream_remaining:
+            self._stream_received(data)
+        else:
+            ElementSender.dataReceived(self, data)
+
+    def lengthLimitExceeded(self, length):
+        if length > self.MAX_STREAM_LENGTH:
+            return ElementSender.lengthLimitExceeded(self, length)
+        log.debug(
+            "Streaming %d byte message from %s" % (length, self.transport.getPeer())
+        )
+        # Take over whatever has been buffered following the length prefix.
+        start = self._compatibilityOffset + self.prefixLength
+        data = self._unprocessed[start:]
+        self._unprocessed, self._compatibilityOffset = b"", 0
+        self._stream_remaining, self._stream = length, StreamingParser()
+        self._stream_received(data)
+
+    def _stream_received(self, data):
+        remaining = self._stream_remaining
+        chunk, rest = data[:remaining], data[remaining:]
+        self._stream_remaining -= len(chunk)
+        if self._stream is not None:
+            try:
+                self._stream.feed(chunk)
+                root = self._stream.root
+                if root is not None and root.get("role") not in VOEVENT_ROLES:
+                    raise ParseError("Not a VOEvent (role=%s)" % (root.get("role"),))
+            except ParseError as e:
+                log.debug("Discarding streamed message: %s" % (e,))
+                self._stream = None
+        if self._stream_remaining:
+            return
+
+        stream, self._stream = self._stream, None
+        incoming = None
+        if stream is not None:
+            try:
+                incoming = stream.close()
+            except ParseError:
+                pass
+        self.messageReceived(incoming)
+        if rest:
+            ElementSender.dataReceived(self, rest)
+
     def validate_event(self, event):
         """
         Call a set of event validators on a given event (an xml_document).
@@ -81,7 +168,7 @@ class EventHandler(ElementSender):
             log.debug("Event accepted; sending ACK to %s" % (self.transport.getPeer()))
             self.send_xml(
                 TransportMessage.ack(
-                    self.factory.local_ivo, event.element.attrib["ivorn"]
+                    self.factory.local_ivo, VOEventHeader.of(event).ivorn
                 )
             )
             self.handle_event(event).addCallbacks(
@@ -99,7 +186,7 @@ class EventHandler(ElementSender):
                 self.send_xml(
                     TransportMessage.nak(
                         self.factory.local_ivo,
-                        event.element.attrib["ivorn"],
+                        VOEventHeader.of(event).ivorn,
                         "Event rejected: %s"
                         % (failure.value.subFailure.getErrorMessage(),),
                     )
@@ -108,7 +195,7 @@ class EventHandler(ElementSender):
                 log.debug("Sending ACK to %s" % (self.transport.getPeer()))
                 self.send_xml(
                     TransportMessage.ack(
-                        self.factory.local_ivo, event.element.attrib["ivorn"]
+                        self.factory.local_ivo, VOEventHeader.of(event).ivorn
                     )
                 )
 
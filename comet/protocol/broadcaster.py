@@ -3,6 +3,8 @@
 # supplies them with VOEvent messages.
 
 # Python standard library
+import time
+from collections import deque
 from itertools import chain
 
 # XML parsing using lxml
@@ -10,9 +12,12 @@ import lxml.etree as ElementTree
 
 # Twisted protocol definition
 from twisted.internet import defer
+from twisted.internet.defer import Deferred
 from twisted.internet.task import LoopingCall
 from twisted.internet.threads import deferToThread
+from twisted.internet.interfaces import IPushProducer
 from twisted.internet.protocol import ServerFactory
+from zope.interface import implementer
 
 # Base protocol definitions
 from comet.protocol.base import ElementSender
@@ -22,10 +27,332 @@ from comet.protocol.messages import TransportMessage
 
 # Comet utility routines
 import comet.log as log
-from comet.utility import ParseError, VOEventMessage
+from comet.utility import ParseError, VOEventHeader, VOEventMessage
 
 __all__ = ["VOEventBroadcasterFactory"]
 
+# Limits on the messages queued for each subscriber, and what to do when they
+# are exceeded.
+QUEUE_MESSAGES = 1000
+QUEUE_BYTES = 64 * 2**20
+DROP_OLDEST, DROP_TEST, DISCONNECT = "drop-oldest", "drop-test", "disconnect"
+OVERFLOW_POLICIES = (DROP_OLDEST, DROP_TEST, DISCONNECT)
+
+
+def _evaluate(xpath, element):
+    """
+    Return whether element passes xpath, and the time taken to find out.
+
+    Errors in evaluation count as failure.
+    """
+    start = time.perf_counter()
+    try:
+        matches = bool(xpath(element))
+    except Exception:
+        matches = False
+    return matches, time.perf_counter() - start
+
+
+def _evaluate_batch(xpaths, element):
+    """Return the result of `_evaluate` for each of xpaths."""
+    return [_evaluate(xpath, element) for xpath in xpaths]
+
+
+def _fork(d):
+    """Return a new Deferred which fires with the result of d."""
+    forked = Deferred()
+
+    def fire(result):
+        forked.callback(result)
+        return result
+
+    d.addCallback(fire)
+    return forked
+
+
+class FilterRegistry(object):
+    """
+    The XPath filters installed by subscribers, shared between them.
+
+    Each distinct expression is compiled once, however many subscribers
+    install it, and evaluated at most once for each event: the result is
+    shared by every subscriber using the same expression. Results are
+    retained only for the most recent event.
+
+    Filters are evaluated in the reactor thread pool until they have been
+    measured: all those required for an event are evaluated by a single job.
+    Thereafter, those which take less than ``inline_threshold`` seconds on
+    average are evaluated directly in the reactor thread, avoiding the cost of
+    a round trip to the pool. An ``inline_threshold`` of 0 evaluates every
+    filter in the pool.
+
+    Each installed expression is assigned a bit, so that the results of
+    evaluating all of them against an event can be expressed as a single
+    bitmap (see `evaluate_all` and `mask`).
+    """
+
+    INLINE_THRESHOLD = 50e-6  # Seconds
+
+    def __init__(self, inline_threshold=INLINE_THRESHOLD):
+        self.inline_threshold = inline_threshold
+        self._xpaths = {}  # expression -> [compiled XPath, number of users, bit]
+        self._free_bits = []
+        self._next_bit = 0
+        self._costs = {}  # expression -> mean evaluation time
+        self._event = None
+        self._pending = {}  # expression -> Deferred result for self._event
+        self._results = {}  # expression -> result for self._event
+
+    def __len__(self):
+        return len(self._xpaths)
+
+    def install(self, expression):
+        """
+        Return a compiled XPath for expression, which is shared with any
+        other user of the same expression.
+
+        Raises XPathSyntaxError if expression is invalid.
+        """
+        entry = self._xpaths.get(expression)
+        if entry is None:
+            xpath = ElementTree.XPath(expression)
+            if self._free_bits:
+                bit = self._free_bits.pop()
+            else:
+                bit, self._next_bit = self._next_bit, self._next_bit + 1
+            entry = self._xpaths[expression] = [xpath, 0, bit]
+        entry[1] += 1
+        return entry[0]
+
+    def uninstall(self, xpath):
+        """Release an XPath returned by `install`."""
+        entry = self._xpaths.get(xpath.path)
+        if entry is not None and entry[0] is xpath:
+            entry[1] -= 1
+            if not entry[1]:
+                del self._xpaths[xpath.path]
+                self._costs.pop(xpath.path, None)
+                self._free_bits.append(entry[2])
+
+    def mask(self, xpaths):
+        """
+        Return a bitmap with the bit for each of xpaths set.
+
+        XPaths which were not returned by `install` are ignored.
+        """
+        mask = 0
+        for xpath in xpaths:
+            entry = self._xpaths.get(xpath.path)
+            if entry is not None and entry[0] is xpath:
+                mask |= 1 << entry[2]
+        return mask
+
+    def is_inline(self, expression):
+        """Return True if expression will be evaluated in the reactor thread."""
+        cost = self._costs.get(expression)
+        return cost is not None and cost < self.inline_threshold
+
+    def evaluate(self, event, xpaths):
+        """
+        Return a Deferred which fires with a list of booleans indicating
+        whether event passes each of xpaths.
+
+        If every result is available without consulting the thread pool, the
+        Deferred has already fired.
+        """
+        if event is not self._event:
+            self._event, self._pending, self._results = event, {}, {}
+        results, pending = self._results, self._pending
+        batch = []
+        for xpath in xpaths:
+            path = xpath.path
+            if path in results or path in pending:
+                continue
+            if self.is_inline(path):
+                self._store(_evaluate(xpath, event.element), event, path)
+            else:
+                pending[path] = Deferred()
+                batch.append(xpath)
+        if batch:
+            self._submit(event, batch)
+        try:
+            return defer.succeed([results[xpath.path] for xpath in xpaths])
+        except KeyError:
+            return defer.gatherResults(
+                [
+                    (
+                        defer.succeed(results[xpath.path])
+                        if xpath.path in results
+                        else _fork(pending[xpath.path])
+                    )
+                    for xpath in xpaths
+                ]
+            )
+
+    def evaluate_all(self, event):
+        """
+        Evaluate every installed filter against event.
+
+        Returns a Deferred which fires with a bitmap in which the bit of each
+        filter which event passes is set.
+        """
+        xpaths = [entry[0] for entry in self._xpaths.values()]
+
+        def to_bitmap(matches):
+            bitmap = 0
+            for xpath, passed in zip(xpaths, matches):
+                entry = self._xpaths.get(xpath.path)
+                if passed and entry is not None and entry[0] is xpath:
+                    bitmap |= 1 << entry[2]
+            return bitmap
+
+        return self.evaluate(event, xpaths).addCallback(to_bitmap)
+
+    def evaluated(self, event):
+        """
+        Return the results of evaluating filters against event which are
+        already available, without waiting for the thread pool.
+
+        Returns a bitmap in which the bit of each filter which event passes is
+        set, and a mask in which the bit of each filter evaluated is set.
+        """
+        bitmap = mask = 0
+        if event is self._event:
+            for expression, matches in self._results.items():
+                entry = self._xpaths.get(expression)
+                if entry is not None:
+                    mask |= 1 << entry[2]
+                    if matches:
+                        bitmap |= 1 << entry[2]
+        return bitmap, mask
+
+    def _submit(self, event, batch):
+        pending = [self._pending[xpath.path] for xpath in batch]
+
+        def store(results):
+            for xpath, d, result in zip(batch, pending, results):
+                d.callback(self._store(result, event, xpath.path))
+
+        deferToThread(_evaluate_batch, batch, event.element).addCallback(store)
+
+    def _store(self, result, event, expression):
+        matches, elapsed = result
+        cost = self._costs.get(expression)
+        if expression in self._xpaths:
+            self._costs[expression] = elapsed if cost is None else (cost + elapsed) / 2
+        if event is self._event:
+            self._results[expression] = matches
+            self._pending.pop(expression, None)
+        return matches
+
+
+@implementer(IPushProducer)
+class OutboundQueue(object):
+    """
+    Messages waiting to be written to a subscriber's transport.
+
+    Messages are written immediately unless the transport, with which the
+    queue is registered as a producer, has asked it to pause because the
+    subscriber is not keeping up. They are then queued until the transport
+    resumes. The queue is bounded by both the number of messages and their
+    total size in bytes; when either is exceeded, the overflow policy is
+    applied:
+
+    ``drop-oldest``
+        Discard the oldest messages until the queue is within its limits.
+    ``drop-test``
+        As ``drop-oldest``, but discard test events before anything else.
+    ``disconnect``
+        Discard everything and drop the connection.
+
+    Messages may be marked as requiring an acknowledgement from the
+    subscriber; if one of these is discarded, ``ack_dropped`` (if supplied)
+    is called, since the subscriber will never acknowledge it.
+    """
+
+    def __init__(
+        self,
+        transport,
+        max_messages=QUEUE_MESSAGES,
+        max_bytes=QUEUE_BYTES,
+        policy=DROP_TEST,
+        ack_dropped=None,
+    ):
+        if policy not in OVERFLOW_POLICIES:
+            raise ValueError("Unknown overflow policy: %s" % (policy,))
+        self.transport = transport
+        self.max_messages = max_messages
+        self.max_bytes = max_bytes
+        self.policy = policy
+        self.ack_dropped = ack_dropped
+        self.paused = False
+        self.bytes = 0  # Total size of queued messages
+        self.dropped = 0  # Number of messages discarded on overflow
+        self._queue = deque()  # (data, is_test, ack) tuples
+
+    def __len__(self):
+        return len(self._queue)
+
+    def put(self, data, is_test=False, ack=False):
+        """Write data to the transport, or queue it if we are paused."""
+        if not self.paused and not self._queue:
+            self.transport.write(data)
+            return
+        self._queue.append((data, is_test, ack))
+        self.bytes += len(data)
+        if self._over_limits(len(self._queue)):
+            self._overflow()
+
+    def _overflow(self):
+        if self.policy == DISCONNECT:
+            log.warn(
+                "Outbound queue for %s full: disconnecting"
+                % (str(self.transport.getPeer()),)
+            )
+            self.stopProducing()
+            self.transport.abortConnection()
+            return
+        if self.policy == DROP_TEST:
+            remaining, kept = len(self._queue), deque()
+            for message in self._queue:
+                if message[1] and self._over_limits(remaining):
+                    self._drop(message)
+                    remaining -= 1
+                else:
+                    kept.append(message)
+            self._queue = kept
+        while self._over_limits(len(self._queue)):
+            self._drop(self._queue.popleft())
+
+    def _over_limits(self, messages):
+        return messages > self.max_messages or self.bytes > self.max_bytes
+
+    def _drop(self, message):
+        data, _, ack = message
+        self.bytes -= len(data)
+        self.dropped += 1
+        log.warn(
+            "Outbound queue for %s full: dropping message"
+            % (str(self.transport.getPeer()),)
+        )
+        if ack and self.ack_dropped:
+            self.ack_dropped()
+
+    def pauseProducing(self):
+        self.paused = True
+
+    def resumeProducing(self):
+        self.paused = False
+        while self._queue and not self.paused:
+            data = self._queue.popleft()[0]
+            self.bytes -= len(data)
+            self.transport.write(data)
+
+    def stopProducing(self):
+        self.paused = True
+        self._queue.clear()
+        self.bytes = 0
+
 
 class VOEventBroadcaster(ElementSender):
     MAX_ALIVE_COUNT = 1  # Drop connection if peer misses too many iamalives
@@ -33,17 +360,27 @@ class VOEventBroadcaster(ElementSender):
 
     def __init__(self):
         self.filters = []
+        self.filter_mask = 0
 
     def connectionMade(self):
         log.info("New subscriber at %s" % str(self.transport.getPeer()))
         self.factory.broadcasters.append(self)
         self.alive_count = 0
+        self.queue = OutboundQueue(
+            self.transport,
+            self.factory.queue_messages,
+            self.factory.queue_bytes,
+            self.factory.overflow_policy,
+            self._ack_dropped,
+        )
+        self.transport.registerProducer(self.queue, True)
         self.send_xml(TransportMessage.authenticate(self.factory.local_ivo))
         self.outstanding_ack = 0
 
     def connectionLost(self, *args):
         log.info("Subscriber at %s disconnected" % str(self.transport.getPeer()))
         self.factory.broadcasters.remove(self)
+        self._uninstall_filters()
         return ElementSender.connectionLost(self, *args)
 
     def sendIAmAlive(self):
@@ -56,10 +393,25 @@ class VOEventBroadcaster(ElementSender):
         else:
             self.send_xml(TransportMessage.iamalive(self.factory.local_ivo))
             self.alive_count += 1
+        if self.queue or self.queue.dropped:
+            log.info(
+                "%d messages (%d bytes) queued for %s; %d dropped"
+                % (
+                    len(self.queue),
+                    self.queue.bytes,
+                    str(self.transport.getPeer()),
+                    self.queue.dropped,
+                )
+            )
+
+    def send_xml(self, document):
+        # Written through the queue, so that a slow subscriber cannot cause
+        # unbounded buffering.
+        self.queue.put(self.frame(document))
 
     def stringReceived(self, data):
         try:
-            incoming = TransportMessage(data)
+            incoming = TransportMessage.from_bytes(data)
         except ParseError:
             log.warn("Unparsable message received")
             return
@@ -77,65 +429,92 @@ class VOEventBroadcaster(ElementSender):
             self.transport.loseConnection()
         elif incoming.role == "authenticate":
             log.debug("Authentication received from %s" % str(self.transport.getPeer()))
-            self.filters = []
+            try:
+                element = incoming.element
+            except ParseError:
+                log.warn("Unparsable message received")
+                return
+            self._uninstall_filters()
             # Accept both "new-style" (<Param type="xpath-filter" />) and
             # old-style (<filter type="xpath" />) filters.
             for xpath in chain(
                 [
                     elem.get("value")
-                    for elem in incoming.element.findall(
-                        'Meta/Param[@name="xpath-filter"]'
-                    )
-                ],
-                [
-                    elem.text
-                    for elem in incoming.element.findall('Meta/filter[@type="xpath"]')
+                    for elem in element.findall('Meta/Param[@name="xpath-filter"]')
                 ],
+                [elem.text for elem in element.findall('Meta/filter[@type="xpath"]')],
             ):
                 log.info(
                     "Installing filter %s for %s"
                     % (xpath, str(self.transport.getPeer()))
                 )
                 try:
-                    self.filters.append(ElementTree.XPath(xpath))
+                    self.filters.append(self.factory.filter_registry.install(xpath))
                 except ElementTree.XPathSyntaxError:
                     log.info("Filter %s is not valid XPath" % (xpath,))
+            self.filter_mask = self.factory.filter_registry.mask(self.filters)
         else:
             log.warn(
                 "Incomprehensible data received from %s (role=%s)"
                 % (self.transport.getPeer(), incoming.role)
             )
 
-    def send_event(self, event):
-        # Check the event against our filters and, if one or more pass, then
-        # we send the event to our subscriber.
-        def check_filters(result):
-            if not self.filters or any([value for success, value in result if success]):
-                log.info(
-                    "Event matches filter criteria: forwarding to %s"
-                    % (str(self.transport.getPeer()),)
-                )
-                self.send_xml(event)
-                self.outstanding_ack += 1
-            else:
-                log.info("Event rejected by filter")
+    def _uninstall_filters(self):
+        for xpath in self.filters:
+            self.factory.filter_registry.uninstall(xpath)
+        self.filters = []
+        self.filter_mask = 0
+
+    def _forward(self, event, frame):
+        # frame is event as returned by frame(), which may be shared with
+        # other subscribers.
+        self.outstanding_ack += 1
+        self.queue.put(frame, VOEventHeader.of(event).role == "test", ack=True)
 
-        return defer.DeferredList(
-            [deferToThread(xpath, event.element) for xpath in self.filters],
-            consumeErrors=True,
-        ).addCallback(check_filters)
+    def _ack_dropped(self):
+        # An event was dropped from the queue, so will never be acknowledged.
+        self.outstanding_ack -= 1
+
+    def deliver(self, event, bitmap, frame):
+        """
+        Send event if it passes our filters, given a bitmap of the filters it
+        passes, as returned by `FilterRegistry.evaluate_all`, and the event as
+        returned by `frame`.
+        """
+        if not self.filters:
+            self._forward(event, frame)
+        elif bitmap & self.filter_mask:
+            log.info(
+                "Event matches filter criteria: forwarding to %s"
+                % (str(self.transport.getPeer()),)
+            )
+            self._forward(event, frame)
+        else:
+            log.info("Event rejected by filter")
 
 
 class VOEventBroadcasterFactory(ServerFactory):
     IAMALIVE_INTERVAL = 60  # Sent iamalive every IAMALIVE_INTERVAL seconds
     protocol = VOEventBroadcaster
 
-    def __init__(self, local_ivo, test_interval):
+    def __init__(
+        self,
+        local_ivo,
+        test_interval,
+        queue_messages=QUEUE_MESSAGES,
+        queue_bytes=QUEUE_BYTES,
+        overflow_policy=DROP_TEST,
+    ):
         # test_interval is the time in seconds between sending test events to
-        # the network. 0 to disable.
+        # the network. 0 to disable. The remaining arguments configure each
+        # subscriber's OutboundQueue.
         self.local_ivo = local_ivo
         self.test_interval = test_interval
+        self.queue_messages = queue_messages
+        self.queue_bytes = queue_bytes
+        self.overflow_policy = overflow_policy
         self.broadcasters = []
+        self.filter_registry = FilterRegistry()
         self.alive_loop = LoopingCall(self.sendIAmAlive)
         self.test_loop = LoopingCall(self.sendTestEvent)
 
@@ -158,6 +537,45 @@ class VOEventBroadcasterFactory(ServerFactory):
 
     def sendTestEvent(self):
         log.debug("Broadcasting test event")
-        test_event = VOEventMessage.broker_test(self.local_ivo)
-        for broadcaster in self.broadcasters:
-            broadcaster.send_event(test_event)
+        return self.send_event(VOEventMessage.broker_test(self.local_ivo))
+
+    def send_event(self, event):
+        """
+        Send event to every subscriber whose filters it passes.
+
+        The event is framed only once, and the same frame is written to every
+        subscriber. Subscribers without filters, and those whose filters have
+        been evaluated in the reactor thread, are sent the event immediately.
+        Filters which must be evaluated in the thread pool are evaluated
+        together by a single job, then the event is sent to each of the
+        remaining matching subscribers in a single pass. Returns a Deferred
+        which fires when every subscriber has been sent the event or has
+        rejected it.
+        """
+        frame = self.protocol.frame(event)
+        filtered = []
+        for broadcaster in list(self.broadcasters):
+            if broadcaster.filters:
+                filtered.append(broadcaster)
+            else:
+                broadcaster.deliver(event, 0, frame)
+        if not filtered:
+            return defer.succeed(None)
+
+        d = self.filter_registry.evaluate_all(event)
+        bitmap, evaluated = self.filter_registry.evaluated(event)
+        waiting = []
+        for broadcaster in filtered:
+            mask = broadcaster.filter_mask
+            if mask & bitmap or not mask & ~evaluated:
+                broadcaster.deliver(event, bitmap, frame)
+            else:
+                waiting.append(broadcaster)
+
+        def fan_out(bitmap):
+            connected = set(self.broadcasters)
+            for broadcaster in waiting:
+                if broadcaster in connected:
+                    broadcaster.deliver(event, bitmap, frame)
+
+        return d.addCallback(fan_out)
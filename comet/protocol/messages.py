@@ -2,7 +2,10 @@
 # VOEvent transport protocol messages.
 
 # Python standard library
+import re
+import time
 from datetime import datetime
+from xml.sax.saxutils import escape
 
 # XML parsing using lxml
 import lxml.etree as ElementTree
@@ -15,16 +18,92 @@ ElementTree.register_namespace(
     "trn", "http://www.telescope-networks.org/xml/Transport/v1.1"
 )
 
+# Characters which may not appear in an XML document.
+INVALID_CHARACTERS = re.compile(
+    "[^\t\n\r\x20-\ud7ff\ue000-\ufffd\U00010000-\U0010ffff]"
+)
+
+
+# The current second and its time stamp, as used by _timestamp().
+_last_timestamp = (None, None)
+
+
+def _timestamp():
+    """Return the current UTC time stamp, encoded, caching it each second."""
+    global _last_timestamp
+    now = int(time.time())
+    second, timestamp = _last_timestamp
+    if now != second:
+        timestamp = time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime(now)).encode()
+        _last_timestamp = (now, timestamp)
+    return timestamp
+
+
+def _text(value):
+    """Encode value for use as the text content of an element."""
+    if isinstance(value, bytes):
+        value = value.decode("utf-8")
+    if INVALID_CHARACTERS.search(value):
+        raise ValueError("All strings must be XML compatible")
+    return escape(value, {"\r": "&#13;"}).encode("utf-8")
+
 
 class TransportMessage(xml_document):
 
     # NB: ordering within packet must be per schema --
     # Origin, Response, Timestamp, Meta.
 
+    __slots__ = ["_origin"]
+
+    # Received messages with these roles are not parsed unless their element
+    # is required: their role and origin are read directly from their bytes.
+    SNIFFED_ROLES = ("iamalive", "authenticate")
+
+    # Templates for outgoing messages; see _template().
+    _templates = {}
+
     @property
     def origin(self):
+        if self._element is None:
+            return self._origin
         return self.element.find("Origin").text
 
+    @classmethod
+    def from_sniffed(cls, raw_bytes, role, end):
+        """
+        Construct from raw_bytes without parsing them, given the role and end
+        of the root tag found by `~xml_document.sniff_role`.
+
+        Returns None if the message should be parsed instead.
+        """
+        if role not in cls.SNIFFED_ROLES:
+            return None
+        # Origin must be the first child of the root element, and we only
+        # accept plain text content.
+        after_root, tag = end + 1, raw_bytes.find(b"<Origin>", end)
+        start, stop = tag + len(b"<Origin>"), raw_bytes.find(b"</Origin>", tag)
+        if tag < 0 or stop < 0 or raw_bytes[after_root:tag].strip():
+            return None
+        origin = raw_bytes[start:stop]
+        if b"&" in origin or b"<" in origin:
+            return None
+        try:
+            origin = origin.decode("ascii")
+        except UnicodeDecodeError:
+            return None
+        message = cls._unparsed(raw_bytes, role)
+        message._origin = origin
+        return message
+
+    @classmethod
+    def from_bytes(cls, raw_bytes):
+        """Construct from raw_bytes, parsing them only if necessary."""
+        if isinstance(raw_bytes, bytes):
+            message = cls.from_sniffed(raw_bytes, *cls.sniff_role(raw_bytes))
+            if message is not None:
+                return message
+        return cls(raw_bytes)
+
     @staticmethod
     def _root_element():
         return ElementTree.Element(
@@ -49,47 +128,74 @@ class TransportMessage(xml_document):
         timestamp.text = datetime.utcnow().strftime("%Y-%m-%dT%H:%M:%SZ")
         return root_element
 
+    @classmethod
+    def _template(cls, role, response, result):
+        """
+        Return a template for outgoing messages with the given role.
+
+        The template is the serialization of a message with placeholders for
+        the text of its Origin, optional Response, TimeStamp and optional
+        Meta/Result elements, in that order. Templates are built on first use
+        and cached; they follow the current serialization policy.
+        """
+        key = (role, response, result, cls.pretty_print)
+        if key not in cls._templates:
+            root_element = cls._root_element()
+            root_element.set("role", role)
+            ElementTree.SubElement(root_element, "Origin").text = "%s"
+            if response:
+                ElementTree.SubElement(root_element, "Response").text = "%s"
+            ElementTree.SubElement(root_element, "TimeStamp").text = "%s"
+            if result:
+                meta = ElementTree.SubElement(root_element, "Meta")
+                ElementTree.SubElement(meta, "Result").text = "%s"
+            cls._templates[key] = ElementTree.tostring(
+                root_element,
+                xml_declaration=True,
+                encoding="UTF-8",
+                pretty_print=cls.pretty_print,
+            )
+        return cls._templates[key]
+
+    @classmethod
+    def _from_template(cls, role, origin, response=None, result=None):
+        """
+        Construct a message from a template, without building a tree.
+
+        Response and Meta/Result elements are included if specified.
+        """
+        values = [_text(origin or "")]
+        if response:
+            values.append(_text(response))
+        values.append(_timestamp())
+        if result:
+            values.append(_text(result))
+        raw_bytes = cls._template(role, bool(response), bool(result)) % tuple(values)
+        message = cls._unparsed(raw_bytes, role)
+        if isinstance(origin, bytes):
+            origin = origin.decode("utf-8")
+        message._origin = origin or None
+        return message
+
     @classmethod
     def iamalive(cls, local_ivo):
-        root_element = cls._root_element()
-        root_element.set("role", "iamalive")
-        origin = ElementTree.SubElement(root_element, "Origin")
-        origin.text = local_ivo
-        timestamp = ElementTree.SubElement(root_element, "TimeStamp")
-        timestamp.text = datetime.utcnow().strftime("%Y-%m-%dT%H:%M:%SZ")
-        return cls(root_element)
+        return cls._from_template("iamalive", local_ivo)
 
     @classmethod
     def iamaliveresponse(cls, local_ivo, remote_ivo):
-        root_element = cls._origin_response_element(local_ivo, remote_ivo)
-        root_element.set("role", "iamalive")
-        return cls(root_element)
+        return cls._from_template("iamalive", remote_ivo, local_ivo)
 
     @classmethod
     def ack(cls, local_ivo, remote_ivo):
-        root_element = cls._origin_response_element(local_ivo, remote_ivo)
-        root_element.set("role", "ack")
-        return cls(root_element)
+        return cls._from_template("ack", remote_ivo, local_ivo)
 
     @classmethod
     def nak(cls, local_ivo, remote_ivo, result=None):
-        root_element = cls._origin_response_element(local_ivo, remote_ivo)
-        root_element.set("role", "nak")
-        if result:
-            meta = ElementTree.SubElement(root_element, "Meta")
-            result_element = ElementTree.SubElement(meta, "Result")
-            result_element.text = result
-        return cls(root_element)
+        return cls._from_template("nak", remote_ivo, local_ivo, result)
 
     @classmethod
     def authenticate(cls, local_ivo):
-        root_element = cls._root_element()
-        root_element.set("role", "authenticate")
-        origin = ElementTree.SubElement(root_element, "Origin")
-        origin.text = local_ivo
-        timestamp = ElementTree.SubElement(root_element, "TimeStamp")
-        timestamp.text = datetime.utcnow().strftime("%Y-%m-%dT%H:%M:%SZ")
-        return cls(root_element)
+        return cls._from_template("authenticate", local_ivo)
 
     @classmethod
     def authenticateresponse(cls, local_ivo, remote_ivo, filters):
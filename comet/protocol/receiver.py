@@ -10,7 +10,6 @@ from comet.protocol.base import EventHandler
 
 # Comet utility routines
 import comet.log as log
-from comet.utility import xml_document, ParseError
 
 __all__ = ["VOEventReceiverFactory"]
 
@@ -38,39 +37,41 @@ class VOEventReceiver(EventHandler, TimeoutMixin):
         )
         return TimeoutMixin.timeoutConnection(self)
 
-    def stringReceived(self, data):
+    def messageReceived(self, incoming):
         """
         Called when a complete new message is received.
         """
-        try:
-            incoming = xml_document.infer_type(data)
-        except ParseError:
+        if incoming is None:
             d = log.warn(
                 "Unparsable message received from %s" % str(self.transport.getPeer())
             )
+        # The root element of both VOEvent and Transport packets has a
+        # "role" element which we use to identify the type of message we
+        # have received.
+        elif hasattr(incoming, "ivoid"):
+            log.info(
+                "VOEvent %s received from %s"
+                % (incoming.ivoid, str(self.transport.getPeer()))
+            )
+            d = self.process_event(incoming)
         else:
-            # The root element of both VOEvent and Transport packets has a
-            # "role" element which we use to identify the type of message we
-            # have received.
-            if hasattr(incoming, "ivoid"):
-                log.info(
-                    "VOEvent %s received from %s"
-                    % (incoming.ivoid, str(self.transport.getPeer()))
-                )
-                d = self.process_event(incoming)
-            else:
-                d = log.warn(
-                    "Incomprehensible data received from %s (role=%s)"
-                    % (self.transport.getPeer(), incoming.role)
-                )
-        finally:
-            return d.addCallback(lambda x: self.transport.loseConnection())
+            d = log.warn(
+                "Incomprehensible data received from %s (role=%s)"
+                % (self.transport.getPeer(), incoming.role)
+            )
+        return d.addCallback(lambda x: self.transport.loseConnection())
 
 
 class VOEventReceiverFactory(ServerFactory):
     protocol = VOEventReceiver
 
-    def __init__(self, local_ivo, validators=None, handlers=None):
+    def __init__(self, local_ivo, validators=None, handlers=None, max_stream_length=0):
         self.local_ivo = local_ivo
         self.validators = validators or []
         self.handlers = handlers or []
+        self.max_stream_length = max_stream_length
+
+    def buildProtocol(self, addr):
+        p = ServerFactory.buildProtocol(self, addr)
+        p.MAX_STREAM_LENGTH = self.max_stream_length
+        return p
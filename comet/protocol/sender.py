@@ -9,7 +9,7 @@ from comet.protocol.base import ElementSender
 
 # Comet utility routines
 import comet.log as log
-from comet.utility import xml_document, ParseError
+from comet.utility import xml_document, ParseError, VOEventHeader
 
 __all__ = ["VOEventSender"]
 
@@ -83,7 +83,7 @@ class VOEventSender(ElementSender):
             self.transport.loseConnection()
             return incoming
 
-        outgoing_ivoid = event.element.attrib["ivorn"]
+        outgoing_ivoid = VOEventHeader.of(event).ivorn
         self.send_xml(event)
         d = Deferred().addCallback(log_response)
         self._sent_ivoids[outgoing_ivoid] = d
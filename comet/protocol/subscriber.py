@@ -14,7 +14,6 @@ from comet.protocol.messages import TransportMessage
 
 # Comet utility routines
 import comet.log as log
-from comet.utility import xml_document, ParseError
 
 __all__ = ["VOEventSubscriberFactory"]
 
@@ -44,13 +43,11 @@ class VOEventSubscriber(EventHandler, TimeoutMixin):
         )
         return TimeoutMixin.timeoutConnection(self)
 
-    def stringReceived(self, data):
+    def messageReceived(self, incoming):
         """
         Called when a complete new message is received.
         """
-        try:
-            incoming = xml_document.infer_type(data)
-        except ParseError:
+        if incoming is None:
             log.warn("Unparsable message received")
             return
 
@@ -99,13 +96,16 @@ class VOEventSubscriberFactory(Factory):
         validators=None,
         handlers=None,
         filters=None,
+        max_stream_length=0,
     ):
         self.local_ivo = local_ivo
         self.handlers = handlers or []
         self.validators = validators or []
         self.filters = filters or []
+        self.max_stream_length = max_stream_length
 
     def buildProtocol(self, addr):
         p = self.protocol(self.filters)
         p.factory = self
+        p.MAX_STREAM_LENGTH = self.max_stream_length
         return p
@@ -9,7 +9,8 @@ from twisted.internet import defer
 from twisted.test import proto_helpers
 from twisted.internet.protocol import ServerFactory
 
-from comet.testutils import DummyEvent, DUMMY_EVENT_IVOID
+from comet.testutils import DummyEvent, DUMMY_EVENT_IVOID, DUMMY_IAMALIVE
+from comet.testutils import DUMMY_VOEVENT
 from comet.protocol.base import ElementSender, EventHandler
 
 
@@ -32,6 +33,13 @@ class ElementSenderTestCase(unittest.TestCase):
             struct.pack("!i", len(dummy_element.raw_bytes)) + dummy_element.raw_bytes,
         )
 
+    def test_frame(self):
+        event = DummyEvent()
+        self.assertEqual(
+            self.proto.frame(event),
+            struct.pack("!i", len(event.raw_bytes)) + event.raw_bytes,
+        )
+
     def test_lengthLimitExceeded(self):
         self.assertEqual(self.tr.disconnecting, False)
         dummy_element = DummyEvent()
@@ -127,3 +135,74 @@ class EventHandlerTestCase(unittest.TestCase):
         d.addCallback(self._check_for_role, "ack")
         d.addCallback(self._check_for_handler_runs, False)
         return d
+
+
+class StreamingEventHandler(EventHandler):
+    MAX_LENGTH = 100
+    MAX_STREAM_LENGTH = 2**24
+
+    def __init__(self):
+        self.received = []
+
+    def messageReceived(self, incoming):
+        self.received.append(incoming)
+
+
+class StreamingEventHandlerFactory(ServerFactory):
+    protocol = StreamingEventHandler
+
+
+class EventHandlerStreamingTestCase(unittest.TestCase):
+    def setUp(self):
+        factory = StreamingEventHandlerFactory()
+        self.proto = factory.buildProtocol(("127.0.0.1", 0))
+        self.tr = proto_helpers.StringTransport()
+        self.proto.makeConnection(self.tr)
+
+    def _frame(self, raw_bytes):
+        return struct.pack("!I", len(raw_bytes)) + raw_bytes
+
+    def _send(self, data, size=64):
+        for start in range(0, len(data), size):
+            stop = start + size
+            self.proto.dataReceived(data[start:stop])
+            # Streamed messages are not buffered by the protocol.
+            self.assertLessEqual(len(self.proto._unprocessed), size)
+
+    def test_stream(self):
+        self._send(self._frame(DUMMY_VOEVENT))
+        self.assertEqual(len(self.proto.received), 1)
+        self.assertEqual(self.proto.received[0].raw_bytes, DUMMY_VOEVENT)
+        self.assertEqual(self.proto.received[0].ivoid, DUMMY_EVENT_IVOID.decode())
+        self.assertFalse(self.tr.disconnecting)
+
+    def test_stream_followed(self):
+        # Messages following a streamed message are received as usual.
+        self._send(self._frame(DUMMY_VOEVENT) + self._frame(DUMMY_VOEVENT), size=1000)
+        self.assertEqual(len(self.proto.received), 2)
+        for incoming in self.proto.received:
+            self.assertEqual(incoming.raw_bytes, DUMMY_VOEVENT)
+
+    def test_stream_not_voevent(self):
+        # Streamed messages must be VOEvents; others are discarded.
+        self.assertGreater(len(DUMMY_IAMALIVE), self.proto.MAX_LENGTH)
+        self._send(self._frame(DUMMY_IAMALIVE))
+        self.assertEqual(self.proto.received, [None])
+        self.assertIsNone(self.proto._stream)
+
+    def test_stream_unparsable(self):
+        self._send(self._frame(DUMMY_VOEVENT.replace(b"</Who>", b"")))
+        self.assertEqual(self.proto.received, [None])
+
+    def test_stream_disabled(self):
+        # By default, messages longer than MAX_LENGTH are refused.
+        self.proto.MAX_STREAM_LENGTH = EventHandler.MAX_STREAM_LENGTH
+        self.proto.dataReceived(self._frame(DUMMY_VOEVENT))
+        self.assertEqual(self.proto.received, [])
+        self.assertTrue(self.tr.disconnecting)
+
+    def test_stream_length_exceeded(self):
+        self.proto.MAX_STREAM_LENGTH = len(DUMMY_VOEVENT) - 1
+        self.proto.dataReceived(self._frame(DUMMY_VOEVENT))
+        self.assertEqual(self.proto.received, [])
+        self.assertTrue(self.tr.disconnecting)
@@ -8,7 +8,8 @@ import lxml.etree as etree
 from twisted.trial import unittest
 
 import comet
-from comet.testutils import DUMMY_SERVICE_IVOID
+from comet.testutils import DUMMY_ACK, DUMMY_IAMALIVE, DUMMY_SERVICE_IVOID
+from comet.testutils import DUMMY_EVENT_IVOID
 from comet.protocol.messages import TransportMessage
 
 
@@ -78,3 +79,95 @@ class TransportTestCase(unittest.TestCase):
         for inp, outp in zip(filters, filter_elems):
             self.assertEqual(inp, outp.get("value"))
         self._check_message(message, "authenticate")
+
+
+class TransportMessageTemplateTestCase(unittest.TestCase):
+    def _check_serialization(self, message):
+        # The message is not parsed until its element is required, and its
+        # bytes are just as lxml would produce from its element.
+        self.assertIsNone(message._element)
+        self.assertEqual(
+            etree.tostring(
+                message.element,
+                xml_declaration=True,
+                encoding="UTF-8",
+                pretty_print=message.pretty_print,
+            ),
+            message.raw_bytes,
+        )
+
+    def test_messages(self):
+        for message in [
+            TransportMessage.iamalive(DUMMY_SERVICE_IVOID),
+            TransportMessage.iamaliveresponse(DUMMY_SERVICE_IVOID, DUMMY_EVENT_IVOID),
+            TransportMessage.ack(DUMMY_SERVICE_IVOID, DUMMY_EVENT_IVOID),
+            TransportMessage.ack(None, DUMMY_EVENT_IVOID),
+            TransportMessage.nak(DUMMY_SERVICE_IVOID, DUMMY_EVENT_IVOID, "reason"),
+            TransportMessage.authenticate(DUMMY_SERVICE_IVOID),
+        ]:
+            self._check_serialization(message)
+
+    def test_compact(self):
+        message = TransportMessage.ack(DUMMY_SERVICE_IVOID, DUMMY_EVENT_IVOID)
+        self.assertEqual(message.raw_bytes.count(b"\n"), 1)
+        self._check_serialization(message)
+
+    def test_pretty_print(self):
+        self.patch(TransportMessage, "pretty_print", True)
+        message = TransportMessage.ack(DUMMY_SERVICE_IVOID, DUMMY_EVENT_IVOID)
+        self.assertIn(b"\n  <Origin>", message.raw_bytes)
+        self._check_serialization(message)
+
+    def test_origin(self):
+        message = TransportMessage.ack(DUMMY_SERVICE_IVOID, DUMMY_EVENT_IVOID)
+        self.assertEqual(message.origin, DUMMY_EVENT_IVOID.decode())
+        self.assertEqual(message.element.find("Origin").text, message.origin)
+
+    def test_escaping(self):
+        result = "Event rejected: <a> & <b>\r\n"
+        origin = "ivo://comet.broker/test#a&b<c>"
+        message = TransportMessage.nak(DUMMY_SERVICE_IVOID, origin, result)
+        self._check_serialization(message)
+        self.assertEqual(message.element.find("Origin").text, origin)
+        self.assertEqual(message.element.find("Meta/Result").text, result)
+
+    def test_invalid_characters(self):
+        self.assertRaises(
+            ValueError, TransportMessage.nak, DUMMY_SERVICE_IVOID, "ivo://a/b", "\x00"
+        )
+
+
+class TransportMessageFromBytesTestCase(unittest.TestCase):
+    def test_sniffed(self):
+        # Role and origin are available without parsing.
+        message = TransportMessage.from_bytes(DUMMY_IAMALIVE)
+        self.assertIsNone(message._element)
+        self.assertEqual(message.role, "iamalive")
+        self.assertEqual(message.origin, DUMMY_EVENT_IVOID.decode())
+        self.assertEqual(message.raw_bytes, DUMMY_IAMALIVE)
+
+        # The element is parsed on demand.
+        self.assertEqual(message.element.find("Origin").text, message.origin)
+        self.assertIsNotNone(message._element)
+
+    def test_parsed(self):
+        # Other roles are parsed immediately.
+        message = TransportMessage.from_bytes(DUMMY_ACK)
+        self.assertIsNotNone(message._element)
+        self.assertEqual(message.role, "ack")
+
+    def _check_not_sniffed(self, raw_bytes):
+        message = TransportMessage.from_bytes(raw_bytes)
+        self.assertIsNotNone(message._element)
+        return message
+
+    def test_origin_with_entity(self):
+        message = self._check_not_sniffed(
+            DUMMY_IAMALIVE.replace(DUMMY_EVENT_IVOID, b"ivo://a/b#c&amp;d")
+        )
+        self.assertEqual(message.origin, "ivo://a/b#c&d")
+
+    def test_origin_not_first(self):
+        self._check_not_sniffed(
+            DUMMY_IAMALIVE.replace(b"<Origin>", b"<Foo/><Origin>", 1)
+        )
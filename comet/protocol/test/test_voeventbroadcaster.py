@@ -3,6 +3,7 @@
 
 import lxml.etree as etree
 
+from twisted.internet import defer
 from twisted.internet import reactor
 from twisted.internet import task
 from twisted.trial import unittest
@@ -19,18 +20,25 @@ from comet.testutils import (
 )
 from comet.service.broker import BCAST_TEST_INTERVAL
 
-from comet.protocol.broadcaster import VOEventBroadcaster, VOEventBroadcasterFactory
+import comet.protocol.broadcaster
+from comet.protocol.broadcaster import (
+    FilterRegistry,
+    OutboundQueue,
+    VOEventBroadcaster,
+    VOEventBroadcasterFactory,
+)
 
 
 class DummyBroadcaster(object):
     def __init__(self):
         self.received_alive = False
         self.received_event = False
+        self.filters = []
 
     def sendIAmAlive(self):
         self.received_alive = True
 
-    def send_event(self, event):
+    def deliver(self, event, bitmap, frame):
         self.received_event = True
 
 
@@ -134,7 +142,7 @@ class VOEventBroadcasterTestCase(unittest.TestCase):
         # Note lack of filter!
         self.tr.clear()
         init_outstanding_ack = self.proto.outstanding_ack
-        self.proto.send_event(DummyEvent())
+        self.factory.send_event(DummyEvent())
         self.assertEqual(self.tr.value()[4:], DummyEvent().raw_bytes)
         self.assertEqual(self.proto.outstanding_ack - init_outstanding_ack, 1)
 
@@ -147,11 +155,13 @@ class VOEventBroadcasterTestCase(unittest.TestCase):
         def check_ack_increment(result):
             self.assertEqual(self.proto.outstanding_ack - init_outstanding_ack, 0)
 
-        self.tr.clear()
-        self.proto.filters.append(
-            etree.XPath('/*[local-name()="VOEvent" and @role!="test"]')
+        self.proto.stringReceived(
+            DUMMY_AUTHENTICATE_RESPONSE(
+                ['/*[local-name()="VOEvent" and @role!="test"]']
+            ).raw_bytes
         )  # Will reject dummy event with role "test"
-        d = self.proto.send_event(DummyEvent())
+        self.tr.clear()
+        d = self.factory.send_event(DummyEvent())
         d.addCallback(check_output)
         d.addCallback(check_ack_increment)
         return d
@@ -165,11 +175,13 @@ class VOEventBroadcasterTestCase(unittest.TestCase):
         def check_ack_increment(result):
             self.assertEqual(self.proto.outstanding_ack - init_outstanding_ack, 1)
 
-        self.tr.clear()
-        self.proto.filters.append(
-            etree.XPath('/*[local-name()="VOEvent" and @role="test"]')
+        self.proto.stringReceived(
+            DUMMY_AUTHENTICATE_RESPONSE(
+                ['/*[local-name()="VOEvent" and @role="test"]']
+            ).raw_bytes
         )  # Will accept dummy event with role "test"
-        d = self.proto.send_event(DummyEvent())
+        self.tr.clear()
+        d = self.factory.send_event(DummyEvent())
         d.addCallback(check_output)
         d.addCallback(check_ack_increment)
         return d
@@ -194,6 +206,16 @@ class VOEventBroadcasterTestCase(unittest.TestCase):
         self.assertEqual(self.tr.value(), b"")
         self.assertEqual(self.tr.connected, True)
 
+    def test_receive_empty_role(self):
+        # A message with an empty role is incomprehensible.
+        self.tr.clear()
+        for empty_role in (b"role=''", b'role=""'):
+            self.proto.stringReceived(
+                DUMMY_IAMALIVE.replace(b'role="iamalive"', empty_role)
+            )
+        self.assertEqual(self.tr.value(), b"")
+        self.assertEqual(self.tr.connected, True)
+
     def test_receive_iamalive(self):
         self.tr.clear()
         init_alive_count = self.proto.alive_count
@@ -245,6 +267,15 @@ class VOEventBroadcasterTestCase(unittest.TestCase):
         self.assertEqual(self.tr.connected, True)
         self.assertEqual(len(self.proto.filters), 1)
 
+    def test_receive_authenticateresponse_malformed(self):
+        # Authentication messages are checked when their filters are read.
+        received = DUMMY_AUTHENTICATE_RESPONSE(["//Param"]).raw_bytes[:-10]
+        self.tr.clear()
+        self.proto.stringReceived(received)
+        self.assertEqual(self.tr.value(), b"")
+        self.assertEqual(self.tr.connected, True)
+        self.assertEqual(len(self.proto.filters), 0)
+
     def test_receive_authenticateresponse_with_bad_filter(self):
         self.tr.clear()
         self.assertEqual(len(self.proto.filters), 0)
@@ -254,3 +285,430 @@ class VOEventBroadcasterTestCase(unittest.TestCase):
         self.assertEqual(self.tr.value(), b"")
         self.assertEqual(self.tr.connected, True)
         self.assertEqual(len(self.proto.filters), 0)
+
+    def test_filters_shared(self):
+        # Subscribers using the same expression share a compiled XPath.
+        expression = '/*[local-name()="VOEvent" and @role="test"]'
+        other = self.factory.buildProtocol(("127.0.0.1", 0))
+        other.makeConnection(proto_helpers.StringTransportWithDisconnection())
+        for proto in (self.proto, other):
+            proto.stringReceived(DUMMY_AUTHENTICATE_RESPONSE([expression]).raw_bytes)
+        self.assertIs(self.proto.filters[0], other.filters[0])
+        self.assertEqual(len(self.factory.filter_registry), 1)
+
+    def test_factory_send_event(self):
+        # The factory sends events only to those subscribers whose filters
+        # they pass.
+        accept = self.factory.buildProtocol(("127.0.0.1", 0))
+        accept.makeConnection(proto_helpers.StringTransportWithDisconnection())
+        unfiltered = self.factory.buildProtocol(("127.0.0.1", 0))
+        unfiltered.makeConnection(proto_helpers.StringTransportWithDisconnection())
+        accept.stringReceived(
+            DUMMY_AUTHENTICATE_RESPONSE(
+                ['/*[local-name()="VOEvent" and @role="test"]']
+            ).raw_bytes
+        )
+        self.proto.stringReceived(
+            DUMMY_AUTHENTICATE_RESPONSE(
+                ['/*[local-name()="VOEvent" and @role!="test"]']
+            ).raw_bytes
+        )
+        for proto in (self.proto, accept, unfiltered):
+            proto.transport.clear()
+
+        def check_output(result):
+            self.assertEqual(self.tr.value(), b"")
+            self.assertEqual(self.proto.outstanding_ack, 0)
+            for proto in (accept, unfiltered):
+                self.assertEqual(proto.transport.value()[4:], DummyEvent().raw_bytes)
+                self.assertEqual(proto.outstanding_ack, 1)
+
+        return self.factory.send_event(DummyEvent()).addCallback(check_output)
+
+    def test_factory_send_event_shared_frame(self):
+        # The same frame is written to every subscriber.
+        other = self.factory.buildProtocol(("127.0.0.1", 0))
+        other.makeConnection(proto_helpers.StringTransportWithDisconnection())
+        written = []
+        for proto in (self.proto, other):
+            proto.transport.write = written.append
+        self.successResultOf(self.factory.send_event(DummyEvent()))
+        self.assertEqual(len(written), 2)
+        self.assertIs(written[0], written[1])
+        self.assertEqual(written[0], VOEventBroadcaster.frame(DummyEvent()))
+
+    def _hold_pool(self):
+        # Replace the thread pool with jobs which run when we call them.
+        jobs = []
+
+        def deferToThread(f, *args):
+            d = defer.Deferred()
+            jobs.append(lambda: d.callback(f(*args)))
+            return d
+
+        self.patch(comet.protocol.broadcaster, "deferToThread", deferToThread)
+        return jobs
+
+    def _subscriber(self, expressions):
+        proto = self.factory.buildProtocol(("127.0.0.1", 0))
+        proto.makeConnection(proto_helpers.StringTransportWithDisconnection())
+        proto.stringReceived(DUMMY_AUTHENTICATE_RESPONSE(expressions).raw_bytes)
+        proto.transport.clear()
+        return proto
+
+    def test_factory_send_event_unfiltered_first(self):
+        # Subscribers without filters do not wait for others' filters to be
+        # evaluated in the thread pool.
+        jobs = self._hold_pool()
+        filtered = self._subscriber(['/*[local-name()="VOEvent"]'])
+        self.tr.clear()
+        d = self.factory.send_event(DummyEvent())
+        self.assertEqual(self.tr.value()[4:], DummyEvent().raw_bytes)
+        self.assertEqual(filtered.transport.value(), b"")
+        self.assertNoResult(d)
+        self.assertEqual(len(jobs), 1)
+        jobs.pop()()
+        self.successResultOf(d)
+        self.assertEqual(filtered.transport.value()[4:], DummyEvent().raw_bytes)
+
+    def test_factory_send_event_inline_first(self):
+        # Subscribers whose filters are evaluated inline do not wait for
+        # others' filters to be evaluated in the thread pool.
+        jobs = self._hold_pool()
+        self.factory.filter_registry.inline_threshold = 1.0
+        inline = self._subscriber(['/*[local-name()="VOEvent"]'])
+        d = self.factory.send_event(DummyEvent())
+        jobs.pop()()  # Measures the filter's cost.
+        self.successResultOf(d)
+        inline.transport.clear()
+        pooled = self._subscriber(["//Who"])
+        d = self.factory.send_event(DummyEvent())
+        self.assertEqual(inline.transport.value()[4:], DummyEvent().raw_bytes)
+        self.assertEqual(pooled.transport.value(), b"")
+        self.assertNoResult(d)
+        jobs.pop()()
+        self.successResultOf(d)
+        self.assertEqual(pooled.transport.value()[4:], DummyEvent().raw_bytes)
+        self.assertEqual(inline.outstanding_ack, 2)
+
+    def test_factory_send_event_disconnected(self):
+        # Subscribers which disconnect while filters are evaluated are not
+        # sent the event.
+        jobs = self._hold_pool()
+        filtered = self._subscriber(['/*[local-name()="VOEvent"]'])
+        d = self.factory.send_event(DummyEvent())
+        filtered.connectionLost()
+        jobs.pop()()
+        self.successResultOf(d)
+        self.assertEqual(filtered.transport.value(), b"")
+
+    def test_queue_registered(self):
+        # Each subscriber's queue is registered as a streaming producer.
+        self.assertIs(self.tr.producer, self.proto.queue)
+        self.assertTrue(self.tr.streaming)
+
+    def test_send_event_paused(self):
+        # Events are queued while the transport is paused.
+        self.tr.clear()
+        self.proto.queue.pauseProducing()
+        self.factory.send_event(DummyEvent())
+        self.assertEqual(self.tr.value(), b"")
+        self.assertEqual(len(self.proto.queue), 1)
+        self.proto.queue.resumeProducing()
+        self.assertEqual(self.tr.value()[4:], DummyEvent().raw_bytes)
+        self.assertEqual(len(self.proto.queue), 0)
+
+    def test_dropped_events_not_awaiting_ack(self):
+        # Events dropped from the queue are not expected to be acknowledged.
+        self.proto.queue.max_messages = 2
+        self.proto.queue.pauseProducing()
+        for _ in range(12):
+            self.factory.send_event(DummyEvent())
+        self.assertEqual(self.proto.outstanding_ack, 2)
+        self.proto.queue.resumeProducing()
+        self.proto.stringReceived(DUMMY_ACK)
+        self.proto.stringReceived(DUMMY_ACK)
+        self.assertEqual(self.proto.outstanding_ack, 0)
+        self.proto.sendIAmAlive()
+        self.assertEqual(self.tr.connected, True)
+
+    def test_filters_released(self):
+        # Filters are released on re-authentication and on disconnection.
+        registry = self.factory.filter_registry
+        self.proto.stringReceived(DUMMY_AUTHENTICATE_RESPONSE(["//Param"]).raw_bytes)
+        self.assertEqual(len(registry), 1)
+        self.proto.stringReceived(DUMMY_AUTHENTICATE_RESPONSE(["//What"]).raw_bytes)
+        self.assertEqual(len(registry), 1)
+        self.assertEqual(self.proto.filters[0].path, "//What")
+        self.proto.connectionLost()
+        self.assertEqual(len(registry), 0)
+
+
+class FilterRegistryTestCase(unittest.TestCase):
+    def setUp(self):
+        self.registry = FilterRegistry(inline_threshold=0)
+        self.calls = []
+        self.jobs = 0
+
+        # Evaluate filters in the test thread, recording each evaluation.
+        def deferToThread(f, xpaths, element):
+            self.jobs += 1
+            self.calls.extend(xpath.path for xpath in xpaths)
+            return defer.succeed(f(xpaths, element))
+
+        self.patch(comet.protocol.broadcaster, "deferToThread", deferToThread)
+
+    def test_install(self):
+        xpath = self.registry.install("//Param")
+        self.assertIs(self.registry.install("//Param"), xpath)
+        self.assertIsNot(self.registry.install("//What"), xpath)
+        self.assertEqual(len(self.registry), 2)
+
+    def test_install_invalid(self):
+        self.assertRaises(
+            etree.XPathSyntaxError, self.registry.install, "Not a valid XPath"
+        )
+        self.assertEqual(len(self.registry), 0)
+
+    def test_uninstall(self):
+        # Each expression is retained until all its users have released it.
+        first = self.registry.install("//Param")
+        second = self.registry.install("//Param")
+        self.registry.uninstall(first)
+        self.assertEqual(len(self.registry), 1)
+        self.registry.uninstall(second)
+        self.assertEqual(len(self.registry), 0)
+
+    def test_uninstall_unknown(self):
+        # An XPath not obtained from the registry is ignored.
+        self.registry.install("//Param")
+        self.registry.uninstall(etree.XPath("//Param"))
+        self.assertEqual(len(self.registry), 1)
+
+    def test_evaluate_once(self):
+        # Each distinct expression is evaluated once per event, however many
+        # subscribers use it.
+        accept = self.registry.install('/*[@role="test"]')
+        reject = self.registry.install('/*[@role="observation"]')
+        event = DummyEvent()
+        results = [
+            self.registry.evaluate(event, xpaths)
+            for xpaths in ([accept], [accept, reject], [reject], [accept])
+        ]
+        self.assertEqual(
+            [self.successResultOf(d) for d in results],
+            [[True], [True, False], [False], [True]],
+        )
+        self.assertEqual(sorted(self.calls), sorted([accept.path, reject.path]))
+
+        # A new event is evaluated afresh.
+        self.successResultOf(self.registry.evaluate(DummyEvent(), [accept]))
+        self.assertEqual(self.calls.count(accept.path), 2)
+
+    def test_evaluate_batched(self):
+        # All the filters required for an event are evaluated by one job.
+        xpaths = [self.registry.install("//Param"), self.registry.install("//What")]
+        d = self.registry.evaluate(DummyEvent(), xpaths + xpaths)
+        self.assertEqual(self.successResultOf(d), [False, False, False, False])
+        self.assertEqual(self.jobs, 1)
+        self.assertEqual(sorted(self.calls), ["//Param", "//What"])
+
+    def test_mask(self):
+        first = self.registry.install("//Param")
+        second = self.registry.install("//What")
+        self.assertNotEqual(self.registry.mask([first]), self.registry.mask([second]))
+        self.assertEqual(
+            self.registry.mask([first, second]),
+            self.registry.mask([first]) | self.registry.mask([second]),
+        )
+        self.assertEqual(self.registry.mask([etree.XPath("//Param")]), 0)
+
+    def test_mask_reused(self):
+        # The bits of uninstalled filters are reused.
+        first = self.registry.install("//Param")
+        mask = self.registry.mask([first])
+        self.registry.uninstall(first)
+        self.assertEqual(self.registry.mask([self.registry.install("//What")]), mask)
+
+    def test_evaluate_all(self):
+        accept = self.registry.install('/*[@role="test"]')
+        reject = self.registry.install('/*[@role="observation"]')
+        bitmap = self.successResultOf(self.registry.evaluate_all(DummyEvent()))
+        self.assertEqual(self.jobs, 1)
+        self.assertTrue(bitmap & self.registry.mask([accept]))
+        self.assertFalse(bitmap & self.registry.mask([reject]))
+
+    def test_evaluate_all_empty(self):
+        self.assertEqual(
+            self.successResultOf(self.registry.evaluate_all(DummyEvent())), 0
+        )
+        self.assertEqual(self.jobs, 0)
+
+    def test_evaluated(self):
+        accept = self.registry.install('/*[@role="test"]')
+        reject = self.registry.install('/*[@role="observation"]')
+        event = DummyEvent()
+        self.assertEqual(self.registry.evaluated(event), (0, 0))
+        self.registry.evaluate(event, [accept, reject])
+        bitmap, mask = self.registry.evaluated(event)
+        self.assertEqual(bitmap, self.registry.mask([accept]))
+        self.assertEqual(mask, self.registry.mask([accept, reject]))
+        self.assertEqual(self.registry.evaluated(DummyEvent()), (0, 0))
+
+    def test_evaluate_error(self):
+        # An expression which fails to evaluate does not match.
+        xpath = self.registry.install("$undefined")
+        d = self.registry.evaluate(DummyEvent(), [xpath])
+        self.assertEqual(self.successResultOf(d), [False])
+
+
+class FilterRegistryInlineTestCase(unittest.TestCase):
+    def setUp(self):
+        self.registry = FilterRegistry(inline_threshold=1.0)
+        self.threaded = []
+        self.cost = 0.0
+
+        def deferToThread(f, xpaths, element):
+            self.threaded.extend(xpath.path for xpath in xpaths)
+            return defer.succeed(f(xpaths, element))
+
+        def evaluate(xpath, element):
+            return bool(xpath(element)), self.cost
+
+        self.patch(comet.protocol.broadcaster, "deferToThread", deferToThread)
+        self.patch(comet.protocol.broadcaster, "_evaluate", evaluate)
+        self.xpath = self.registry.install('/*[@role="test"]')
+
+    def _evaluate(self):
+        d = self.registry.evaluate(DummyEvent(), [self.xpath])
+        self.assertEqual(self.successResultOf(d), [True])
+
+    def test_unmeasured(self):
+        # Filters are first evaluated in the thread pool.
+        self.assertFalse(self.registry.is_inline(self.xpath.path))
+        self._evaluate()
+        self.assertEqual(len(self.threaded), 1)
+
+    def test_cheap_inline(self):
+        # Once measured as cheap, filters are evaluated inline.
+        self._evaluate()
+        self.assertTrue(self.registry.is_inline(self.xpath.path))
+        self._evaluate()
+        self._evaluate()
+        self.assertEqual(len(self.threaded), 1)
+
+    def test_expensive_threaded(self):
+        self.cost = 2.0
+        self._evaluate()
+        self._evaluate()
+        self.assertFalse(self.registry.is_inline(self.xpath.path))
+        self.assertEqual(len(self.threaded), 2)
+
+    def test_becomes_expensive(self):
+        # A filter which becomes expensive inline returns to the thread pool.
+        self._evaluate()
+        self._evaluate()
+        self.cost = 10.0
+        self._evaluate()
+        self.assertFalse(self.registry.is_inline(self.xpath.path))
+        self._evaluate()
+        self.assertEqual(len(self.threaded), 2)
+
+    def test_disabled(self):
+        self.registry.inline_threshold = 0
+        self._evaluate()
+        self._evaluate()
+        self.assertEqual(len(self.threaded), 2)
+
+    def test_uninstall(self):
+        # Measurements are discarded with the filter.
+        self._evaluate()
+        self.registry.uninstall(self.xpath)
+        self.xpath = self.registry.install(self.xpath.path)
+        self.assertFalse(self.registry.is_inline(self.xpath.path))
+
+
+class OutboundQueueTestCase(unittest.TestCase):
+    def setUp(self):
+        self.tr = proto_helpers.StringTransport()
+
+    def _queue(self, policy, max_messages=3, max_bytes=1000):
+        queue = OutboundQueue(self.tr, max_messages, max_bytes, policy)
+        queue.pauseProducing()
+        return queue
+
+    def test_bad_policy(self):
+        self.assertRaises(ValueError, OutboundQueue, self.tr, policy="bad")
+
+    def test_write_through(self):
+        queue = OutboundQueue(self.tr)
+        queue.put(b"a")
+        self.assertEqual(self.tr.value(), b"a")
+        self.assertEqual(len(queue), 0)
+
+    def test_pause_resume(self):
+        queue = self._queue("drop-oldest")
+        queue.put(b"a")
+        queue.put(b"bc")
+        self.assertEqual((len(queue), queue.bytes), (2, 3))
+        self.assertEqual(self.tr.value(), b"")
+        queue.resumeProducing()
+        self.assertEqual(self.tr.value(), b"abc")
+        self.assertEqual((len(queue), queue.bytes), (0, 0))
+
+    def test_pause_while_resuming(self):
+        # If the transport pauses us again, we stop writing.
+        queue = self._queue("drop-oldest")
+        self.tr.write = lambda data: queue.pauseProducing()
+        queue.put(b"a")
+        queue.put(b"b")
+        queue.resumeProducing()
+        self.assertEqual(len(queue), 1)
+
+    def test_drop_oldest(self):
+        queue = self._queue("drop-oldest")
+        for data in (b"a", b"b", b"c", b"d"):
+            queue.put(data)
+        self.assertEqual((len(queue), queue.dropped), (3, 1))
+        queue.resumeProducing()
+        self.assertEqual(self.tr.value(), b"bcd")
+
+    def test_drop_oldest_bytes(self):
+        queue = self._queue("drop-oldest", max_bytes=5)
+        for data in (b"aa", b"bb", b"cc"):
+            queue.put(data)
+        self.assertEqual((len(queue), queue.bytes, queue.dropped), (2, 4, 1))
+
+    def test_drop_test(self):
+        # Test events are dropped first, then the oldest messages.
+        queue = self._queue("drop-test")
+        queue.put(b"a")
+        queue.put(b"t", is_test=True)
+        queue.put(b"b")
+        queue.put(b"c")
+        self.assertEqual(queue.dropped, 1)
+        queue.put(b"d")
+        self.assertEqual(queue.dropped, 2)
+        queue.resumeProducing()
+        self.assertEqual(self.tr.value(), b"bcd")
+
+    def test_ack_dropped(self):
+        # Dropping a message which requires an acknowledgement is reported.
+        dropped = []
+        queue = OutboundQueue(
+            self.tr, 1, 1000, "drop-oldest", lambda: dropped.append(1)
+        )
+        queue.pauseProducing()
+        queue.put(b"a", ack=True)
+        queue.put(b"b")
+        queue.put(b"c", ack=True)
+        self.assertEqual((queue.dropped, len(dropped)), (2, 1))
+
+    def test_disconnect(self):
+        queue = self._queue("disconnect")
+        for data in (b"a", b"b", b"c"):
+            queue.put(data)
+        self.assertFalse(self.tr.disconnecting)
+        queue.put(b"d")
+        self.assertTrue(self.tr.disconnecting)
+        self.assertEqual((len(queue), queue.bytes), (0, 0))
@@ -24,6 +24,13 @@ class VOEventReceiverFactoryTestCase(unittest.TestCase):
         self.assertFalse(self.factory.validators)  # Should be empty
         self.assertFalse(self.factory.handlers)  # Should be empty
 
+    def test_max_stream_length(self):
+        proto = self.factory.buildProtocol(("127.0.0.1", 0))
+        self.assertEqual(proto.MAX_STREAM_LENGTH, 0)
+        factory = VOEventReceiverFactory(DUMMY_SERVICE_IVOID, max_stream_length=1024)
+        proto = factory.buildProtocol(("127.0.0.1", 0))
+        self.assertEqual(proto.MAX_STREAM_LENGTH, 1024)
+
 
 class VOEventReceiverTestCase(unittest.TestCase):
     def setUp(self):
@@ -55,6 +62,13 @@ class VOEventReceiverTestCase(unittest.TestCase):
         self.assertEqual(self.tr.value(), b"")
         self.assertEqual(self.tr.connected, False)
 
+    def test_receive_empty_role(self):
+        # A message with an empty role is incomprehensible.
+        self.tr.clear()
+        self.proto.stringReceived(DUMMY_VOEVENT.replace(b'role="test"', b'role=""'))
+        self.assertEqual(self.tr.value(), b"")
+        self.assertEqual(self.tr.connected, False)
+
     def test_receive_voevent(self):
         self.tr.clear()
         self.proto.stringReceived(DUMMY_VOEVENT)
@@ -30,6 +30,13 @@ class VOEventSubscriberFactoryTestCase(unittest.TestCase):
     def test_protocol(self):
         self.assertIsInstance(self.proto, VOEventSubscriber)
 
+    def test_max_stream_length(self):
+        self.assertEqual(self.proto.MAX_STREAM_LENGTH, 0)
+        factory = VOEventSubscriberFactory(DUMMY_EVENT_IVOID, max_stream_length=1024)
+        proto = factory.buildProtocol(("127.0.0.1", 0))
+        self.assertEqual(proto.MAX_STREAM_LENGTH, 1024)
+        proto.connectionLost()
+
 
 class VOEventSubscriberTimeoutTestCase(unittest.TestCase):
     def setUp(self):
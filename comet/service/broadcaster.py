@@ -5,11 +5,20 @@ from twisted.application.internet import StreamServerEndpointService
 import comet.log as log
 from comet.utility import WhitelistingFactory
 from comet.protocol import VOEventBroadcasterFactory
+from comet.protocol.broadcaster import DROP_TEST, QUEUE_BYTES, QUEUE_MESSAGES
 
 __all__ = ["makeBroadcasterService"]
 
 
-def makeBroadcasterService(endpoint, local_ivo, test_interval, whitelist):
+def makeBroadcasterService(
+    endpoint,
+    local_ivo,
+    test_interval,
+    whitelist,
+    queue_messages=QUEUE_MESSAGES,
+    queue_bytes=QUEUE_BYTES,
+    overflow_policy=DROP_TEST,
+):
     """Create a VOEvent receiver service.
 
     The receiver service accepts VOEvent messages submitted to the broker by
@@ -27,8 +36,18 @@ def makeBroadcasterService(endpoint, local_ivo, test_interval, whitelist):
     whitelist : `list` of `ipaddress.IPv4Network` or `ipaddress.IPv6Network`
         Only addresses which fall in a network included in the whitelist are
         permitted to subscribe.
+    queue_messages : `int`
+        The maximum number of messages queued for a subscriber which is not
+        keeping up.
+    queue_bytes : `int`
+        The maximum total size in bytes of messages queued for a subscriber.
+    overflow_policy : `str`
+        One of ``drop-oldest``, ``drop-test`` or ``disconnect``: what to do
+        when a subscriber's queue is full.
     """
-    factory = VOEventBroadcasterFactory(local_ivo, test_interval)
+    factory = VOEventBroadcasterFactory(
+        local_ivo, test_interval, queue_messages, queue_bytes, overflow_policy
+    )
     if log.LEVEL >= log.Levels.INFO:
         factory.noisy = False
 
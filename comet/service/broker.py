@@ -18,11 +18,18 @@ from twisted.plugin import getPlugins
 import comet
 import comet.log as log
 from comet.constants import DEFAULT_SUBMIT_PORT, DEFAULT_SUBSCRIBE_PORT
+from comet.protocol.broadcaster import DROP_TEST, OVERFLOW_POLICIES
+from comet.protocol.broadcaster import QUEUE_BYTES, QUEUE_MESSAGES
 from comet.service.broadcaster import makeBroadcasterService
 from comet.service.subscriber import makeSubscriberService
 from comet.service.receiver import makeReceiverService
-from comet.utility import Event_DB, BaseOptions, valid_ivoid, valid_xpath
+from comet.utility import Event_DB, MmapEvent_DB, SQLiteEvent_DB
+from comet.utility import BaseOptions, valid_ivoid, valid_xpath
 from comet.utility import coerce_to_client_endpoint, coerce_to_server_endpoint
+from comet.utility import RecentEvents
+from comet.utility.event_db import SYNC_COUNT, SYNC_INTERVAL
+from comet.utility.event_db import RECENT_AGE, RECENT_SIZE
+from comet.utility.event_db import BLOOM_ERROR_RATE, IDENTITIES
 from comet.validator import CheckIVOID, CheckPreviouslySeen, CheckSchema
 
 # Handlers and plugins
@@ -40,6 +47,9 @@ PRUNE_INTERVAL = 6 * 60 * 60  # Prune the event db every 6 hours
 # By default, we brodcast a test event every BCAST_TEST_INTERVAL seconds.
 BCAST_TEST_INTERVAL = 3600
 
+# Available event database implementations.
+EVENTDB_BACKENDS = {"dbm": Event_DB, "mmap": MmapEvent_DB, "sqlite": SQLiteEvent_DB}
+
 
 class Options(BaseOptions):
     PROG = "twistd [options] comet"
@@ -62,6 +72,92 @@ class Options(BaseOptions):
             default=gettempdir(),
             help="Event database root [default=%(default)s].",
         )
+        std_group.add_argument(
+            "--eventdb-backend",
+            default="dbm",
+            choices=sorted(EVENTDB_BACKENDS),
+            help="Event database storage format [default=%(default)s].",
+        )
+        std_group.add_argument(
+            "--eventdb-shared",
+            action="store_true",
+            help="Share the event database with other Comet processes on this "
+            "host, so that each event is accepted only once by any of them. "
+            "Requires the sqlite backend.",
+        )
+        std_group.add_argument(
+            "--eventdb-identity",
+            default="payload",
+            choices=sorted(IDENTITIES),
+            help="How events are identified when checking for duplicates: by "
+            "their entire contents, by IVORN and contents, or by IVORN alone "
+            "[default=%(default)s].",
+        )
+        std_group.add_argument(
+            "--eventdb-threads",
+            default=1,
+            type=int,
+            help="Number of dedicated event database threads; 0 to share the "
+            "reactor's thread pool [default=%(default)s].",
+        )
+        std_group.add_argument(
+            "--eventdb-handles",
+            default=0,
+            type=int,
+            help="Maximum number of event database handles to hold open "
+            "between events; 0 to open the database for every event "
+            "[default=%(default)s].",
+        )
+        std_group.add_argument(
+            "--eventdb-sync-count",
+            default=SYNC_COUNT,
+            type=int,
+            help="Flush event database writes to disk after this many "
+            "events [default=%(default)s].",
+        )
+        std_group.add_argument(
+            "--eventdb-sync-interval",
+            default=SYNC_INTERVAL,
+            type=float,
+            help="Flush event database writes to disk at least this often "
+            "(seconds) [default=%(default)s].",
+        )
+        std_group.add_argument(
+            "--eventdb-recent-size",
+            default=RECENT_SIZE,
+            type=int,
+            help="Number of recently seen events to remember in memory; 0 to "
+            "always consult the event database [default=%(default)s].",
+        )
+        std_group.add_argument(
+            "--eventdb-recent-age",
+            default=RECENT_AGE,
+            type=float,
+            help="Time for which recently seen events are remembered in memory "
+            "(seconds) [default=%(default)s].",
+        )
+        std_group.add_argument(
+            "--eventdb-bloom-capacity",
+            default=0,
+            type=int,
+            help="Initial capacity of the per-stream Bloom filters used to "
+            "identify unseen events; 0 to disable [default=%(default)s].",
+        )
+        std_group.add_argument(
+            "--eventdb-bloom-error-rate",
+            default=BLOOM_ERROR_RATE,
+            type=float,
+            help="False positive rate of the per-stream Bloom filters "
+            "[default=%(default)s].",
+        )
+        std_group.add_argument(
+            "--stream-max-length",
+            default=0,
+            type=int,
+            help="Maximum length in bytes of messages from authors and "
+            "upstream brokers which are too long to buffer, and are instead "
+            "parsed as they arrive; 0 to refuse them [default=%(default)s].",
+        )
 
         rcv_group = self.parser.add_argument_group(
             "Event Receiver", "Receive events submitted " "by remote authors."
@@ -113,6 +209,28 @@ class Options(BaseOptions):
             "subscription requests [default=accept "
             "from everywhere].",
         )
+        bcast_group.add_argument(
+            "--broadcast-queue-messages",
+            default=QUEUE_MESSAGES,
+            type=int,
+            help="Maximum number of messages queued for a subscriber which is "
+            "not keeping up [default=%(default)s].",
+        )
+        bcast_group.add_argument(
+            "--broadcast-queue-bytes",
+            default=QUEUE_BYTES,
+            type=int,
+            help="Maximum total size in bytes of messages queued for a "
+            "subscriber which is not keeping up [default=%(default)s].",
+        )
+        bcast_group.add_argument(
+            "--broadcast-overflow",
+            default=DROP_TEST,
+            choices=OVERFLOW_POLICIES,
+            help="What to do when a subscriber's queue is full: discard the "
+            "oldest messages, discard test events first, or disconnect "
+            "[default=%(default)s].",
+        )
 
         sub_group = self.parser.add_argument_group(
             "Event Subscriber", "Subscribe to event streams" " from remote brokers."
@@ -168,6 +286,8 @@ class Options(BaseOptions):
 
     def _checkOptions(self):
         self._check_for_ivoid()
+        self._check_eventdb_shared()
+        self._check_ranges()
         self._configure_plugins()
 
     def _configure_plugins(self):
@@ -193,10 +313,77 @@ class Options(BaseOptions):
         if not self["local_ivo"] and (self["receive"] or self["broadcast"]):
             self.parser.error("IVOA identifier required (--local-ivo).")
 
+    def _check_eventdb_shared(self):
+        """Ensure that a shared event database uses a backend which supports it."""
+        if self["eventdb_shared"] and self["eventdb_backend"] != "sqlite":
+            self.parser.error("--eventdb-shared requires --eventdb-backend=sqlite.")
+
+    def _check_ranges(self):
+        """Ensure that numeric options fall within their permitted ranges."""
+
+        def non_negative(value):
+            return value >= 0
+
+        def positive(value):
+            return value > 0
+
+        def fraction(value):
+            return 0 < value < 1
+
+        for name, valid, requirement in [
+            ("eventdb_threads", non_negative, "must not be negative"),
+            ("eventdb_handles", non_negative, "must not be negative"),
+            ("eventdb_sync_count", positive, "must be positive"),
+            ("eventdb_sync_interval", positive, "must be positive"),
+            ("eventdb_recent_size", non_negative, "must not be negative"),
+            ("eventdb_recent_age", positive, "must be positive"),
+            ("eventdb_bloom_capacity", non_negative, "must not be negative"),
+            ("eventdb_bloom_error_rate", fraction, "must be between 0 and 1"),
+            ("broadcast_queue_messages", positive, "must be positive"),
+            ("broadcast_queue_bytes", positive, "must be positive"),
+            ("stream_max_length", non_negative, "must not be negative"),
+        ]:
+            if not valid(self[name]):
+                option = name.replace("_", "-")
+                self.parser.error(f"--{option} {requirement}.")
+
+
+def makeEventDB(config):
+    """Construct an event database as specified by ``config``."""
+    kwargs = {
+        "threads": config["eventdb_threads"],
+        "identity": config["eventdb_identity"],
+    }
+    if config["eventdb_backend"] in ("dbm", "sqlite"):
+        kwargs.update(
+            sync_count=config["eventdb_sync_count"],
+            sync_interval=config["eventdb_sync_interval"],
+        )
+    if config["eventdb_backend"] == "sqlite":
+        kwargs.update(shared=config["eventdb_shared"])
+    if config["eventdb_backend"] == "dbm":
+        kwargs.update(
+            max_handles=config["eventdb_handles"],
+            bloom_capacity=config["eventdb_bloom_capacity"],
+            bloom_error_rate=config["eventdb_bloom_error_rate"],
+        )
+    return EVENTDB_BACKENDS[config["eventdb_backend"]](config["eventdb"], **kwargs)
+
 
 def makeService(config):
-    event_db = Event_DB(config["eventdb"])
+    event_db = makeEventDB(config)
+    reactor.addSystemEventTrigger("after", "startup", event_db.warm_start, MAX_AGE)
     LoopingCall(event_db.prune, MAX_AGE).start(PRUNE_INTERVAL)
+    LoopingCall(event_db.flush).start(config["eventdb_sync_interval"], now=False)
+    reactor.addSystemEventTrigger("after", "shutdown", event_db.close)
+
+    # A single set of recently seen events is shared by all validators.
+    if config["eventdb_recent_size"]:
+        recent_events = RecentEvents(
+            config["eventdb_recent_size"], config["eventdb_recent_age"]
+        )
+    else:
+        recent_events = None
 
     broker_service = MultiService()
     for ep in config["broadcast"] if config["broadcast"] else []:
@@ -205,6 +392,9 @@ def makeService(config):
             config["local_ivo"],
             config["broadcast_test_interval"],
             config["broadcast_whitelist"],
+            config["broadcast_queue_messages"],
+            config["broadcast_queue_bytes"],
+            config["broadcast_overflow"],
         )
         bcast.setServiceParent(broker_service)
 
@@ -214,7 +404,7 @@ def makeService(config):
 
     if config["receive"]:
         validators = [
-            CheckPreviouslySeen(event_db),
+            CheckPreviouslySeen(event_db, recent_events),
             CheckSchema(os.path.join(comet.__path__[0], "schema/VOEvent-v2.0.xsd")),
             CheckIVOID(),
         ]
@@ -225,6 +415,7 @@ def makeService(config):
                 validators,
                 config["handlers"],
                 config["receive_whitelist"],
+                config["stream_max_length"],
             )
             recv.setServiceParent(broker_service)
 
@@ -232,9 +423,10 @@ def makeService(config):
         sub = makeSubscriberService(
             ep,
             config["local_ivo"],
-            [CheckPreviouslySeen(event_db)],
+            [CheckPreviouslySeen(event_db, recent_events)],
             config["handlers"],
             config["filters"],
+            config["stream_max_length"],
         )
         sub.setServiceParent(broker_service)
 
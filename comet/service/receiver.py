@@ -9,7 +9,9 @@ from comet.protocol import VOEventReceiverFactory
 __all__ = ["makeReceiverService"]
 
 
-def makeReceiverService(endpoint, local_ivo, validators, handlers, whitelist):
+def makeReceiverService(
+    endpoint, local_ivo, validators, handlers, whitelist, max_stream_length=0
+):
     """Create a VOEvent receiver service.
 
     The receiver service accepts VOEvent messages submitted to the broker by
@@ -29,6 +31,9 @@ def makeReceiverService(endpoint, local_ivo, validators, handlers, whitelist):
     whitelist : `list` of `ipaddress.IPv4Network` or `ipaddress.IPv6Network`
         Submissions are only accepted from addresses which fall in a network
         included in the whitelist.
+    max_stream_length : `int`
+        Submissions longer than the protocol's ``MAX_LENGTH``, but no longer
+        than this, are parsed as they arrive. If ``0``, they are refused.
 
     Warnings
     --------
@@ -37,7 +42,10 @@ def makeReceiverService(endpoint, local_ivo, validators, handlers, whitelist):
     probably break horribly).
     """
     factory = VOEventReceiverFactory(
-        local_ivo=local_ivo, validators=validators, handlers=handlers
+        local_ivo=local_ivo,
+        validators=validators,
+        handlers=handlers,
+        max_stream_length=max_stream_length,
     )
     if log.LEVEL >= log.Levels.INFO:
         factory.noisy = False
@@ -7,7 +7,9 @@ from comet.protocol.subscriber import VOEventSubscriberFactory
 __all__ = ["makeSubscriberService"]
 
 
-def makeSubscriberService(endpoint, local_ivo, validators, handlers, filters):
+def makeSubscriberService(
+    endpoint, local_ivo, validators, handlers, filters, max_stream_length=0
+):
     """Create a reconnecting VOEvent subscriber service.
 
     Parameters
@@ -24,6 +26,9 @@ def makeSubscriberService(endpoint, local_ivo, validators, handlers, filters):
     filters : `list` of `str`
         XPath filters. Will be passed to upstream as a request to filter the
         alerts being sent.
+    max_stream_length : `int`
+        Messages longer than the protocol's ``MAX_LENGTH``, but no longer than
+        this, are parsed as they arrive. If ``0``, they are refused.
 
     Notes
     -----
@@ -33,7 +38,9 @@ def makeSubscriberService(endpoint, local_ivo, validators, handlers, filters):
     Reconnection is handled according to the default policies of
     `twisted.application.internet.ClientService`.
     """
-    factory = VOEventSubscriberFactory(local_ivo, validators, handlers, filters)
+    factory = VOEventSubscriberFactory(
+        local_ivo, validators, handlers, filters, max_stream_length
+    )
     service = ClientService(endpoint, factory)
 
     return service
@@ -10,10 +10,15 @@ from twisted.internet import reactor
 from twisted.internet.error import CannotListenError
 
 from comet.constants import DEFAULT_SUBMIT_PORT, DEFAULT_SUBSCRIBE_PORT
+from comet.protocol.broadcaster import QUEUE_BYTES, QUEUE_MESSAGES
 from comet.service.broker import BCAST_TEST_INTERVAL
 from comet.service.broker import Options
-from comet.service.broker import makeService
+from comet.service.broker import makeEventDB, makeService
 from comet.testutils import DUMMY_SERVICE_IVOID, OptionTestUtils
+from comet.utility import Event_DB, MmapEvent_DB, SQLiteEvent_DB
+from comet.utility.event_db import SYNC_COUNT, SYNC_INTERVAL
+from comet.utility.event_db import RECENT_AGE, RECENT_SIZE
+from comet.utility.event_db import BLOOM_ERROR_RATE
 
 
 class BrokerOptionsTestCase(unittest.TestCase, OptionTestUtils):
@@ -129,6 +134,124 @@ class BrokerOptionsTestCase(unittest.TestCase, OptionTestUtils):
             self.config.parseOptions(["--eventdb", dirname])["eventdb"], dirname
         )
 
+    def test_eventdb_backend(self):
+        # The dbm backend is the default.
+        self.config.parseOptions(self.cmd_line)
+        self.assertEqual(self.config["eventdb_backend"], "dbm")
+
+        self.config.parseOptions(self.cmd_line + ["--eventdb-backend", "sqlite"])
+        self.assertEqual(self.config["eventdb_backend"], "sqlite")
+
+        # Unknown backends are rejected.
+        self._check_bad_parse(self.cmd_line + ["--eventdb-backend", "bad"])
+
+    def test_eventdb_shared(self):
+        # By default, the event database is not shared.
+        self.config.parseOptions(self.cmd_line)
+        self.assertFalse(self.config["eventdb_shared"])
+
+        self.config.parseOptions(
+            self.cmd_line + ["--eventdb-shared", "--eventdb-backend", "sqlite"]
+        )
+        self.assertTrue(self.config["eventdb_shared"])
+
+        # The dbm backend cannot be shared.
+        self._check_bad_parse(self.cmd_line + ["--eventdb-shared"])
+
+    def test_eventdb_identity(self):
+        # By default, events are identified by their entire contents.
+        self.config.parseOptions(self.cmd_line)
+        self.assertEqual(self.config["eventdb_identity"], "payload")
+
+        self.config.parseOptions(self.cmd_line + ["--eventdb-identity", "ivorn"])
+        self.assertEqual(self.config["eventdb_identity"], "ivorn")
+
+        self._check_bad_parse(self.cmd_line + ["--eventdb-identity", "bad"])
+
+    def test_eventdb_threads(self):
+        # By default, the event database has a dedicated thread.
+        self.config.parseOptions(self.cmd_line)
+        self.assertEqual(self.config["eventdb_threads"], 1)
+
+        self.config.parseOptions(self.cmd_line + ["--eventdb-threads", "0"])
+        self.assertEqual(self.config["eventdb_threads"], 0)
+
+    def test_eventdb_handles(self):
+        # By default, we don't cache database handles.
+        self.config.parseOptions(self.cmd_line)
+        self.assertEqual(self.config["eventdb_handles"], 0)
+        self.assertEqual(self.config["eventdb_sync_count"], SYNC_COUNT)
+        self.assertEqual(self.config["eventdb_sync_interval"], SYNC_INTERVAL)
+
+        # But can be told to, with a custom flushing policy.
+        self.config.parseOptions(
+            self.cmd_line
+            + [
+                "--eventdb-handles",
+                "10",
+                "--eventdb-sync-count",
+                "5",
+                "--eventdb-sync-interval",
+                "1.5",
+            ]
+        )
+        self.assertEqual(self.config["eventdb_handles"], 10)
+        self.assertEqual(self.config["eventdb_sync_count"], 5)
+        self.assertEqual(self.config["eventdb_sync_interval"], 1.5)
+
+        # Non-numeric values are rejected.
+        self._check_bad_parse(self.cmd_line + ["--eventdb-handles", "many"])
+
+    def test_eventdb_recent(self):
+        # Check defaults.
+        self.config.parseOptions(self.cmd_line)
+        self.assertEqual(self.config["eventdb_recent_size"], RECENT_SIZE)
+        self.assertEqual(self.config["eventdb_recent_age"], RECENT_AGE)
+
+        # And that they can be over-ridden.
+        self.config.parseOptions(
+            self.cmd_line
+            + ["--eventdb-recent-size", "0", "--eventdb-recent-age", "2.5"]
+        )
+        self.assertEqual(self.config["eventdb_recent_size"], 0)
+        self.assertEqual(self.config["eventdb_recent_age"], 2.5)
+
+    def test_eventdb_bloom(self):
+        # Bloom filters are disabled by default.
+        self.config.parseOptions(self.cmd_line)
+        self.assertEqual(self.config["eventdb_bloom_capacity"], 0)
+        self.assertEqual(self.config["eventdb_bloom_error_rate"], BLOOM_ERROR_RATE)
+
+        self.config.parseOptions(
+            self.cmd_line
+            + [
+                "--eventdb-bloom-capacity",
+                "1000",
+                "--eventdb-bloom-error-rate",
+                "0.01",
+            ]
+        )
+        self.assertEqual(self.config["eventdb_bloom_capacity"], 1000)
+        self.assertEqual(self.config["eventdb_bloom_error_rate"], 0.01)
+
+    def test_numeric_ranges(self):
+        for option, value in [
+            ("--eventdb-threads", "-1"),
+            ("--eventdb-handles", "-1"),
+            ("--eventdb-sync-count", "0"),
+            ("--eventdb-sync-interval", "0"),
+            ("--eventdb-sync-interval", "-1.5"),
+            ("--eventdb-recent-size", "-1"),
+            ("--eventdb-recent-age", "0"),
+            ("--eventdb-bloom-capacity", "-1"),
+            ("--eventdb-bloom-error-rate", "0"),
+            ("--eventdb-bloom-error-rate", "1"),
+            ("--broadcast-queue-messages", "0"),
+            ("--broadcast-queue-bytes", "0"),
+            ("--stream-max-length", "-1"),
+        ]:
+            self._check_bad_parse(self.cmd_line + [option, value])
+
     def test_receive(self):
         # Check that ``--receive`` properly sets up server endpoints.
         self._check_server_endpoints("receive", DEFAULT_SUBMIT_PORT)
@@ -154,6 +277,30 @@ class BrokerOptionsTestCase(unittest.TestCase, OptionTestUtils):
         # Check that we create a whitelist for broadcasters.
         self._check_whitelist("broadcast-whitelist")
 
+    def test_stream_max_length(self):
+        self.config.parseOptions(self.cmd_line)
+        self.assertEqual(self.config["stream_max_length"], 0)
+        self.config.parseOptions(self.cmd_line + ["--stream-max-length", "16777216"])
+        self.assertEqual(self.config["stream_max_length"], 2**24)
+
+    def test_broadcast_queue(self):
+        self.config.parseOptions(self.cmd_line)
+        self.assertEqual(self.config["broadcast_queue_messages"], QUEUE_MESSAGES)
+        self.assertEqual(self.config["broadcast_queue_bytes"], QUEUE_BYTES)
+        self.config.parseOptions(
+            self.cmd_line
+            + ["--broadcast-queue-messages", "10", "--broadcast-queue-bytes", "1024"]
+        )
+        self.assertEqual(self.config["broadcast_queue_messages"], 10)
+        self.assertEqual(self.config["broadcast_queue_bytes"], 1024)
+
+    def test_broadcast_overflow(self):
+        self.config.parseOptions(self.cmd_line)
+        self.assertEqual(self.config["broadcast_overflow"], "drop-test")
+        self.config.parseOptions(self.cmd_line + ["--broadcast-overflow", "disconnect"])
+        self.assertEqual(self.config["broadcast_overflow"], "disconnect")
+        self._check_bad_parse(self.cmd_line + ["--broadcast-overflow", "bad"])
+
     def test_subscribe(self):
         # By default, we subscribe to nothing.
         self.config.parseOptions(self.cmd_line)
@@ -336,6 +483,20 @@ class BrokerServiceTestCase(unittest.TestCase):
         )
         self.assertEqual(len(service.services), 6)
 
+    def test_make_event_db(self):
+        # The requested event database backend is constructed.
+        for backend, cls in [
+            ("dbm", Event_DB),
+            ("mmap", MmapEvent_DB),
+            ("sqlite", SQLiteEvent_DB),
+        ]:
+            self.config.parseOptions(
+                ["--eventdb", self.mktemp(), "--eventdb-backend", backend]
+            )
+            event_db = makeEventDB(self.config)
+            self.assertIsInstance(event_db, cls)
+            event_db.close()
+
     def _check_bind_failure(self, service):
         # Check that starting the service raises a CannotListenError.
         try:
@@ -0,0 +1,99 @@
+# Comet VOEvent Broker.
+# Scalable Bloom filter.
+
+from hashlib import blake2b
+from math import ceil, log
+
+__all__ = ["ScalableBloomFilter"]
+
+
+class BloomFilter(object):
+    """
+    A fixed-size Bloom filter.
+
+    Membership is tested against a pair of 64-bit hashes, from which the
+    ``n_hashes`` bit indexes are derived by double hashing.
+    """
+
+    __slots__ = ["capacity", "count", "n_bits", "n_hashes", "bits"]
+
+    def __init__(self, capacity, error_rate):
+        self.capacity = capacity
+        self.count = 0
+        self.n_bits = max(8, int(ceil(-capacity * log(error_rate) / log(2) ** 2)))
+        self.n_hashes = max(1, int(round(self.n_bits / capacity * log(2))))
+        self.bits = bytearray((self.n_bits + 7) // 8)
+
+    def _indexes(self, h1, h2):
+        return ((h1 + i * h2) % self.n_bits for i in range(self.n_hashes))
+
+    def add(self, h1, h2):
+        for index in self._indexes(h1, h2):
+            self.bits[index >> 3] |= 1 << (index & 7)
+        self.count += 1
+
+    def contains(self, h1, h2):
+        return all(
+            self.bits[index >> 3] & (1 << (index & 7))
+            for index in self._indexes(h1, h2)
+        )
+
+
+class ScalableBloomFilter(object):
+    """
+    A Bloom filter which grows as elements are added.
+
+    Elements are added to a fixed-size `BloomFilter` until it reaches
+    capacity, at which point a new filter, ``GROWTH`` times larger and with an
+    error rate ``TIGHTENING`` times smaller, is started. The overall false
+    positive rate is thereby bounded by ``error_rate`` no matter how many
+    elements are added (Almeida et al., 2007).
+
+    Elements may be `str` or `bytes`; a `str` is treated as its UTF-8
+    encoding. There is no way to remove an element: build a new filter
+    instead.
+    """
+
+    GROWTH = 2
+    TIGHTENING = 0.5
+
+    def __init__(self, capacity=1000, error_rate=0.001, elements=()):
+        if capacity < 1:
+            raise ValueError("Capacity must be positive.")
+        if not 0 < error_rate < 1:
+            raise ValueError("Error rate must be between 0 and 1.")
+        self.capacity = capacity
+        self.error_rate = error_rate
+        self.filters = [BloomFilter(capacity, error_rate * (1 - self.TIGHTENING))]
+        for element in elements:
+            self.add(element)
+
+    @staticmethod
+    def _hash(element):
+        if isinstance(element, str):
+            element = element.encode("UTF-8")
+        digest = blake2b(element, digest_size=16).digest()
+        # An odd step ensures that the derived indexes don't cycle early.
+        return (
+            int.from_bytes(digest[:8], "little"),
+            int.from_bytes(digest[8:], "little") | 1,
+        )
+
+    def add(self, element):
+        current = self.filters[-1]
+        if current.count >= current.capacity:
+            current = BloomFilter(
+                current.capacity * self.GROWTH,
+                self.error_rate
+                * (1 - self.TIGHTENING)
+                * self.TIGHTENING ** len(self.filters),
+            )
+            self.filters.append(current)
+        current.add(*self._hash(element))
+
+    def __contains__(self, element):
+        h1, h2 = self._hash(element)
+        return any(f.contains(h1, h2) for f in self.filters)
+
+    def __len__(self):
+        return sum(f.count for f in self.filters)
@@ -7,37 +7,196 @@ try:
     import anydbm
 except ImportError:
     import dbm as anydbm
+import sqlite3
+import stat
 import time
-from hashlib import sha1
-from threading import Lock
-from collections import defaultdict
-from contextlib import closing
+from hashlib import blake2b, sha1
+from queue import Empty, Queue
+from threading import Lock, Thread
+from collections import Counter, defaultdict, OrderedDict
+from contextlib import contextmanager
+from zlib import crc32
 
+from twisted.internet import reactor
 from twisted.internet.threads import deferToThread
-from twisted.internet.defer import DeferredList
+from twisted.internet.defer import Deferred, DeferredList, fail, succeed
+from twisted.internet.task import deferLater
+from twisted.python.failure import Failure
 
 import comet.log as log
-from comet.utility.voevent import parse_ivoid
+from comet.utility.bloom import ScalableBloomFilter
+from comet.utility.hashtable import HashTable
+from comet.utility.voevent import VOEventHeader
 
-__all__ = ["Event_DB"]
+__all__ = [
+    "Event_DB",
+    "SQLiteEvent_DB",
+    "MmapEvent_DB",
+    "EventDBWorker",
+    "RecentEvents",
+]
 
+# When database handles are cached, changes are flushed to disk after
+# SYNC_COUNT writes or SYNC_INTERVAL seconds, whichever comes first.
+SYNC_COUNT = 100
+SYNC_INTERVAL = 10.0
 
-class Event_DB(object):
-    def __init__(self, root):
+# By default, RecentEvents remembers up to RECENT_SIZE events for up to
+# RECENT_AGE seconds.
+RECENT_SIZE = 10000
+RECENT_AGE = 60.0
+
+# Default false positive rate for per-stream Bloom filters.
+BLOOM_ERROR_RATE = 0.001
+
+# Entries in the time index are grouped into buckets spanning BUCKET_SECONDS.
+BUCKET_SECONDS = 3600
+
+# Pruning releases the lock on a database after examining at most PRUNE_SLICE
+# entries, so that it never blocks event processing for long.
+PRUNE_SLICE = 1000
+
+# An EventDBWorker thread checks up to BATCH_SIZE queued events at a time.
+BATCH_SIZE = 100
+
+# Time (in seconds) to wait for another process to release a lock on a
+# shared SQLite database.
+BUSY_TIMEOUT = 10.0
+
+# When warm starting, databases left by a previous run are pruned one every
+# WARM_START_INTERVAL seconds.
+WARM_START_INTERVAL = 1.0
+
+# Suffixes which dbm implementations may add to the names of database files.
+DBM_SUFFIXES = (".bak", ".dat", ".db", ".dir", ".pag")
+
+# Initial number of slots in a new MmapEvent_DB hash table.
+TABLE_CAPACITY = 2**16
+
+# MmapEvent_DB compacts its table after pruning if more than this fraction of
+# its slots hold tombstones.
+COMPACT_FRACTION = 0.25
+
+
+def _payload_key(ivorn, raw_bytes):
+    return sha1(raw_bytes).hexdigest()
+
+
+def _ivorn_key(ivorn, raw_bytes):
+    return blake2b(ivorn.encode("UTF-8"), digest_size=20).hexdigest()
+
+
+def _ivorn_hash_key(ivorn, raw_bytes):
+    # A checksum suffices to distinguish events which share an IVORN.
+    return "%s-%08x" % (_ivorn_key(ivorn, raw_bytes), crc32(raw_bytes))
+
+
+def _is_regular(path):
+    """Return True if path is a regular file, or a link to one."""
+    try:
+        return stat.S_ISREG(os.stat(path).st_mode)
+    except OSError:
+        return False
+
+
+# Ways in which an event may be identified, mapping to functions which
+# calculate its key from its IVORN and its serialised form:
+#
+# payload:    the SHA-1 digest of the entire event, as received.
+# ivorn-hash: the IVORN, together with a CRC-32 checksum of the entire event;
+#             much cheaper than payload for large events.
+# ivorn:      the IVORN only, so that events which differ only in their
+#             serialisation, or which are re-issued with the same IVORN, are
+#             regarded as duplicates.
+IDENTITIES = {
+    "payload": _payload_key,
+    "ivorn-hash": _ivorn_hash_key,
+    "ivorn": _ivorn_key,
+}
+
+
+class _Handle(object):
+    """
+    An open database and the currently open bucket of its time index,
+    together with the information needed to decide when it should next be
+    flushed to disk.
+    """
+
+    __slots__ = ["db", "index", "bucket", "writes", "last_sync"]
+
+    def __init__(self, db):
+        self.db = db
+        self.index = None
+        self.bucket = None
+        self.writes = 0
+        self.last_sync = time.time()
+
+    def close_index(self):
+        if self.index is not None:
+            self.index.close()
+        self.index = None
+        self.bucket = None
+
+    def close(self):
+        self.close_index()
+        self.db.close()
+
+    def sync(self):
+        """
+        Flush outstanding writes to disk.
+
+        Not every dbm flavour provides a ``sync()`` method. Return False if
+        the handle could not be flushed, in which case the caller should close
+        it instead.
+        """
+        if self.writes:
+            if not hasattr(self.db, "sync"):
+                return False
+            self.db.sync()
+        self.writes = 0
+        self.last_sync = time.time()
+        return True
+
+
+class BaseEvent_DB(object):
+    """
+    Functionality common to all databases of previously seen events.
+
+    Events are identified by a key derived from their contents, and grouped
+    into streams by the authority and resource key of their IVOIDs.
+
+    If ``threads`` is non-zero, the database is served by an `EventDBWorker`
+    with that many threads, which processes checks in batches of up to
+    ``batch_size`` events. Otherwise, the reactor's thread pool is used.
+
+    ``identity`` selects how keys are derived from events; it must be one of
+    `IDENTITIES`.
+    """
+
+    def __init__(self, root, threads=0, batch_size=BATCH_SIZE, identity="payload"):
+        if identity not in IDENTITIES:
+            raise ValueError("Unknown event identity: %s" % (identity,))
         self.root = self._ensure_dir(root)
-        self.databases = defaultdict(Lock)
+        self.identity = identity
+        self.worker = EventDBWorker(self, threads, batch_size) if threads else None
 
     @staticmethod
-    def _get_event_details(event):
-        auth, rsrc, local = parse_ivoid(event.element.attrib["ivorn"])
+    def _get_event_details(event, identity="payload"):
+        header = VOEventHeader.of(event)
+        ivorn = header.ivorn
+        auth, rsrc, local = header.ivorn_parts
 
         # Although "/" isn't the path separator on Windows, it os.path.join()
         # still gets confused if it appears in a filename.
         db_path = os.path.join(auth, rsrc).replace(os.path.sep, "_").replace("/", "_")
 
-        key = sha1(event.raw_bytes).hexdigest()
+        key = IDENTITIES[identity](ivorn, event.raw_bytes)
         return db_path, key
 
+    def event_details(self, event):
+        """Return the stream and key identifying ``event`` in this database."""
+        return self._get_event_details(event, self.identity)
+
     @staticmethod
     def _ensure_dir(path):
         """
@@ -60,40 +219,975 @@ class Event_DB(object):
         """Return True if event is unseen (and hence good to forward), False
         otherwise.
         """
-        db_path, key = self._get_event_details(event)
+        return self.check_key(*self.event_details(event))
+
+    def check_key(self, db_path, key):
+        """Return True if key is unseen in the stream db_path, recording it if
+        so; return False otherwise.
+
+        Override in subclasses.
+        """
+        raise NotImplementedError
+
+    def check_keys(self, keys):
+        """
+        Check a sequence of ``(db_path, key)`` tuples, in order.
+
+        Returns a list containing a ``(success, result)`` tuple for each,
+        where ``result`` is either the return value of `check_key` or the
+        exception it raised. Subclasses may override this to handle batches
+        more efficiently.
+        """
+        results = []
+        for db_path, key in keys:
+            try:
+                results.append((True, self.check_key(db_path, key)))
+            except Exception as e:
+                results.append((False, e))
+        return results
+
+    def defer_check_event(self, event):
+        """As `check_event`, but run in another thread; returns a Deferred."""
+        if self.worker is None:
+            return deferToThread(self.check_event, event)
+        try:
+            db_path, key = self.event_details(event)
+        except Exception:
+            return fail()
+        return self.worker.check_key(db_path, key)
+
+    def defer_check_key(self, db_path, key):
+        """As `check_key`, but run in another thread; returns a Deferred."""
+        if self.worker is None:
+            return deferToThread(self.check_key, db_path, key)
+        return self.worker.check_key(db_path, key)
+
+    def _defer(self, func, *args):
+        """
+        Run a maintenance task in another thread; returns a Deferred.
+
+        Tasks run on the worker's maintenance thread, if there is one, so
+        they do not delay checks.
+        """
+        if self.worker is None:
+            return deferToThread(func, *args)
+        return self.worker.call(func, *args)
+
+    def prune(self, expiry_time):
+        """
+        Remove entries with age at least expiry_time seconds from the
+        database. Returns a `~twisted.internet.defer.Deferred` which fires when
+        pruning is complete.
+
+        Override in subclasses.
+        """
+        raise NotImplementedError
+
+    def warm_start(self, expiry_time, interval=WARM_START_INTERVAL):
+        """
+        Prune any streams recorded by a previous run which would not otherwise
+        be pruned. Returns a `~twisted.internet.defer.Deferred` which fires
+        when complete.
+        """
+        return succeed(None)
+
+    def flush(self):
+        """
+        Flush any outstanding writes to disk. Returns a
+        `~twisted.internet.defer.Deferred` which fires when complete.
+        """
+        return succeed(None)
+
+    def close(self):
+        """
+        Flush outstanding writes and release any resources held.
+        """
+        if self.worker:
+            self.worker.stop()
+
+
+class Event_DB(BaseEvent_DB):
+    """
+    Database of previously seen events, stored using dbm.
+
+    Events are recorded in a separate dbm database per stream (that is, per
+    combination of IVOID authority and resource key) under ``root``. Each
+    database is accompanied by a time index: a directory of files, one per
+    ``BUCKET_SECONDS`` interval, listing the events recorded during that
+    interval. This enables `prune` to find expired events without examining
+    the rest of the database.
+
+    By default, the relevant database is opened and closed every time an event
+    is checked. If ``max_handles`` is non-zero, up to that many databases are
+    instead held open between events, with the least recently used being
+    closed when the limit is exceeded. Writes to open databases are flushed to
+    disk every ``sync_count`` writes or ``sync_interval`` seconds, whichever
+    comes first, and whenever `flush` or `close` is called.
+
+    If ``bloom_capacity`` is non-zero, a `ScalableBloomFilter` with that
+    initial capacity and a false positive rate of ``bloom_error_rate`` is
+    maintained for each stream. It is built from the contents of the database
+    when the stream is first used, and rebuilt after pruning. Events which the
+    filter reports as definitely unseen are recorded without reading the
+    database; see `bloom_counts`.
+    """
+
+    def __init__(
+        self,
+        root,
+        max_handles=0,
+        sync_count=SYNC_COUNT,
+        sync_interval=SYNC_INTERVAL,
+        bloom_capacity=0,
+        bloom_error_rate=BLOOM_ERROR_RATE,
+        threads=0,
+        batch_size=BATCH_SIZE,
+        identity="payload",
+    ):
+        BaseEvent_DB.__init__(self, root, threads, batch_size, identity)
+        self.databases = defaultdict(Lock)
+        self.max_handles = max_handles
+        self.sync_count = sync_count
+        self.sync_interval = sync_interval
+        self.bloom_capacity = bloom_capacity
+        self.bloom_error_rate = bloom_error_rate
+
+        # Per-stream Bloom filters and their statistics. Only accessed while
+        # holding the lock on the corresponding database.
+        self._filters = {}
+        self._bloom_counts = defaultdict(Counter)
+
+        # Databases known to have a time index.
+        self._indexed = set()
+
+        # Open handles, in order of use (least recent first). A handle may
+        # only be taken from or returned to the cache while holding both
+        # _handles_lock and the lock on the corresponding database.
+        self._handles = OrderedDict()
+        self._handles_lock = Lock()
+
+    def _index_path(self, db_path, bucket=None):
+        path = os.path.join(self.root, db_path + ".index")
+        return path if bucket is None else os.path.join(path, str(bucket))
+
+    def _buckets(self, db_path):
+        """Return the buckets in the time index for ``db_path``, oldest first."""
+        try:
+            names = os.listdir(self._index_path(db_path))
+        except FileNotFoundError:
+            return []
+        return sorted(int(name) for name in names if name.isdigit())
+
+    def _read_bucket(self, db_path, bucket):
+        """Return a list of ``(timestamp, key)`` tuples from a time index bucket."""
+        entries = []
+        try:
+            with open(self._index_path(db_path, bucket)) as f:
+                for line in f:
+                    # Skip any line which is still being written.
+                    if line.endswith("\n"):
+                        timestamp, key = line[:-1].split(" ", 1)
+                        entries.append((float(timestamp), key))
+        except FileNotFoundError:
+            pass
+        return entries
+
+    def _index(self, handle, db_path, key, timestamp):
+        """
+        Record ``key`` in the time index for ``db_path``. The caller must hold
+        the lock on ``db_path``.
+        """
+        bucket = int(float(timestamp) // BUCKET_SECONDS)
+        if handle.bucket != bucket:
+            handle.close_index()
+            # Line buffered, so that the index is always readable.
+            handle.index = open(self._index_path(db_path, bucket), "a", buffering=1)
+            handle.bucket = bucket
+        handle.index.write("%s %s\n" % (timestamp, key))
+
+    def _ensure_index(self, db_path, db):
+        """
+        Ensure that the database at ``db_path`` has a time index. The caller
+        must hold the lock on ``db_path``.
+
+        Databases written by older versions of Comet have no index; one is
+        built from their contents the first time they are opened.
+        """
+        if db_path in self._indexed:
+            return
+        index_path = self._index_path(db_path)
+        if not os.path.isdir(index_path):
+            entries = defaultdict(list)
+            for key in db.keys():
+                timestamp = db[key].decode()
+                entries[int(float(timestamp) // BUCKET_SECONDS)].append(
+                    "%s %s\n" % (timestamp, key.decode())
+                )
+            if entries:
+                log.info(
+                    "Indexing %d events in %s"
+                    % (sum(len(lines) for lines in entries.values()), db_path)
+                )
+            os.makedirs(index_path, exist_ok=True)
+            for bucket, lines in entries.items():
+                with open(self._index_path(db_path, bucket), "a") as f:
+                    f.writelines(lines)
+        self._indexed.add(db_path)
+
+    def _open_db(self, db_path):
+        db = anydbm.open(os.path.join(self.root, db_path), "c")
+        try:
+            self._ensure_index(db_path, db)
+        except Exception:
+            db.close()
+            raise
+        return _Handle(db)
+
+    @contextmanager
+    def _open(self, db_path):
+        """
+        Provide a `_Handle` on the database at ``db_path``.
+
+        The caller must hold the lock on ``db_path``, and should increment the
+        handle's ``writes`` count when it modifies the database.
+        """
+        if not self.max_handles:
+            handle = self._open_db(db_path)
+            try:
+                yield handle
+            finally:
+                handle.close()
+            return
+
+        with self._handles_lock:
+            handle = self._handles.pop(db_path, None)
+        if handle is None:
+            handle = self._open_db(db_path)
+
+        try:
+            yield handle
+        except Exception:
+            # Don't risk caching a handle in an unknown state.
+            handle.close()
+            raise
+
+        if (
+            handle.writes >= self.sync_count
+            or time.time() - handle.last_sync >= self.sync_interval
+        ) and not handle.sync():
+            handle.close()
+            return
+
+        with self._handles_lock:
+            self._handles[db_path] = handle
+            evicted = self._evict()
+        for lock, handle in evicted:
+            try:
+                handle.close()
+            finally:
+                lock.release()
+
+    def _evict(self):
+        """
+        Remove least recently used handles from the cache until it is within
+        ``max_handles``.
+
+        Must be called with ``_handles_lock`` held. Databases which are
+        currently locked are in use, and are skipped. Returns a list of
+        ``(lock, handle)`` tuples: the caller is responsible for closing each
+        handle and then releasing the corresponding lock.
+        """
+        evicted = []
+        excess = len(self._handles) - self.max_handles
+        for db_path in list(self._handles):
+            if excess <= 0:
+                break
+            lock = self.databases[db_path]
+            if lock.acquire(False):
+                evicted.append((lock, self._handles.pop(db_path)))
+                excess -= 1
+        return evicted
+
+    def check_key(self, db_path, key):
         with self.databases[db_path]:  # Acquire lock
-            with closing(anydbm.open(os.path.join(self.root, db_path), "c")) as db:
-                if key in db:
-                    return False
-                else:
-                    db[key] = str(time.time())
-                    return True
+            with self._open(db_path) as handle:
+                return self._check(handle, db_path, key)
+
+    def check_keys(self, keys):
+        # Each database is locked and opened once for all of its keys.
+        results = [None] * len(keys)
+        streams = defaultdict(list)
+        for i, (db_path, key) in enumerate(keys):
+            streams[db_path].append(i)
+        for db_path, indexes in streams.items():
+            try:
+                with self.databases[db_path]:
+                    with self._open(db_path) as handle:
+                        for i in indexes:
+                            results[i] = (
+                                True,
+                                self._check(handle, db_path, keys[i][1]),
+                            )
+            except Exception as e:
+                for i in indexes:
+                    if results[i] is None:
+                        results[i] = (False, e)
+        return results
+
+    def _check(self, handle, db_path, key):
+        """
+        Check for, and record, ``key`` in the open database ``handle``. The
+        caller must hold the lock on ``db_path``.
+        """
+        bloom = self._get_filter(db_path, handle.db)
+        if bloom is not None:
+            if key not in bloom:
+                self._bloom_counts[db_path]["hits"] += 1
+            elif key in handle.db:
+                self._bloom_counts[db_path]["misses"] += 1
+                return False
+            else:
+                self._bloom_counts[db_path]["misses"] += 1
+                self._bloom_counts[db_path]["false_positives"] += 1
+            bloom.add(key)
+        elif key in handle.db:
+            return False
+        timestamp = str(time.time())
+        handle.db[key] = timestamp
+        self._index(handle, db_path, key, timestamp)
+        handle.writes += 1
+        return True
+
+    def _get_filter(self, db_path, db):
+        """
+        Return the Bloom filter for ``db_path`` (None if disabled), building it
+        from ``db`` if necessary. The caller must hold the lock on ``db_path``.
+        """
+        if not self.bloom_capacity:
+            return None
+        if db_path not in self._filters:
+            self._filters[db_path] = ScalableBloomFilter(
+                self.bloom_capacity, self.bloom_error_rate, db.keys()
+            )
+        return self._filters[db_path]
+
+    def bloom_counts(self):
+        """
+        Summarize the effectiveness of the Bloom filters across all streams.
+
+        Returns a `~collections.Counter` of ``hits`` (events the filter
+        reported as unseen, so the database was not read), ``misses`` (events
+        which had to be looked up in the database), and ``false_positives``
+        (misses which turned out not to be in the database after all).
+        """
+        total = Counter()
+        for counts in list(self._bloom_counts.values()):
+            total.update(counts)
+        return total
 
     def prune(self, expiry_time):
         """
         Remove entries with age at least expiry_time seconds from the database.
+
+        Expired entries are located using the time index. The lock on each
+        database is held while examining at most ``PRUNE_SLICE`` entries at a
+        time, so that event processing can continue while pruning. If Bloom
+        filters are in use, their `bloom_counts` are logged when complete.
         """
+        d = DeferredList(
+            [
+                self._defer(self._expire_db, db_path, lock, expiry_time)
+                for db_path, lock in list(self.databases.items())
+            ]
+        )
+        if self.bloom_capacity:
+            d.addCallback(self._log_bloom_counts)
+        return d
+
+    def _log_bloom_counts(self, result):
+        counts = self.bloom_counts()
+        log.info(
+            "Bloom filters: %d hits, %d misses, %d false positives"
+            % (counts["hits"], counts["misses"], counts["false_positives"])
+        )
+        return result
+
+    def _expire_db(self, db_path, lock, expiry_time):
+        now = time.time()
+
+        def expired(timestamp):
+            # Rounding to nearest int avoids an issue when we call prune(0)
+            # *immediately* after an insertion and might get hit by floating
+            # point weirdness.
+            return int(now - timestamp) >= expiry_time
+
+        # Ensure the time index exists before we rely upon it.
+        with lock:
+            with self._open(db_path):
+                pass
 
-        def expire_db(db_path, lock):
-            remove = []
+        removed = 0
+        for bucket in self._buckets(db_path):
+            if not expired(bucket * BUCKET_SECONDS):
+                break  # This bucket, and all later ones, are live.
+            removed += self._expire_bucket(db_path, lock, bucket, expired)
+
+        log.info("Expired %d events from %s" % (removed, db_path))
+        if removed and db_path in self._filters:
+            self._rebuild_filter(db_path, lock)
+
+    def _expire_bucket(self, db_path, lock, bucket, expired):
+        """
+        Remove the entries in a time index bucket for which ``expired(timestamp)``
+        is true from the database at ``db_path``, and then from the bucket
+        itself. Return the number of entries removed from the database.
+        """
+        keys = [
+            key
+            for timestamp, key in self._read_bucket(db_path, bucket)
+            if expired(timestamp)
+        ]
+        removed = 0
+        for start in range(0, len(keys), PRUNE_SLICE):
+            end = start + PRUNE_SLICE
             with lock:
-                db = anydbm.open(os.path.join(self.root, db_path), "c")
-                # The database returned by anydbm is guaranteed to have a
-                # .keys() method, but not necessarily .(iter)items().
+                with self._open(db_path) as handle:
+                    for key in keys[start:end]:
+                        # The key may since have been removed and re-recorded,
+                        # so check the database's own timestamp.
+                        try:
+                            if not expired(float(handle.db[key])):
+                                continue
+                        except KeyError:
+                            continue
+                        del handle.db[key]
+                        handle.writes += 1
+                        removed += 1
+
+        with lock:
+            with self._open(db_path) as handle:
+                if handle.bucket == bucket:
+                    handle.close_index()
+                if expired((bucket + 1) * BUCKET_SECONDS):
+                    os.remove(self._index_path(db_path, bucket))
+                else:
+                    # Only the oldest live bucket needs to be rewritten.
+                    live = [
+                        "%r %s\n" % (timestamp, key)
+                        for timestamp, key in self._read_bucket(db_path, bucket)
+                        if not expired(timestamp)
+                    ]
+                    with open(self._index_path(db_path, bucket), "w") as f:
+                        f.writelines(live)
+        return removed
+
+    def _rebuild_filter(self, db_path, lock):
+        """
+        Bloom filters don't support removal, so rebuild the filter for
+        ``db_path`` from its time index.
+
+        The bulk of the index is read without holding the lock; only the
+        newest bucket, which may have been written to in the meantime, is
+        re-read with the lock held.
+        """
+        settled = set(self._buckets(db_path)[:-1])
+        bloom = ScalableBloomFilter(self.bloom_capacity, self.bloom_error_rate)
+        for bucket in settled:
+            for timestamp, key in self._read_bucket(db_path, bucket):
+                bloom.add(key)
+        with lock:
+            for bucket in self._buckets(db_path):
+                if bucket not in settled:
+                    for timestamp, key in self._read_bucket(db_path, bucket):
+                        bloom.add(key)
+            self._filters[db_path] = bloom
+
+    def _discover(self):
+        """
+        Return the names of the stream databases under ``root``.
+        """
+        # A database may consist of several files, named by adding suffixes to
+        # the name of the database. Other files are ignored.
+        names = set()
+        for filename in os.listdir(self.root):
+            if not _is_regular(os.path.join(self.root, filename)):
+                continue
+            names.add(filename)
+            name, suffix = os.path.splitext(filename)
+            if suffix in DBM_SUFFIXES:
+                names.add(name)
+        return sorted(name for name in names if self._is_event_db(name))
+
+    def _is_event_db(self, name):
+        """
+        Return True if ``name`` under ``root`` is a database of events: that
+        is, one whose values are all timestamps.
+        """
+        path = os.path.join(self.root, name)
+        # whichdb opens any of these which exist, and opening (for example) a
+        # FIFO would block indefinitely.
+        for suffix in ("",) + DBM_SUFFIXES:
+            if os.path.lexists(path + suffix) and not _is_regular(path + suffix):
+                return False
+        if not anydbm.whichdb(path):
+            return False
+        if os.path.isdir(self._index_path(name)):
+            return True
+        try:
+            db = anydbm.open(path, "r")
+            try:
                 for key in db.keys():
-                    if int(time.time() - float(db[key])) >= expiry_time:
-                        # Rounding to nearest int avoids an issue when we call
-                        # call prune(0) *immediately* after an insertion and might
-                        # get hit by floating point weirdness.
-                        remove.append(key)
-                log.info("Expiring %d events from %s" % (len(remove), db_path))
-                for key in remove:
-                    del db[key]
+                    float(db[key])
+            finally:
                 db.close()
+        except Exception:
+            log.info("Ignoring %s: not an event database" % (path,))
+            return False
+        return True
 
+    def warm_start(self, expiry_time, interval=WARM_START_INTERVAL):
+        """
+        Register, and prune, stream databases left under ``root`` by a
+        previous run.
+
+        Otherwise, databases for streams which send no further events are
+        never pruned. So as not to compete with event processing, databases
+        are pruned one at a time, every ``interval`` seconds; thereafter, they
+        are pruned by `prune` as usual.
+        """
+
+        def prune_next(db_paths):
+            # Streams seen since startup are pruned by prune() anyway.
+            while db_paths and db_paths[0] in self.databases:
+                db_paths.pop(0)
+            if not db_paths:
+                return
+            db_path = db_paths.pop(0)
+            d = self._defer(
+                self._expire_db, db_path, self.databases[db_path], expiry_time
+            )
+            d.addErrback(
+                lambda failure: log.warn(
+                    "Failed to prune %s: %s" % (db_path, failure.getErrorMessage())
+                )
+            )
+            d.addCallback(lambda _: deferLater(reactor, interval, prune_next, db_paths))
+            return d
+
+        def found(db_paths):
+            log.info("Found %d existing event databases" % (len(db_paths),))
+            return prune_next(db_paths)
+
+        return self._defer(self._discover).addCallback(found)
+
+    def flush(self):
+        """
+        Flush outstanding writes to all cached database handles to disk.
+        """
+        with self._handles_lock:
+            db_paths = list(self._handles)
         return DeferredList(
             [
-                deferToThread(expire_db, db_path, lock)
-                for db_path, lock in self.databases.items()
+                self._defer(self._flush_db, db_path, self.databases[db_path])
+                for db_path in db_paths
             ]
         )
+
+    def _flush_db(self, db_path, lock):
+        with lock:
+            with self._handles_lock:
+                handle = self._handles.get(db_path)
+            if handle and not handle.sync():
+                with self._handles_lock:
+                    del self._handles[db_path]
+                handle.close()
+
+    def close(self):
+        """
+        Close all cached database handles.
+        """
+        BaseEvent_DB.close(self)
+        with self._handles_lock:
+            db_paths = list(self._handles)
+        for db_path in db_paths:
+            with self.databases[db_path]:
+                with self._handles_lock:
+                    handle = self._handles.pop(db_path, None)
+                if handle:
+                    handle.close()
+
+
+class SQLiteEvent_DB(BaseEvent_DB):
+    """
+    Database of previously seen events, stored in a single SQLite database.
+
+    The database, ``FILENAME`` under ``root``, operates in write-ahead logging
+    mode, and contains a single table with a row per event. Insertions are
+    grouped into transactions, which are committed every ``sync_count``
+    insertions or ``sync_interval`` seconds, whichever comes first, and
+    whenever `flush` or `close` is called.
+
+    If ``shared`` is True, the database may be used by several processes at
+    once, and an event recorded by any one of them is regarded as seen by
+    all. In this case, each check (or batch of checks) is committed
+    immediately in its own short transaction.
+    """
+
+    FILENAME = "events.sqlite"
+
+    def __init__(
+        self,
+        root,
+        sync_count=SYNC_COUNT,
+        sync_interval=SYNC_INTERVAL,
+        threads=0,
+        batch_size=BATCH_SIZE,
+        identity="payload",
+        shared=False,
+    ):
+        BaseEvent_DB.__init__(self, root, threads, batch_size, identity)
+        self.sync_count = sync_count
+        self.sync_interval = sync_interval
+        self.shared = shared
+
+        # The connection is shared by all threads; _lock serializes access.
+        self._lock = Lock()
+        self._conn = sqlite3.connect(
+            os.path.join(self.root, self.FILENAME),
+            timeout=BUSY_TIMEOUT,
+            check_same_thread=False,
+            isolation_level=None,  # We manage transactions explicitly.
+        )
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        # In WAL mode, this is safe against corruption, but the most recent
+        # transactions may be lost on power failure.
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS events ("
+            "stream TEXT NOT NULL, key TEXT NOT NULL, seen_at REAL NOT NULL, "
+            "PRIMARY KEY (stream, key)) WITHOUT ROWID"
+        )
+        self._conn.execute(
+            "CREATE INDEX IF NOT EXISTS events_seen_at ON events (seen_at)"
+        )
+        self._pending = 0
+        self._last_commit = time.time()
+
+    def _commit(self):
+        """Commit any open transaction. The caller must hold ``_lock``."""
+        if self._conn.in_transaction:
+            self._conn.execute("COMMIT")
+        self._pending = 0
+        self._last_commit = time.time()
+
+    def _insert(self, db_path, key):
+        """
+        Record ``key``, returning True if it was not already present. The
+        caller must hold ``_lock``, and should call `_maybe_commit` when done.
+        """
+        if not self._conn.in_transaction:
+            # When shared, take the write lock at the start of the transaction:
+            # other processes may have written since it began, and SQLite
+            # cannot then wait for the lock when upgrading a read transaction.
+            self._conn.execute("BEGIN IMMEDIATE" if self.shared else "BEGIN")
+        inserted = self._conn.execute(
+            "INSERT OR IGNORE INTO events (stream, key, seen_at) VALUES (?, ?, ?)",
+            (db_path, key, time.time()),
+        ).rowcount
+        self._pending += inserted
+        return inserted == 1
+
+    def _maybe_commit(self):
+        if (
+            self.shared
+            or self._pending >= self.sync_count
+            or time.time() - self._last_commit >= self.sync_interval
+        ):
+            self._commit()
+
+    def check_key(self, db_path, key):
+        with self._lock:
+            result = self._insert(db_path, key)
+            self._maybe_commit()
+            return result
+
+    def check_keys(self, keys):
+        # The whole batch is handled in a single transaction.
+        results = []
+        with self._lock:
+            for db_path, key in keys:
+                try:
+                    results.append((True, self._insert(db_path, key)))
+                except sqlite3.Error as e:
+                    results.append((False, e))
+            self._maybe_commit()
+        return results
+
+    def prune(self, expiry_time):
+        return self._defer(self._expire, expiry_time)
+
+    def _expire(self, expiry_time):
+        with self._lock:
+            self._commit()
+            removed = self._conn.execute(
+                "DELETE FROM events WHERE seen_at <= ?", (time.time() - expiry_time,)
+            ).rowcount
+        log.info("Expired %d events" % (removed,))
+
+    def flush(self):
+        return self._defer(self._flush)
+
+    def _flush(self):
+        with self._lock:
+            self._commit()
+
+    def close(self):
+        BaseEvent_DB.close(self)
+        with self._lock:
+            self._commit()
+            self._conn.close()
+
+
+class MmapEvent_DB(BaseEvent_DB):
+    """
+    Database of previously seen events, stored in a memory-mapped hash table.
+
+    All events are recorded in a single `~comet.utility.hashtable.HashTable`,
+    ``FILENAME`` under ``root``, with a fixed-size record per event holding a
+    digest of its key, the time it was seen and the stream to which it
+    belongs. Streams are numbered in order of first appearance; the stream
+    names are listed, one per line, in ``STREAMS_FILENAME``.
+
+    Checks are made in memory, and the operating system writes changes to
+    disk in its own time, or when `flush` or `close` is called. The table
+    grows as required, starting from ``capacity`` slots.
+
+    The database may only be used by one process at a time.
+    """
+
+    FILENAME = "events.table"
+    STREAMS_FILENAME = "events.streams"
+
+    def __init__(
+        self,
+        root,
+        capacity=TABLE_CAPACITY,
+        threads=0,
+        batch_size=BATCH_SIZE,
+        identity="payload",
+    ):
+        BaseEvent_DB.__init__(self, root, threads, batch_size, identity)
+        self._lock = Lock()
+        self._table = HashTable(os.path.join(self.root, self.FILENAME), capacity)
+        self._streams = {}
+        streams_path = os.path.join(self.root, self.STREAMS_FILENAME)
+        if os.path.exists(streams_path):
+            with open(streams_path) as f:
+                for line in f:
+                    self._streams[line.rstrip("\n")] = len(self._streams) + 1
+        self._streams_file = open(streams_path, "a", buffering=1)
+
+    @staticmethod
+    def _digest(key):
+        return blake2b(key.encode("UTF-8"), digest_size=16).digest()
+
+    def _stream_id(self, db_path):
+        """Return the number of stream ``db_path``. The caller must hold
+        ``_lock``.
+        """
+        if db_path not in self._streams:
+            self._streams_file.write(db_path + "\n")
+            self._streams[db_path] = len(self._streams) + 1
+        return self._streams[db_path]
+
+    def _add(self, db_path, key):
+        """Record ``key``, returning True if it was not already present. The
+        caller must hold ``_lock``.
+        """
+        return self._table.add(self._digest(key), self._stream_id(db_path), time.time())
+
+    def check_key(self, db_path, key):
+        with self._lock:
+            return self._add(db_path, key)
+
+    def check_keys(self, keys):
+        results = []
+        with self._lock:
+            for db_path, key in keys:
+                try:
+                    results.append((True, self._add(db_path, key)))
+                except Exception as e:
+                    results.append((False, e))
+        return results
+
+    def prune(self, expiry_time):
+        return self._defer(self._expire, expiry_time)
+
+    def _expire(self, expiry_time):
+        # Like Event_DB, release the lock every PRUNE_SLICE slots. If the table
+        # is rebuilt in the meantime, records may move; any that are missed
+        # will be expired next time.
+        cutoff = time.time() - expiry_time
+        removed, start = 0, 0
+        while True:
+            with self._lock:
+                if start >= self._table.capacity:
+                    if self._table.tombstones > self._table.capacity * COMPACT_FRACTION:
+                        self._table.compact()
+                    break
+                end = start + PRUNE_SLICE
+                removed += self._table.expire(cutoff, start, end)
+            start = end
+        log.info("Expired %d events" % (removed,))
+
+    def flush(self):
+        return self._defer(self._flush)
+
+    def _flush(self):
+        with self._lock:
+            self._table.flush()
+
+    def close(self):
+        BaseEvent_DB.close(self)
+        with self._lock:
+            self._table.close()
+            self._streams_file.close()
+
+
+class EventDBWorker(object):
+    """
+    Dedicated threads through which requests to an event database are made.
+
+    Checks are distributed over ``threads`` threads according to their
+    stream, so that each stream is always handled by the same thread. Each
+    thread takes up to ``batch_size`` queued checks at a time and passes them
+    to the database's `~BaseEvent_DB.check_keys` method together. A further
+    thread runs maintenance tasks, such as pruning, so that they do not delay
+    checks.
+
+    Results are delivered through Deferreds which fire in the reactor thread.
+    """
+
+    def __init__(self, event_db, threads=1, batch_size=BATCH_SIZE):
+        self.event_db = event_db
+        self.batch_size = batch_size
+        self._queues = [Queue() for _ in range(threads)]
+        self._maintenance = Queue()
+        self._threads = [
+            Thread(target=self._check_loop, args=(queue,), name="EventDBWorker-%d" % i)
+            for i, queue in enumerate(self._queues)
+        ]
+        self._threads.append(
+            Thread(target=self._maintenance_loop, name="EventDBWorker-maintenance")
+        )
+        for thread in self._threads:
+            thread.daemon = True
+            thread.start()
+
+    @property
+    def queue_depth(self):
+        """The number of checks waiting to be processed."""
+        return sum(queue.qsize() for queue in self._queues)
+
+    def check_key(self, db_path, key):
+        """Queue a check of ``key`` in ``db_path``; returns a Deferred."""
+        d = Deferred()
+        shard = crc32(db_path.encode("UTF-8")) % len(self._queues)
+        self._queues[shard].put((db_path, key, d))
+        return d
+
+    def call(self, func, *args):
+        """Queue ``func(*args)`` on the maintenance thread; returns a Deferred."""
+        d = Deferred()
+        self._maintenance.put((func, args, d))
+        return d
+
+    def stop(self):
+        """Stop all threads once they have processed everything queued."""
+        for queue in self._queues + [self._maintenance]:
+            queue.put(None)
+        for thread in self._threads:
+            thread.join()
+
+    def _check_loop(self, queue):
+        while True:
+            batch = [queue.get()]
+            while batch[-1] is not None and len(batch) < self.batch_size:
+                try:
+                    batch.append(queue.get_nowait())
+                except Empty:
+                    break
+            stopping = batch[-1] is None
+            if stopping:
+                batch.pop()
+
+            if batch:
+                try:
+                    results = self.event_db.check_keys(
+                        [(db_path, key) for db_path, key, d in batch]
+                    )
+                except Exception as e:
+                    results = [(False, e)] * len(batch)
+                for (db_path, key, d), (success, result) in zip(batch, results):
+                    if success:
+                        reactor.callFromThread(d.callback, result)
+                    else:
+                        reactor.callFromThread(d.errback, Failure(result))
+                log.debug(
+                    "Checked %d events; %d queued" % (len(batch), self.queue_depth)
+                )
+
+            if stopping:
+                return
+
+    def _maintenance_loop(self):
+        while True:
+            task = self._maintenance.get()
+            if task is None:
+                return
+            func, args, d = task
+            try:
+                result = func(*args)
+            except Exception:
+                reactor.callFromThread(d.errback, Failure())
+            else:
+                reactor.callFromThread(d.callback, result)
+
+
+class RecentEvents(object):
+    """
+    A bounded set of recently seen event keys, held in memory.
+
+    Keys are forgotten after ``max_age`` seconds, or when more than
+    ``max_size`` are held (oldest first). This is not thread-safe: it is
+    intended to be consulted on the reactor thread, ahead of the (blocking)
+    `Event_DB`.
+    """
+
+    def __init__(self, max_size=RECENT_SIZE, max_age=RECENT_AGE):
+        self.max_size = max_size
+        self.max_age = max_age
+        self._keys = OrderedDict()  # key -> time added, oldest first
+
+    def _expire(self):
+        cutoff = time.time() - self.max_age
+        while self._keys and (
+            len(self._keys) > self.max_size or next(iter(self._keys.values())) <= cutoff
+        ):
+            self._keys.popitem(last=False)
+
+    def __contains__(self, key):
+        self._expire()
+        return key in self._keys
+
+    def __len__(self):
+        self._expire()
+        return len(self._keys)
+
+    def add(self, key):
+        self._keys.pop(key, None)
+        self._keys[key] = time.time()
+        self._expire()
+
+    def discard(self, key):
+        self._keys.pop(key, None)
@@ -0,0 +1,203 @@
+# Comet VOEvent Broker.
+# Memory-mapped hash table.
+
+import mmap
+import os
+import struct
+
+__all__ = ["HashTable"]
+
+
+class HashTable(object):
+    """
+    A set of fixed-size records, stored in a memory-mapped file.
+
+    Each record consists of a 16-byte digest, a timestamp, and a 32-bit tag;
+    records are identified by their digest and tag together. They are stored
+    in an open-addressing hash table with linear probing, indexed by the
+    digest, so that lookups and insertions touch only a few consecutive
+    records and make no system calls. Writes reach the file through the
+    operating system's page cache; call `flush` to force them to disk.
+
+    Expired records are replaced by tombstones, which are reused by later
+    insertions and discarded whenever the table is rebuilt. The table is
+    rebuilt, doubling its capacity if necessary, whenever the live records
+    and tombstones together would exceed ``MAX_LOAD`` of its capacity; it may
+    also be compacted explicitly.
+
+    Not thread-safe: callers must serialize access.
+    """
+
+    MAGIC = b"CMTHASH1"
+    HEADER = struct.Struct("<8sQQQ")  # Magic, capacity, live, tombstones.
+    RECORD = struct.Struct("<16sdI4x")  # Digest, timestamp, tag.
+    TAG = struct.Struct("<I")
+    TAG_OFFSET = 24
+
+    # Special tag values marking unused slots.
+    EMPTY = 0
+    TOMBSTONE = 0xFFFFFFFF
+
+    MIN_CAPACITY = 8
+    MAX_LOAD = 0.5
+
+    def __init__(self, path, capacity=1024):
+        if capacity < self.MIN_CAPACITY or capacity & (capacity - 1):
+            raise ValueError("Capacity must be a power of two, at least 8.")
+        self.path = path
+        self.generation = 0
+        if not os.path.exists(path):
+            with open(path, "wb") as f:
+                f.write(self.HEADER.pack(self.MAGIC, capacity, 0, 0))
+                f.truncate(self.HEADER.size + capacity * self.RECORD.size)
+        self._open()
+
+    def _open(self):
+        self._file = open(self.path, "r+b")
+        self._mmap = mmap.mmap(self._file.fileno(), 0)
+        magic, self.capacity, self.count, self.tombstones = self.HEADER.unpack_from(
+            self._mmap
+        )
+        if magic != self.MAGIC:
+            self._mmap.close()
+            self._file.close()
+            raise ValueError("%s is not a hash table." % (self.path,))
+
+    def _write_header(self):
+        self.HEADER.pack_into(
+            self._mmap, 0, self.MAGIC, self.capacity, self.count, self.tombstones
+        )
+
+    def _offset(self, slot):
+        return self.HEADER.size + slot * self.RECORD.size
+
+    def _tag(self, slot):
+        return self.TAG.unpack_from(self._mmap, self._offset(slot) + self.TAG_OFFSET)[0]
+
+    def _find(self, digest, tag):
+        """
+        Return a tuple of the slot holding the given record (or None), and the
+        first slot in which it could be inserted (or None, if present).
+        """
+        mask = self.capacity - 1
+        slot = int.from_bytes(digest[:8], "little") & mask
+        free = None
+        # The load limit guarantees that we will reach an empty slot.
+        while True:
+            offset = self._offset(slot)
+            digest_end = offset + len(digest)
+            slot_tag = self.TAG.unpack_from(self._mmap, offset + self.TAG_OFFSET)[0]
+            if slot_tag == self.EMPTY:
+                return None, slot if free is None else free
+            elif slot_tag == self.TOMBSTONE:
+                if free is None:
+                    free = slot
+            elif slot_tag == tag and self._mmap[offset:digest_end] == digest:
+                return slot, None
+            slot = (slot + 1) & mask
+
+    def __len__(self):
+        return self.count
+
+    def __contains__(self, record):
+        digest, tag = record
+        return self._find(digest, tag)[0] is not None
+
+    def get(self, digest, tag):
+        """Return the timestamp of the given record, or None if absent."""
+        slot, _ = self._find(digest, tag)
+        if slot is None:
+            return None
+        return self.RECORD.unpack_from(self._mmap, self._offset(slot))[1]
+
+    def add(self, digest, tag, timestamp):
+        """
+        Add a record, returning True if it was not already present.
+
+        ``tag`` must be between 1 and 2**32 - 2.
+        """
+        if len(digest) != 16:
+            raise ValueError("Digest must be 16 bytes.")
+        if not self.EMPTY < tag < self.TOMBSTONE:
+            raise ValueError("Invalid tag: %d" % (tag,))
+        if self.count + self.tombstones >= self.capacity * self.MAX_LOAD:
+            self.compact()
+        slot, free = self._find(digest, tag)
+        if slot is not None:
+            return False
+        if self._tag(free) == self.TOMBSTONE:
+            self.tombstones -= 1
+        self.RECORD.pack_into(self._mmap, self._offset(free), digest, timestamp, tag)
+        self.count += 1
+        self._write_header()
+        return True
+
+    def records(self, start=0, stop=None):
+        """
+        Yield ``(slot, digest, timestamp, tag)`` for each live record in slots
+        ``start`` to ``stop``.
+        """
+        stop = self.capacity if stop is None else min(self.capacity, stop)
+        for slot in range(start, stop):
+            digest, timestamp, tag = self.RECORD.unpack_from(
+                self._mmap, self._offset(slot)
+            )
+            if tag not in (self.EMPTY, self.TOMBSTONE):
+                yield slot, digest, timestamp, tag
+
+    def expire(self, cutoff, start=0, stop=None):
+        """
+        Replace records in slots ``start`` to ``stop`` with timestamps no later
+        than ``cutoff`` by tombstones; return the number replaced.
+        """
+        expired = [
+            slot
+            for slot, digest, timestamp, tag in self.records(start, stop)
+            if timestamp <= cutoff
+        ]
+        for slot in expired:
+            self.TAG.pack_into(
+                self._mmap, self._offset(slot) + self.TAG_OFFSET, self.TOMBSTONE
+            )
+        self.count -= len(expired)
+        self.tombstones += len(expired)
+        self._write_header()
+        return len(expired)
+
+    def compact(self):
+        """
+        Rebuild the table without tombstones, growing it if it is too full.
+
+        The new table is written alongside the old one and then moved into
+        place, so a failure leaves the old table intact.
+        """
+        capacity = self.capacity
+        while self.count + 1 >= capacity * self.MAX_LOAD:
+            capacity *= 2
+        new_path = self.path + ".new"
+        if os.path.exists(new_path):
+            os.unlink(new_path)
+        table = HashTable(new_path, capacity)
+        for slot, digest, timestamp, tag in self.records():
+            _, free = table._find(digest, tag)
+            table.RECORD.pack_into(
+                table._mmap, table._offset(free), digest, timestamp, tag
+            )
+        table.count = self.count
+        table.close()
+        self.close()
+        os.replace(new_path, self.path)
+        self._open()
+        self.generation += 1
+
+    def flush(self):
+        """Write any changes to disk."""
+        self._mmap.flush()
+
+    def close(self):
+        """Write any changes to disk and close the file."""
+        if not self._mmap.closed:
+            self._write_header()
+            self._mmap.flush()
+            self._mmap.close()
+        self._file.close()
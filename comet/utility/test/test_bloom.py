@@ -0,0 +1,44 @@
+# Comet VOEvent Broker.
+# Tests for Bloom filter.
+
+from twisted.trial import unittest
+
+from comet.utility import ScalableBloomFilter
+
+
+class ScalableBloomFilterTestCase(unittest.TestCase):
+    def test_no_false_negatives(self):
+        bloom = ScalableBloomFilter(capacity=100)
+        keys = ["key-%d" % (i,) for i in range(1000)]
+        for key in keys:
+            bloom.add(key)
+        for key in keys:
+            self.assertIn(key, bloom)
+        self.assertEqual(len(bloom), 1000)
+
+    def test_growth(self):
+        # Adding more than the initial capacity starts a new, larger, filter.
+        bloom = ScalableBloomFilter(capacity=10)
+        for i in range(11):
+            bloom.add(str(i))
+        self.assertEqual(len(bloom.filters), 2)
+        self.assertEqual(bloom.filters[1].capacity, 10 * bloom.GROWTH)
+
+    def test_error_rate(self):
+        # The false positive rate should be bounded, even after growth.
+        error_rate = 0.01
+        bloom = ScalableBloomFilter(capacity=100, error_rate=error_rate)
+        for i in range(2000):
+            bloom.add("in-%d" % (i,))
+        false_positives = sum("out-%d" % (i,) in bloom for i in range(10000))
+        self.assertLess(false_positives / 10000, error_rate)
+
+    def test_str_and_bytes(self):
+        # A str is equivalent to its UTF-8 encoding.
+        bloom = ScalableBloomFilter(elements=["key"])
+        self.assertIn(b"key", bloom)
+
+    def test_bad_arguments(self):
+        self.assertRaises(ValueError, ScalableBloomFilter, 0)
+        self.assertRaises(ValueError, ScalableBloomFilter, 10, 0)
+        self.assertRaises(ValueError, ScalableBloomFilter, 10, 1)
@@ -7,20 +7,63 @@ import stat
 import tempfile
 import time
 from functools import reduce
+from glob import glob
+from hashlib import sha1
 from itertools import repeat, permutations
 from multiprocessing.pool import ThreadPool
 from operator import __or__
 from sys import platform
 from unittest import skipIf
 
+from twisted.internet.defer import gatherResults
+from twisted.python import log as twisted_log
 from twisted.trial import unittest
 
-from comet.testutils import DummyEvent
-from comet.utility.event_db import Event_DB
+import comet.log as log
+from comet.testutils import DummyEvent, DummyLogObserver
+from comet.utility import event_db
+from comet.utility.event_db import Event_DB, MmapEvent_DB, SQLiteEvent_DB
+from comet.utility.event_db import RecentEvents
+from comet.utility.event_db import BUCKET_SECONDS
 from comet.utility.voevent import BadIvoidError
 
 
-class Event_DB_TestCase(unittest.TestCase):
+class Event_DB_Tests(object):
+    # Tests applicable to all event database implementations.
+
+    def test_unseen(self):
+        # Unseen event -> return True
+        self.assertTrue(self.event_db.check_event(self.event))
+
+    def test_seen(self):
+        # Seen event -> return False
+        self.event_db.check_event(self.event)
+        self.assertFalse(self.event_db.check_event(self.event))
+
+    def test_threadsafe(self):
+        # Ensure that the eventdb is thread-safe by hammering on it with
+        # multiple threads simultaneously. We should only get one positive.
+        pool = ThreadPool(10)
+        results = pool.map(self.event_db.check_event, repeat(self.event, 1000))
+        self.assertEqual(results.count(True), 1)
+        self.assertEqual(results.count(False), 999)
+
+    def test_prune(self):
+        def done_prune(result):
+            self.assertTrue(self.event_db.check_event(self.event))
+
+        self.event_db.check_event(self.event)
+        d = self.event_db.prune(0)
+        d.addCallback(done_prune)
+        return d
+
+    def test_bad_ivoid(self):
+        bad_event = DummyEvent(b"ivo://#")
+        with self.assertRaises(BadIvoidError):
+            self.event_db.check_event(bad_event)
+
+
+class Event_DB_TestCase(unittest.TestCase, Event_DB_Tests):
     def setUp(self):
         self.event_db_dir = tempfile.mkdtemp()
         self.event_db = Event_DB(self.event_db_dir)
@@ -58,37 +101,6 @@ class Event_DB_TestCase(unittest.TestCase):
         os.chmod(filename, stat.S_IRUSR | stat.S_IWUSR | stat.S_IXUSR)
         self.assertTrue(Event_DB(filename).check_event(self.event))
 
-    def test_unseen(self):
-        # Unseen event -> return True
-        self.assertTrue(self.event_db.check_event(self.event))
-
-    def test_seen(self):
-        # Seen event -> return False
-        self.event_db.check_event(self.event)
-        self.assertFalse(self.event_db.check_event(self.event))
-
-    def test_threadsafe(self):
-        # Ensure that the eventdb is thread-safe by hammering on it with
-        # multiple threads simultaneously. We should only get one positive.
-        pool = ThreadPool(10)
-        results = pool.map(self.event_db.check_event, repeat(self.event, 1000))
-        self.assertEqual(results.count(True), 1)
-        self.assertEqual(results.count(False), 999)
-
-    def test_prune(self):
-        def done_prune(result):
-            self.assertTrue(self.event_db.check_event(self.event))
-
-        self.event_db.check_event(self.event)
-        d = self.event_db.prune(0)
-        d.addCallback(done_prune)
-        return d
-
-    def test_bad_ivoid(self):
-        bad_event = DummyEvent(b"ivo://#")
-        with self.assertRaises(BadIvoidError):
-            self.event_db.check_event(bad_event)
-
     def test_prune_bad_event(self):
         bad_event = DummyEvent(ivoid=b"ivo://")
         self.assertNotIn("", self.event_db.databases)
@@ -111,4 +123,521 @@ class Event_DB_TestCase(unittest.TestCase):
         return d
 
     def tearDown(self):
+        self.event_db.close()
+        shutil.rmtree(self.event_db_dir)
+
+    def _db_path(self, event=None):
+        return Event_DB._get_event_details(event or self.event)[0]
+
+    def _make_legacy_db(self, ages):
+        # Create a database in the format written by older versions of Comet,
+        # without a time index, containing entries of the given ages.
+        db_path = self._db_path()
+        db = event_db.anydbm.open(os.path.join(self.event_db_dir, db_path), "c")
+        for i, age in enumerate(ages):
+            db["legacy-%d" % (i,)] = str(time.time() - age)
+        db.close()
+        return db_path
+
+    def test_time_index(self):
+        # Recording an event adds it to the time index.
+        self.event_db.check_event(self.event)
+        db_path, key = Event_DB._get_event_details(self.event)
+        self.assertEqual(len(self.event_db._buckets(db_path)), 1)
+        bucket = self.event_db._buckets(db_path)[0]
+        self.assertEqual(
+            [key], [k for t, k in self.event_db._read_bucket(db_path, bucket)]
+        )
+
+    def test_legacy_db(self):
+        # A database without an index is indexed, then pruned, correctly.
+        db_path = self._make_legacy_db([0, 2 * BUCKET_SECONDS + 10])
+        self.assertTrue(self.event_db.check_event(self.event))
+        self.assertEqual(len(self.event_db._buckets(db_path)), 2)
+
+        def done_prune(result):
+            self.assertEqual(len(self.event_db._buckets(db_path)), 1)
+            db = event_db.anydbm.open(os.path.join(self.event_db_dir, db_path))
+            try:
+                self.assertIn("legacy-0", db)
+                self.assertNotIn("legacy-1", db)
+            finally:
+                db.close()
+            self.assertFalse(self.event_db.check_event(self.event))
+
+        return self.event_db.prune(BUCKET_SECONDS).addCallback(done_prune)
+
+    def test_discover(self):
+        # Existing databases are found, but not other files.
+        self.event_db.check_event(self.event)
+        self._make_legacy_db([0])
+        open(os.path.join(self.event_db_dir, "not_a_db"), "w").close()
+        SQLiteEvent_DB(self.event_db_dir).close()
+        self.assertEqual(self.event_db._discover(), [self._db_path()])
+
+    @skipIf(platform == "win32", "Not available on Windows.")
+    def test_discover_fifo(self):
+        # Opening a FIFO would block, so it must be ignored.
+        self.event_db.check_event(self.event)
+        os.mkfifo(os.path.join(self.event_db_dir, "fifo"))
+        os.mkfifo(os.path.join(self.event_db_dir, "other.db"))
+        self.assertEqual(self.event_db._discover(), [self._db_path()])
+
+    def test_discover_not_events(self):
+        # A database whose values are not timestamps is ignored, and not
+        # indexed.
+        db = event_db.anydbm.open(os.path.join(self.event_db_dir, "other"), "c")
+        db["key"] = "value"
+        db.close()
+        self.assertEqual(self.event_db._discover(), [])
+        self.assertFalse(os.path.exists(os.path.join(self.event_db_dir, "other.index")))
+
+    def test_warm_start(self):
+        # Databases left by a previous run are registered and pruned.
+        other = DummyEvent(b"ivo://comet.broker/other#1")
+        self.event_db.check_event(self.event)
+        self.event_db.check_event(other)
+        self.event_db.close()
+        self.event_db = Event_DB(self.event_db_dir)
+
+        def done_warm_start(result):
+            self.assertEqual(
+                sorted(self.event_db.databases),
+                sorted([self._db_path(), self._db_path(other)]),
+            )
+            self.assertTrue(self.event_db.check_event(self.event))
+            self.assertTrue(self.event_db.check_event(other))
+
+        return self.event_db.warm_start(0, interval=0).addCallback(done_warm_start)
+
+    def test_warm_start_skips_known(self):
+        # Streams seen since startup are left to prune().
+        self.event_db.check_event(self.event)
+
+        def done_warm_start(result):
+            self.assertFalse(self.event_db.check_event(self.event))
+
+        return self.event_db.warm_start(0, interval=0).addCallback(done_warm_start)
+
+    def test_prune_live(self):
+        # Pruning leaves live events untouched.
+        def done_prune(result):
+            self.assertFalse(self.event_db.check_event(self.event))
+            self.assertEqual(len(self.event_db._buckets(self._db_path())), 1)
+
+        self.event_db.check_event(self.event)
+        return self.event_db.prune(BUCKET_SECONDS).addCallback(done_prune)
+
+    def test_prune_slices(self):
+        # Events are pruned correctly when they span multiple slices.
+        events = [DummyEvent(b"ivo://comet.broker/test#%d" % (i,)) for i in range(5)]
+
+        def done_prune(result):
+            for event in events:
+                self.assertTrue(self.event_db.check_event(event))
+
+        self.patch(event_db, "PRUNE_SLICE", 2)
+        for event in events:
+            self.event_db.check_event(event)
+        return self.event_db.prune(0).addCallback(done_prune)
+
+    def test_prune_removes_index(self):
+        # Once pruned, the events are also removed from the index.
+        def done_prune(result):
+            for filename in glob(os.path.join(self.event_db_dir, "*.index", "*")):
+                self.assertEqual(os.path.getsize(filename), 0)
+
+        self.event_db.check_event(self.event)
+        return self.event_db.prune(0).addCallback(done_prune)
+
+
+class Event_DB_CachedHandles_TestCase(Event_DB_TestCase):
+    # Repeat all the above, but with database handles held open between
+    # events.
+    def setUp(self):
+        self.event_db_dir = tempfile.mkdtemp()
+        self.event_db = Event_DB(self.event_db_dir, max_handles=2)
+        self.event = DummyEvent()
+
+    def test_handle_cached(self):
+        self.event_db.check_event(self.event)
+        self.assertEqual(len(self.event_db._handles), 1)
+
+    def test_lru_eviction(self):
+        # Three streams, but only two handles: the least recently used stream
+        # is closed, but its contents are retained.
+        events = [DummyEvent(b"ivo://comet.broker/test%d#1" % (i,)) for i in range(3)]
+        for event in events:
+            self.assertTrue(self.event_db.check_event(event))
+        self.assertEqual(len(self.event_db._handles), 2)
+        db_paths = [Event_DB._get_event_details(event)[0] for event in events]
+        self.assertNotIn(db_paths[0], self.event_db._handles)
+        self.assertFalse(self.event_db.check_event(events[0]))
+        self.assertNotIn(db_paths[1], self.event_db._handles)
+
+    def _handle(self):
+        return self.event_db._handles[Event_DB._get_event_details(self.event)[0]]
+
+    def test_sync_count(self):
+        # Writes are flushed after sync_count events.
+        self.event_db.sync_count = 2
+        self.event_db.check_event(self.event)
+        self.assertEqual(self._handle().writes, 1)
+        self.event_db.check_event(DummyEvent(b"ivo://comet.broker/test#2"))
+        self.assertEqual(self._handle().writes, 0)
+
+    def test_flush(self):
+        def done_flush(result):
+            self.assertEqual(self._handle().writes, 0)
+            # Data should be visible to a fresh reader.
+            self.assertFalse(Event_DB(self.event_db_dir).check_event(self.event))
+
+        self.event_db.check_event(self.event)
+        self.assertEqual(self._handle().writes, 1)
+        return self.event_db.flush().addCallback(done_flush)
+
+    def test_close(self):
+        self.event_db.check_event(self.event)
+        self.event_db.close()
+        self.assertEqual(len(self.event_db._handles), 0)
+        self.assertFalse(Event_DB(self.event_db_dir).check_event(self.event))
+
+
+class Event_DB_Bloom_TestCase(Event_DB_TestCase):
+    # Repeat all the above, but with Bloom filters enabled.
+    def setUp(self):
+        self.event_db_dir = tempfile.mkdtemp()
+        self.event_db = Event_DB(self.event_db_dir, bloom_capacity=10)
+        self.event = DummyEvent()
+
+    def test_bloom_counts(self):
+        self.assertTrue(self.event_db.check_event(self.event))
+        self.assertEqual(self.event_db.bloom_counts()["hits"], 1)
+        self.assertFalse(self.event_db.check_event(self.event))
+        self.assertEqual(self.event_db.bloom_counts()["misses"], 1)
+
+    def test_rebuild_from_db(self):
+        # A new Event_DB builds its filter from the existing database.
+        self.event_db.check_event(self.event)
+        event_db = Event_DB(self.event_db_dir, bloom_capacity=10)
+        self.assertFalse(event_db.check_event(self.event))
+        self.assertEqual(event_db.bloom_counts()["misses"], 1)
+
+    def test_prune_rebuilds_filter(self):
+        def done_prune(result):
+            db_path = Event_DB._get_event_details(self.event)[0]
+            self.assertEqual(len(self.event_db._filters[db_path]), 0)
+            self.assertTrue(self.event_db.check_event(self.event))
+
+        self.event_db.check_event(self.event)
+        return self.event_db.prune(0).addCallback(done_prune)
+
+    def test_prune_logs_bloom_counts(self):
+        observer = DummyLogObserver()
+        twisted_log.addObserver(observer)
+        self.addCleanup(twisted_log.removeObserver, observer)
+        self.patch(log, "LEVEL", log.Levels.INFO)
+
+        def done_prune(result):
+            messages = [" ".join(msg) for msg in observer.messages]
+            self.assertIn(
+                "Bloom filters: 1 hits, 1 misses, 0 false positives", messages
+            )
+
+        self.event_db.check_event(self.event)
+        self.event_db.check_event(self.event)
+        return self.event_db.prune(0).addCallback(done_prune)
+
+
+class EventDBWorker_Tests(object):
+    # Tests of checks made through a dedicated EventDBWorker.
+
+    def test_defer_check_event(self):
+        def check_seen(result):
+            self.assertTrue(result)
+            return self.event_db.defer_check_event(self.event)
+
+        d = self.event_db.defer_check_event(self.event)
+        d.addCallback(check_seen)
+        d.addCallback(self.assertFalse)
+        return d
+
+    def test_batch(self):
+        # Many concurrent checks: only the first of each event is unseen.
+        events = [
+            DummyEvent(b"ivo://comet.broker/test%d#1" % (i % 5,)) for i in range(50)
+        ]
+        d = gatherResults([self.event_db.defer_check_event(e) for e in events])
+        d.addCallback(lambda results: self.assertEqual(results.count(True), 5))
+        return d
+
+    def test_check_keys(self):
+        db_path, key = Event_DB._get_event_details(self.event)
+        self.assertEqual(
+            self.event_db.check_keys([(db_path, key), (db_path, key)]),
+            [(True, True), (True, False)],
+        )
+
+    def test_bad_ivoid_deferred(self):
+        d = self.event_db.defer_check_event(DummyEvent(b"ivo://#"))
+        return self.assertFailure(d, BadIvoidError)
+
+    def test_check_failure(self):
+        # Failures in the worker thread are delivered to the caller.
+        def check_keys(keys):
+            raise RuntimeError
+
+        self.event_db.check_keys = check_keys
+        return self.assertFailure(
+            self.event_db.defer_check_event(self.event), RuntimeError
+        )
+
+    def test_queue_depth(self):
+        d = self.event_db.defer_check_event(self.event)
+        d.addCallback(lambda _: self.assertEqual(self.event_db.worker.queue_depth, 0))
+        return d
+
+
+class Event_DB_Worker_TestCase(Event_DB_TestCase, EventDBWorker_Tests):
+    # Repeat all the above, with a dedicated worker and cached handles.
+    def setUp(self):
+        self.event_db_dir = tempfile.mkdtemp()
+        self.event_db = Event_DB(self.event_db_dir, max_handles=2, threads=2)
+        self.event = DummyEvent()
+
+
+class SQLiteEvent_DB_TestCase(unittest.TestCase, Event_DB_Tests):
+    def setUp(self):
+        self.event_db_dir = tempfile.mkdtemp()
+        self.event_db = SQLiteEvent_DB(self.event_db_dir)
+        self.event = DummyEvent()
+
+    def test_wal(self):
+        self.assertEqual(
+            self.event_db._conn.execute("PRAGMA journal_mode").fetchone()[0], "wal"
+        )
+
+    def test_sync_count(self):
+        # Insertions are committed every sync_count events.
+        self.event_db.sync_count = 2
+        self.event_db.check_event(self.event)
+        self.assertTrue(self.event_db._conn.in_transaction)
+        self.event_db.check_event(DummyEvent(b"ivo://comet.broker/test#2"))
+        self.assertFalse(self.event_db._conn.in_transaction)
+
+    def test_flush(self):
+        def done_flush(result):
+            self.assertFalse(self.event_db._conn.in_transaction)
+            # Data should be visible to another connection.
+            other = SQLiteEvent_DB(self.event_db_dir)
+            try:
+                self.assertFalse(other.check_event(self.event))
+            finally:
+                other.close()
+
+        self.event_db.check_event(self.event)
+        return self.event_db.flush().addCallback(done_flush)
+
+    def test_close(self):
+        self.event_db.check_event(self.event)
+        self.event_db.close()
+        self.event_db = SQLiteEvent_DB(self.event_db_dir)
+        self.assertFalse(self.event_db.check_event(self.event))
+
+    def test_prune_live(self):
+        # Pruning leaves live events untouched.
+        def done_prune(result):
+            self.assertFalse(self.event_db.check_event(self.event))
+
+        self.event_db.check_event(self.event)
+        return self.event_db.prune(BUCKET_SECONDS).addCallback(done_prune)
+
+    def tearDown(self):
+        self.event_db.close()
         shutil.rmtree(self.event_db_dir)
+
+
+class SQLiteEvent_DB_Shared_TestCase(SQLiteEvent_DB_TestCase):
+    # Repeat all the above, with a database shared between processes.
+    def setUp(self):
+        self.event_db_dir = tempfile.mkdtemp()
+        self.event_db = SQLiteEvent_DB(self.event_db_dir, shared=True)
+        self.event = DummyEvent()
+
+    def test_sync_count(self):
+        # Every insertion is committed immediately.
+        self.event_db.check_event(self.event)
+        self.assertFalse(self.event_db._conn.in_transaction)
+
+    def test_shared(self):
+        # An event recorded by one process is seen by another at once.
+        other = SQLiteEvent_DB(self.event_db_dir, shared=True)
+        try:
+            self.assertTrue(self.event_db.check_event(self.event))
+            self.assertFalse(other.check_event(self.event))
+        finally:
+            other.close()
+
+    def test_shared_batch(self):
+        other = SQLiteEvent_DB(self.event_db_dir, shared=True)
+        try:
+            keys = [SQLiteEvent_DB._get_event_details(self.event)]
+            self.assertEqual(self.event_db.check_keys(keys), [(True, True)])
+            self.assertEqual(other.check_keys(keys), [(True, False)])
+        finally:
+            other.close()
+
+
+class SQLiteEvent_DB_Worker_TestCase(SQLiteEvent_DB_TestCase, EventDBWorker_Tests):
+    def setUp(self):
+        self.event_db_dir = tempfile.mkdtemp()
+        self.event_db = SQLiteEvent_DB(self.event_db_dir, threads=2)
+        self.event = DummyEvent()
+
+
+class MmapEvent_DB_TestCase(unittest.TestCase, Event_DB_Tests):
+    def setUp(self):
+        self.event_db_dir = tempfile.mkdtemp()
+        self.event_db = MmapEvent_DB(self.event_db_dir, capacity=8)
+        self.event = DummyEvent()
+
+    def test_streams(self):
+        # Streams are numbered in order of appearance, and remembered.
+        other = DummyEvent(b"ivo://comet.broker/other#1")
+        self.event_db.check_event(self.event)
+        self.event_db.check_event(other)
+        self.event_db.close()
+        self.event_db = MmapEvent_DB(self.event_db_dir)
+        self.assertEqual(
+            self.event_db._streams,
+            {
+                MmapEvent_DB._get_event_details(self.event)[0]: 1,
+                MmapEvent_DB._get_event_details(other)[0]: 2,
+            },
+        )
+        self.assertFalse(self.event_db.check_event(other))
+
+    def test_same_key_different_stream(self):
+        db_path, key = MmapEvent_DB._get_event_details(self.event)
+        self.assertTrue(self.event_db.check_key(db_path, key))
+        self.assertTrue(self.event_db.check_key("other", key))
+
+    def test_flush(self):
+        def done_flush(result):
+            # The table on disk should record the event.
+            with open(
+                os.path.join(self.event_db_dir, MmapEvent_DB.FILENAME), "rb"
+            ) as f:
+                self.assertIn(MmapEvent_DB._digest(key), f.read())
+
+        key = MmapEvent_DB._get_event_details(self.event)[1]
+        self.event_db.check_event(self.event)
+        return self.event_db.flush().addCallback(done_flush)
+
+    def test_prune_live(self):
+        def done_prune(result):
+            self.assertFalse(self.event_db.check_event(self.event))
+
+        self.event_db.check_event(self.event)
+        return self.event_db.prune(BUCKET_SECONDS).addCallback(done_prune)
+
+    def test_prune_compacts(self):
+        # Pruning removes tombstones once there are enough of them.
+        def done_prune(result):
+            self.assertEqual(self.event_db._table.tombstones, 0)
+            self.assertEqual(len(self.event_db._table), 0)
+
+        self.patch(event_db, "PRUNE_SLICE", 2)
+        for i in range(3):
+            self.event_db.check_event(DummyEvent(b"ivo://comet.broker/test#%d" % (i,)))
+        return self.event_db.prune(0).addCallback(done_prune)
+
+    def tearDown(self):
+        self.event_db.close()
+        shutil.rmtree(self.event_db_dir)
+
+
+class MmapEvent_DB_Worker_TestCase(MmapEvent_DB_TestCase, EventDBWorker_Tests):
+    def setUp(self):
+        self.event_db_dir = tempfile.mkdtemp()
+        self.event_db = MmapEvent_DB(self.event_db_dir, capacity=8, threads=2)
+        self.event = DummyEvent()
+
+
+class EventIdentityTestCase(unittest.TestCase):
+    def setUp(self):
+        self.event_db_dir = tempfile.mkdtemp()
+        self.event = DummyEvent()
+        # The same event, serialised differently.
+        self.reserialised = DummyEvent()
+        self.reserialised.raw_bytes = self.event.raw_bytes + b"\n"
+        # A different event with the same contents.
+        self.other = DummyEvent(b"ivo://comet.broker/test#2")
+        self.other.raw_bytes = self.event.raw_bytes
+
+    def tearDown(self):
+        shutil.rmtree(self.event_db_dir)
+
+    def _keys(self, identity):
+        return [
+            Event_DB._get_event_details(event, identity)[1]
+            for event in (self.event, self.reserialised, self.other)
+        ]
+
+    def test_payload(self):
+        event, reserialised, other = self._keys("payload")
+        self.assertEqual(event, sha1(self.event.raw_bytes).hexdigest())
+        self.assertNotEqual(event, reserialised)
+        self.assertEqual(event, other)
+
+    def test_ivorn_hash(self):
+        event, reserialised, other = self._keys("ivorn-hash")
+        self.assertNotEqual(event, reserialised)
+        self.assertNotEqual(event, other)
+
+    def test_ivorn(self):
+        event, reserialised, other = self._keys("ivorn")
+        self.assertEqual(event, reserialised)
+        self.assertNotEqual(event, other)
+
+    def test_check_event(self):
+        # The database uses the identity it was configured with.
+        event_db = Event_DB(self.event_db_dir, identity="ivorn")
+        self.assertTrue(event_db.check_event(self.event))
+        self.assertFalse(event_db.check_event(self.reserialised))
+
+    def test_bad_identity(self):
+        self.assertRaises(ValueError, Event_DB, self.event_db_dir, identity="bad")
+
+
+class RecentEventsTestCase(unittest.TestCase):
+    def test_add(self):
+        recent = RecentEvents()
+        self.assertNotIn("key", recent)
+        recent.add("key")
+        self.assertIn("key", recent)
+        self.assertEqual(len(recent), 1)
+
+    def test_discard(self):
+        recent = RecentEvents()
+        recent.add("key")
+        recent.discard("key")
+        self.assertNotIn("key", recent)
+        # Discarding an unknown key is not an error.
+        recent.discard("key")
+
+    def test_max_size(self):
+        # The oldest entries are discarded first.
+        recent = RecentEvents(max_size=2)
+        for key in ("a", "b", "c"):
+            recent.add(key)
+        self.assertEqual(len(recent), 2)
+        self.assertNotIn("a", recent)
+        self.assertIn("b", recent)
+        self.assertIn("c", recent)
+
+    def test_max_age(self):
+        recent = RecentEvents(max_age=0)
+        recent.add("key")
+        self.assertNotIn("key", recent)
+        self.assertEqual(len(recent), 0)
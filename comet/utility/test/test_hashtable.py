@@ -0,0 +1,102 @@
+# Comet VOEvent Broker.
+# Tests for memory-mapped hash table.
+
+import os
+from hashlib import blake2b
+
+from twisted.trial import unittest
+
+from comet.utility import HashTable
+
+
+def digest(i):
+    return blake2b(b"%d" % (i,), digest_size=16).digest()
+
+
+class HashTableTestCase(unittest.TestCase):
+    def setUp(self):
+        self.path = self.mktemp()
+        self.table = HashTable(self.path, capacity=8)
+
+    def tearDown(self):
+        self.table.close()
+
+    def test_add(self):
+        self.assertTrue(self.table.add(digest(0), 1, 100.0))
+        self.assertFalse(self.table.add(digest(0), 1, 200.0))
+        self.assertEqual(self.table.get(digest(0), 1), 100.0)
+        self.assertEqual(len(self.table), 1)
+
+    def test_tags(self):
+        # The same digest with a different tag is a different record.
+        self.table.add(digest(0), 1, 100.0)
+        self.assertNotIn((digest(0), 2), self.table)
+        self.assertTrue(self.table.add(digest(0), 2, 100.0))
+
+    def test_bad_arguments(self):
+        self.assertRaises(ValueError, HashTable, self.mktemp(), capacity=12)
+        self.assertRaises(ValueError, self.table.add, b"short", 1, 0.0)
+        self.assertRaises(ValueError, self.table.add, digest(0), 0, 0.0)
+        self.assertRaises(
+            ValueError, self.table.add, digest(0), HashTable.TOMBSTONE, 0.0
+        )
+
+    def test_not_a_table(self):
+        path = self.mktemp()
+        with open(path, "wb") as f:
+            f.write(b"x" * 1024)
+        self.assertRaises(ValueError, HashTable, path)
+
+    def test_persistence(self):
+        self.table.add(digest(0), 1, 100.0)
+        self.table.close()
+        self.table = HashTable(self.path)
+        self.assertEqual(self.table.get(digest(0), 1), 100.0)
+        self.assertEqual(len(self.table), 1)
+
+    def test_resize(self):
+        # The table grows to keep its load below MAX_LOAD.
+        for i in range(100):
+            self.assertTrue(self.table.add(digest(i), 1, float(i)))
+        self.assertEqual(len(self.table), 100)
+        self.assertLessEqual(len(self.table), self.table.capacity * HashTable.MAX_LOAD)
+        self.assertEqual(
+            os.path.getsize(self.path),
+            HashTable.HEADER.size + self.table.capacity * HashTable.RECORD.size,
+        )
+        for i in range(100):
+            self.assertIn((digest(i), 1), self.table)
+
+    def test_expire(self):
+        for i in range(3):
+            self.table.add(digest(i), 1, float(i))
+        self.assertEqual(self.table.expire(1.0), 2)
+        self.assertEqual(len(self.table), 1)
+        self.assertEqual(self.table.tombstones, 2)
+        self.assertNotIn((digest(0), 1), self.table)
+        self.assertIn((digest(2), 1), self.table)
+
+        # Tombstones are reused.
+        self.assertTrue(self.table.add(digest(0), 1, 3.0))
+        self.assertEqual(len(self.table), 2)
+        self.assertLessEqual(self.table.tombstones, 2)
+
+    def test_expire_slice(self):
+        for i in range(3):
+            self.table.add(digest(i), 1, 0.0)
+        removed = sum(
+            self.table.expire(1.0, start, start + 2) for start in (0, 2, 4, 6)
+        )
+        self.assertEqual(removed, 3)
+
+    def test_compact(self):
+        for i in range(3):
+            self.table.add(digest(i), 1, float(i))
+        self.table.expire(1.0)
+        self.table.compact()
+        self.assertEqual(self.table.tombstones, 0)
+        self.assertEqual(self.table.capacity, 8)
+        self.assertEqual(
+            list(r[1:] for r in self.table.records()), [(digest(2), 2.0, 1)]
+        )
+        self.assertFalse(os.path.exists(self.path + ".new"))
@@ -8,8 +8,9 @@ import lxml.etree as etree
 from twisted.trial import unittest
 
 import comet
-from comet.utility import VOEventMessage, parse_ivoid, BadIvoidError
-from comet.testutils import DUMMY_SERVICE_IVOID
+from comet.utility import VOEventMessage, VOEventHeader, parse_ivoid, BadIvoidError
+from comet.utility.voevent import _parse_prefix
+from comet.testutils import DUMMY_EVENT_IVOID, DUMMY_SERVICE_IVOID, DUMMY_VOEVENT
 
 
 class broker_test_messageTestCase(unittest.TestCase):
@@ -25,6 +26,44 @@ class broker_test_messageTestCase(unittest.TestCase):
         self.assertTrue(self.message.ivoid.startswith(DUMMY_SERVICE_IVOID.decode()))
 
 
+class VOEventHeaderTestCase(unittest.TestCase):
+    def setUp(self):
+        self.message = VOEventMessage(DUMMY_VOEVENT)
+
+    def test_fields(self):
+        header = self.message.header
+        self.assertEqual(header.ivorn, DUMMY_EVENT_IVOID.decode())
+        self.assertEqual(header.role, "test")
+        self.assertEqual(header.author_ivorn, DUMMY_SERVICE_IVOID.decode())
+        self.assertEqual(header.date, "2012-01-01T00:00:00")
+        self.assertEqual(header.ivorn_parts, parse_ivoid(header.ivorn))
+        self.assertEqual(header.stream, "ivo://comet.broker/test")
+
+    def test_cached(self):
+        self.assertIs(self.message.header, self.message.header)
+        self.assertIs(VOEventHeader.of(self.message), self.message.header)
+
+    def test_replaced(self):
+        # The header follows the element.
+        header = self.message.header
+        self.message.raw_bytes = DUMMY_VOEVENT.replace(b"#1234567890", b"#1")
+        self.assertIsNot(self.message.header, header)
+        self.assertEqual(self.message.ivoid, "ivo://comet.broker/test#1")
+
+    def test_bad_ivorn(self):
+        self.message.element.set("ivorn", "bad")
+        header = VOEventHeader(self.message.element)
+        self.assertEqual(header.ivorn, "bad")
+        self.assertRaises(BadIvoidError, getattr, header, "ivorn_parts")
+        self.assertRaises(BadIvoidError, getattr, header, "stream")
+
+    def test_missing(self):
+        header = VOEventHeader(etree.fromstring(b"<VOEvent/>"))
+        for field in ("ivorn", "role", "author_ivorn", "date"):
+            self.assertIsNone(getattr(header, field))
+        self.assertRaises(BadIvoidError, getattr, header, "ivorn_parts")
+
+
 class parse_ivoidTestCase(unittest.TestCase):
     # Character classes as defined by the IVOA Identifiers spec, 1.12
     ALPHANUM = string.ascii_letters + string.digits
@@ -57,6 +96,21 @@ class parse_ivoidTestCase(unittest.TestCase):
         ]:
             self._good_parse(auth, rsrc, local)
 
+    def test_cached(self):
+        # The authority and resource key are parsed once per stream.
+        _parse_prefix.cache_clear()
+        for local in ("1", "2", "3"):
+            self._good_parse("authorityID", "/resourceKey", local)
+        info = _parse_prefix.cache_info()
+        self.assertEqual((info.misses, info.hits), (1, 2))
+
+    def test_cached_bad_local_id(self):
+        # A valid stream does not excuse an invalid local ID.
+        parse_ivoid("ivo://authorityID/resourceKey#local_ID")
+        self.assertRaises(
+            BadIvoidError, parse_ivoid, "ivo://authorityID/resourceKey#local ID"
+        )
+
     def test_no_fragment(self):
         auth, rsrc = "authorityID", "/resourceKey"
         ivoid = "ivo://%s%s" % (auth, rsrc)
@@ -133,6 +187,14 @@ class parse_ivoidTestCase(unittest.TestCase):
             self._bad_parse("auth", "/rsrc", "local" + char)
             self._bad_parse("auth", "/rsrc", char + "local")
 
+    def test_fragment_non_ascii(self):
+        # Non-ASCII word characters are permitted in the fragment, but other
+        # non-ASCII characters are not.
+        self._good_parse("auth", "/rsrc", "l\u014dcal")
+        self._good_parse("auth", "/rsrc", "\u5c40\u6240")
+        self._bad_parse("auth", "/rsrc", "local\u00a0")
+        self._bad_parse("auth", "/rsrc", "\u2603local")
+
     def test_ivoid2_examples(self):
         # Here we check all the examples given in \S2.3 of the IVOA
         # Identifiers Version 2.0 spec.
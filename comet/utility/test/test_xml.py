@@ -2,13 +2,14 @@
 # Tests for XML parsing.
 
 import textwrap
+import threading
 import lxml.etree as etree
 from io import BytesIO
 
 from twisted.trial import unittest
 
 from comet.testutils import DUMMY_IAMALIVE, DUMMY_VOEVENT, DUMMY_EVENT_IVOID
-from comet.utility import xml_document, ParseError
+from comet.utility import xml_document, ParseError, ParserPool, StreamingParser
 from comet.utility import VOEventMessage
 from comet.protocol import TransportMessage
 
@@ -69,6 +70,56 @@ class xml_document_from_element_TestCase(unittest.TestCase, xml_document_tests):
     def setUp(self):
         self.doc = xml_document(etree.fromstring(EXAMPLE_XML))
 
+    def test_compact(self):
+        # Documents are serialized compactly unless pretty printing is set.
+        element = etree.fromstring(b"<foo><bar/></foo>")
+        raw_bytes = xml_document(element).raw_bytes
+        self.assertTrue(raw_bytes.endswith(b"\n<foo><bar/></foo>"))
+        self.patch(xml_document, "pretty_print", True)
+        self.assertTrue(
+            xml_document(element).raw_bytes.endswith(b"\n<foo>\n  <bar/>\n</foo>\n")
+        )
+
+    def test_lazy_serialization(self):
+        # The element is serialized only when the raw bytes are required, and
+        # the result is retained.
+        self.assertIsNone(self.doc._raw_bytes)
+        raw_bytes = self.doc.raw_bytes
+        self.assertIs(self.doc.raw_bytes, raw_bytes)
+        self.assertEqual(
+            etree.tostring(etree.fromstring(raw_bytes)),
+            etree.tostring(self.doc.element)
+        )
+
+
+class ParserPool_TestCase(unittest.TestCase):
+    def setUp(self):
+        self.pool = ParserPool()
+
+    def test_reuse(self):
+        # A thread always receives the same parser.
+        self.assertIs(self.pool.get(), self.pool.get())
+
+    def test_per_thread(self):
+        # But each thread receives its own.
+        parsers = []
+        thread = threading.Thread(target=lambda: parsers.append(self.pool.get()))
+        thread.start()
+        thread.join()
+        self.assertIsNot(parsers[0], self.pool.get())
+
+    def test_configure(self):
+        raw_bytes = b"<foo>\n  <bar/>\n</foo>"
+        parser = self.pool.get()
+        self.assertEqual(etree.fromstring(raw_bytes, parser).text, "\n  ")
+        self.pool.configure(remove_blank_text=True)
+        self.assertIsNot(self.pool.get(), parser)
+        self.assertIsNone(etree.fromstring(raw_bytes, self.pool.get()).text)
+
+    def test_bad_option(self):
+        self.assertRaises(ValueError, self.pool.configure, resolve_entities=True)
+        self.assertRaises(ValueError, ParserPool, no_such_option=True)
+
 
 class xml_security_TestCase(unittest.TestCase):
     """
@@ -131,6 +182,70 @@ class xml_security_TestCase(unittest.TestCase):
         )
         self.assertRaises(ParseError, xml_document, xml_str)
 
+    def test_attribute_entity(self):
+        # Entities in attribute values are expanded by the parser regardless.
+        xml_str = b'<!DOCTYPE a [<!ENTITY e "xxxxxxx">]><a b="&e;&e;"/>'
+        self.assertRaises(ParseError, xml_document, xml_str)
+
+    def test_external_dtd(self):
+        xml_str = b'<!DOCTYPE a SYSTEM "http://example.com/a.dtd"><a>&e;</a>'
+        self.assertRaises(ParseError, xml_document, xml_str)
+
+    def test_undeclared_entity(self):
+        self.assertRaises(ParseError, xml_document, b"<a>&e;</a>")
+
+    def test_voevent_entity(self):
+        xml_str = DUMMY_VOEVENT.replace(
+            b"<voe:VOEvent", b'<!DOCTYPE voe:VOEvent [<!ENTITY e "x">]><voe:VOEvent'
+        ).replace(b"</voe:VOEvent>", b"<Why>&e;</Why></voe:VOEvent>")
+        self.assertRaises(ParseError, xml_document.infer_type, xml_str)
+
+    def test_predefined_entities(self):
+        # Predefined entities and character references are always permitted.
+        doc = xml_document(b"<!-- <!DOCTYPE --><a>&amp;&lt;&#65;</a>")
+        self.assertEqual(doc.element.text, "&<A")
+
+
+class xml_document_sniff_role_TestCase(unittest.TestCase):
+    def _check_role(self, raw_bytes, role):
+        found, end = xml_document.sniff_role(raw_bytes)
+        self.assertEqual(found, role)
+        if role:
+            self.assertEqual(raw_bytes[end], ord(">"))
+
+    def test_role(self):
+        self._check_role(DUMMY_IAMALIVE, "iamalive")
+        self._check_role(DUMMY_VOEVENT, "test")
+        self._check_role(b"<foo role='bar'/>", "bar")
+
+    def test_prolog(self):
+        self._check_role(
+            b"<?xml version='1.0'?><!-- <x role='no'> --><?pi?><foo role='bar'/>",
+            "bar",
+        )
+
+    def test_no_role(self):
+        self._check_role(EXAMPLE_XML, None)
+        self._check_role(b"<foo><bar role='no'/></foo>", None)
+        self._check_role(b"<foo drole='no'/>", None)
+        self._check_role(b"Not XML", None)
+        self._check_role(b"<!-- unterminated", None)
+
+    def test_empty_role(self):
+        # An empty role is left to the parser.
+        self._check_role(b'<foo role=""/>', None)
+        self._check_role(b"<foo role=''/>", None)
+
+    def test_role_in_value(self):
+        # A role within another attribute's value is ignored.
+        self._check_role(b"""<foo a=' role="no"'/>""", None)
+        self._check_role(b"""<foo a="'" b=' role="no"' role="bar"/>""", None)
+        self._check_role(b"""<foo a=" role='no'" role="bar"/>""", None)
+
+    def test_doctype(self):
+        # Documents with a doctype must be parsed.
+        self._check_role(b"<!DOCTYPE foo><foo role='bar'/>", None)
+
 
 class xml_document_infer_type_TestCase(unittest.TestCase):
     def _assertTransport(self, doc, role):
@@ -150,12 +265,83 @@ class xml_document_infer_type_TestCase(unittest.TestCase):
         msg = xml_document.infer_type(DUMMY_IAMALIVE)
         self._assertTransport(msg, "iamalive")
 
+    def test_iamalive_unparsed(self):
+        # Transport messages are only parsed if necessary.
+        msg = xml_document.infer_type(DUMMY_IAMALIVE)
+        self.assertIsNone(msg._element)
+        self.assertIsInstance(msg.element, etree._Element)
+
+    def test_lazy_parse_error(self):
+        # An unparsed message which proves to be malformed raises on access.
+        msg = xml_document.infer_type(DUMMY_IAMALIVE[:-10])
+        self._assertTransport(msg, "iamalive")
+        self.assertRaises(ParseError, getattr, msg, "element")
+
     def test_bad_parse(self):
         self.assertRaises(ParseError, xml_document.infer_type, EXAMPLE_XML)
 
+    def test_single_parse(self):
+        # The payload is parsed only once, and the result retained.
+        parsed = []
+
+        def _parse(raw_bytes):
+            parsed.append(raw_bytes)
+            return parse(raw_bytes)
+
+        parse = xml_document._parse
+        original = xml_document.__dict__["_parse"]
+        xml_document._parse = staticmethod(_parse)
+        self.addCleanup(setattr, xml_document, "_parse", original)
+        msg = xml_document.infer_type(DUMMY_VOEVENT)
+        self.assertEqual(parsed, [DUMMY_VOEVENT])
+        self.assertEqual(msg.raw_bytes, DUMMY_VOEVENT)
+        self.assertEqual(msg.element.get("role"), "test")
+
     def test_from_stream(self):
         b = BytesIO()
         b.write(DUMMY_VOEVENT)
         b.seek(0)
         msg = xml_document.from_stream(b)
         self._assertVOEvent(msg, "test", DUMMY_EVENT_IVOID.decode())
+
+
+class StreamingParser_TestCase(unittest.TestCase):
+    def _feed(self, raw_bytes, size=16):
+        parser = StreamingParser()
+        for start in range(0, len(raw_bytes), size):
+            stop = start + size
+            parser.feed(raw_bytes[start:stop])
+        return parser
+
+    def test_voevent(self):
+        parser = self._feed(DUMMY_VOEVENT)
+        msg = parser.close()
+        self.assertIsInstance(msg, VOEventMessage)
+        self.assertEqual(msg.raw_bytes, DUMMY_VOEVENT)
+        self.assertEqual(msg.ivoid, DUMMY_EVENT_IVOID.decode())
+
+    def test_transport(self):
+        msg = self._feed(DUMMY_IAMALIVE).close()
+        self.assertIsInstance(msg, TransportMessage)
+        self.assertEqual(msg.role, "iamalive")
+
+    def test_root(self):
+        # The root element is available once its start tag has been parsed.
+        end = DUMMY_VOEVENT.index(b"<Who>")
+        parser = self._feed(DUMMY_VOEVENT[:end])
+        self.assertEqual(parser.root.get("ivorn"), DUMMY_EVENT_IVOID.decode())
+        self.assertEqual(parser.root.get("role"), "test")
+
+    def test_unparsable(self):
+        parser = StreamingParser()
+        self.assertRaises(ParseError, parser.feed, b"<foo><bar></foo>")
+
+    def test_incomplete(self):
+        parser = self._feed(DUMMY_VOEVENT[:-10])
+        self.assertRaises(ParseError, parser.close)
+
+    def test_doctype(self):
+        raw_bytes = DUMMY_VOEVENT.replace(
+            b"<voe:VOEvent", b'<!DOCTYPE voe:VOEvent [<!ENTITY e "x">]><voe:VOEvent'
+        )
+        self.assertRaises(ParseError, self._feed, raw_bytes)
@@ -4,6 +4,7 @@
 # Python standard library
 import re
 from datetime import datetime
+from functools import lru_cache
 
 # XML parsing using lxml
 import lxml.etree as ElementTree
@@ -12,7 +13,7 @@ from comet import __version__, __url__
 import comet.log as log
 from comet.utility.xml import xml_document
 
-__all__ = ["parse_ivoid", "VOEventMessage", "BadIvoidError"]
+__all__ = ["parse_ivoid", "VOEventHeader", "VOEventMessage", "BadIvoidError"]
 
 ElementTree.register_namespace("voe", "http://www.ivoa.net/xml/VOEvent/v2.0")
 
@@ -24,6 +25,21 @@ IVOID_RE = re.compile(
     re.VERBOSE,
 )
 
+# The same, split at the "#": the authority and resource key are validated
+# together, and cached, and the local ID separately.
+PREFIX_RE = re.compile(
+    r"""ivo://
+        (?P<auth>[a-zA-Z0-9][\w\-.~*'()]{2,})       # Authority
+        (?P<rsrc>/[\w\-\.~\*'()/]*)? \Z          # Resource name""",
+    re.VERBOSE,
+)
+LOCAL_ID_RE = re.compile(r"[\w\-\.~\*'()\+=/%!$&,;:@?]*$")
+# Equivalent for ASCII strings, and faster.
+LOCAL_ID_ASCII_RE = re.compile(LOCAL_ID_RE.pattern, re.ASCII)
+
+# Number of distinct authority and resource key combinations to remember.
+PREFIX_CACHE_SIZE = 1024
+
 
 class BadIvoidError(Exception):
     """Raised when an IVOID fails to validate."""
@@ -46,27 +62,132 @@ def parse_ivoid(ivoid):
     Refer to the IVOA Identifiers Recommendation (2.0) for details.
     """
     try:
+        prefix, sep, local_ID = ivoid.partition("#")
+        if sep:
+            auth, rsrc = _parse_prefix(prefix)
+            local_re = LOCAL_ID_ASCII_RE if _is_ascii(local_ID) else LOCAL_ID_RE
+            return auth, rsrc, local_re.match(local_ID).group()
+
+        # Without a "#", the boundary between resource key and local ID is
+        # determined by the full expression.
         groups = IVOID_RE.match(ivoid).groups()
+        auth, rsrc = _check_prefix(groups[0], groups[1])
+        return auth, rsrc, groups[2]
+    except (AttributeError, AssertionError, TypeError) as e:
+        log.debug("Failed to parse as IVOID: ", str(e))
+        raise BadIvoidError("Invalid IVOID: %s" % (ivoid,))
 
-        # An empty resource name is valid.
-        rsrc = groups[1] if groups[1] is not None else ""
 
-        # These may not appear in the resource key per IVOA Identifiers
-        # Version 2.0 \S2.3.3.
-        for forbidden in ["//", "/../", "/./"]:
-            assert forbidden not in rsrc
-        assert not rsrc.endswith("/")
+def _is_ascii(s):
+    # Equivalent to str.isascii(), which requires Python 3.7.
+    try:
+        s.encode("ascii")
+    except UnicodeEncodeError:
+        return False
+    return True
 
-        return groups[0], rsrc, groups[2]
-    except (AttributeError, AssertionError) as e:
-        log.debug("Failed to parse as IVOID: ", str(e))
-        raise BadIvoidError("Invalid IVOID: %s" % (ivoid,))
+
+def _check_prefix(auth, rsrc):
+    # An empty resource name is valid.
+    rsrc = rsrc if rsrc is not None else ""
+
+    # These may not appear in the resource key per IVOA Identifiers
+    # Version 2.0 \S2.3.3.
+    for forbidden in ["//", "/../", "/./"]:
+        assert forbidden not in rsrc
+    assert not rsrc.endswith("/")
+
+    return auth, rsrc
+
+
+@lru_cache(maxsize=PREFIX_CACHE_SIZE)
+def _parse_prefix(prefix):
+    """
+    Return the authority ID and resource key from the part of an IVOID
+    preceding the "#".
+
+    Events arrive from a small number of streams, so the result is cached.
+    Raises AssertionError or AttributeError if the prefix is invalid.
+    """
+    match = PREFIX_RE.match(prefix)
+    return _check_prefix(match.group("auth"), match.group("rsrc"))
+
+
+class VOEventHeader(object):
+    """
+    Fields from the header of a VOEvent, extracted once and shared by all who
+    need them.
+
+    ``ivorn``, ``role``, ``author_ivorn`` (from Who/AuthorIVORN) and ``date``
+    (from Who/Date) are strings, or None if absent. The components of the
+    IVORN, as returned by `parse_ivoid`, are available as ``ivorn_parts``,
+    which raises BadIvoidError if the IVORN is invalid.
+    """
+
+    __slots__ = [
+        "element",
+        "ivorn",
+        "role",
+        "author_ivorn",
+        "date",
+        "_ivorn_parts",
+    ]
+
+    def __init__(self, element):
+        self.element = element
+        self.ivorn = element.get("ivorn")
+        self.role = element.get("role")
+        self.author_ivorn = element.findtext("Who/AuthorIVORN")
+        self.date = element.findtext("Who/Date")
+        try:
+            self._ivorn_parts = parse_ivoid(self.ivorn)
+        except (BadIvoidError, TypeError):
+            self._ivorn_parts = None
+
+    @classmethod
+    def of(cls, event):
+        """
+        Return the header of event, which may be any `xml_document`; that of a
+        `VOEventMessage` is cached.
+        """
+        if isinstance(event, VOEventMessage):
+            return event.header
+        return cls(event.element)
+
+    @property
+    def ivorn_parts(self):
+        if self._ivorn_parts is None:
+            raise BadIvoidError("Invalid IVOID: %s" % (self.ivorn,))
+        return self._ivorn_parts
+
+    @property
+    def stream(self):
+        """The IVORN of the stream to which the event belongs."""
+        auth, rsrc, local_ID = self.ivorn_parts
+        return "ivo://%s%s" % (auth, rsrc)
 
 
 class VOEventMessage(xml_document):
+    # The header of the current element; see the header property.
+    _header = None
+
+    @property
+    def header(self):
+        """
+        A `VOEventHeader` describing the event, cached until the document's
+        element is replaced.
+        """
+        element = self.element
+        if self._header is None or self._header.element is not element:
+            self._header = VOEventHeader(element)
+        return self._header
+
     @property
     def ivoid(self):
-        return self.element.attrib["ivorn"]
+        ivorn = self.header.ivorn
+        if ivorn is None:
+            raise KeyError("ivorn")
+        return ivorn
 
     @classmethod
     def broker_test(cls, ivo):
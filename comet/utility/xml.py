@@ -1,19 +1,79 @@
 # Comet VOEvent Broker.
 # XML document parsing.
 
+import re
+import threading
+
 import lxml.etree as ElementTree
 
-__all__ = ["ParseError", "xml_document"]
+__all__ = [
+    "ParseError",
+    "ParserPool",
+    "StreamingParser",
+    "parser_pool",
+    "xml_document",
+]
 
 # Used to infer incoming message type
 VOEVENT_ROLES = ("observation", "prediction", "utility", "test")
 TRANSPORT_ROLES = ("iamalive", "ack", "nak", "authenticate")
 
+# Root elements of VOEvent and Transport packets.
+ROOT_TAGS = (
+    "{http://www.ivoa.net/xml/VOEvent/v2.0}VOEvent",
+    "{http://www.telescope-networks.org/xml/Transport/v1.1}Transport",
+)
+
+# Matches the role attribute within a start tag.
+ROLE_ATTRIBUTE = re.compile(rb"""\srole\s*=\s*(?:"([^"]*)"|'([^']*)')""")
+
 
 class ParseError(Exception):
     pass
 
 
+class ParserPool(object):
+    """
+    Provide a preconfigured XMLParser for each thread.
+
+    Constructing a parser is relatively expensive, so one is created for each
+    thread which parses documents and reused thereafter; parsers may not be
+    shared between threads. Changing the options with `configure` causes each
+    thread to create a new parser on its next use.
+
+    Entity resolution is always disabled. The options which may be set are
+    listed in ``OPTIONS``: see the lxml documentation for details.
+    """
+
+    OPTIONS = ("collect_ids", "huge_tree", "remove_blank_text")
+    DEFAULTS = {"collect_ids": False, "huge_tree": False, "remove_blank_text": False}
+
+    def __init__(self, **options):
+        self._local = threading.local()
+        self.generation = 0
+        self.configure(**options)
+
+    def configure(self, **options):
+        """Set parser options; those not specified take their defaults."""
+        for name in options:
+            if name not in self.OPTIONS:
+                raise ValueError("Unknown parser option: %s" % (name,))
+        self.options = dict(self.DEFAULTS, **options)
+        self.generation += 1
+
+    def get(self):
+        """Return the parser for the current thread."""
+        local = self._local
+        if getattr(local, "generation", None) != self.generation:
+            local.parser = ElementTree.XMLParser(resolve_entities=False, **self.options)
+            local.generation = self.generation
+        return local.parser
+
+
+# Used to parse all incoming documents.
+parser_pool = ParserPool()
+
+
 class xml_document(object):
     """
     The combination of of an ElementTree element and its serialization.
@@ -24,13 +84,27 @@ class xml_document(object):
     unicode string. The raw bytes will (generally) include the XML encoding
     declaration, but if it is not available we will rely on lxml to take its
     best guess.
+
+    A document constructed from an element is serialized (compactly, unless
+    `pretty_print` is set) only when its raw bytes are first required, and a
+    document may be constructed from raw bytes without parsing them (see
+    `sniff_role`), in which case they are parsed when the element is first
+    required. Either way, the result is cached, so an element should not be
+    modified once its serialization may have been used.
     """
 
-    __slots__ = ["_element", "_raw_bytes"]
+    __slots__ = ["_element", "_raw_bytes", "_role"]
+
+    # Whether documents constructed from an element are serialized with
+    # indentation. Compact output is preferred on the wire; human-facing
+    # output may be pretty printed independently.
+    pretty_print = False
 
     @property
     def role(self):
-        return self.element.get("role")
+        if self._element is None:
+            return self._role
+        return self._element.get("role")
 
     def __init__(self, document):
         if isinstance(document, ElementTree._Element):
@@ -39,36 +113,54 @@ class xml_document(object):
             self.raw_bytes = document
 
     def get_raw_bytes(self):
+        if self._raw_bytes is None:
+            self._raw_bytes = ElementTree.tostring(
+                self._element,
+                xml_declaration=True,
+                encoding="UTF-8",
+                pretty_print=self.pretty_print,
+            )
         return self._raw_bytes
 
-    def set_raw_bytes(self, value):
-        if not isinstance(value, bytes):
+    @staticmethod
+    def _parse(raw_bytes):
+        """Parse raw_bytes, returning the root element."""
+        if not isinstance(raw_bytes, bytes):
             raise ParseError("Raw bytes required.")
-        self._raw_bytes = value
 
-        # We'll disable entity expansion in the parser to avoid any risk of
-        # resource exhaustion. If we receive any, we raise (and hence reject
-        # the event). Better safe than sorry.
-        parser = ElementTree.XMLParser(resolve_entities=False)
+        # Our parsers disable entity expansion to avoid any risk of resource
+        # exhaustion. Entities can only be declared in a document type
+        # declaration, and references to undeclared entities are parse
+        # errors, so we reject (and hence reject the event) any document with
+        # a DTD. Better safe than sorry.
         try:
-            element = ElementTree.fromstring(self._raw_bytes, parser=parser)
+            element = ElementTree.fromstring(raw_bytes, parser=parser_pool.get())
         except ElementTree.ParseError as e:
             raise ParseError(str(e))
-        if list(element.iter(ElementTree.Entity)):
-            raise ParseError("Entity expansion not supported")
-        else:
-            self._element = element
+        xml_document._check_doctype(element)
+        return element
+
+    @staticmethod
+    def _check_doctype(element):
+        """Raise ParseError if element's document has a DTD."""
+        if element.getroottree().docinfo.internalDTD is not None:
+            raise ParseError("Document type declarations not supported")
+
+    def set_raw_bytes(self, value):
+        element = self._parse(value)
+        self._raw_bytes = value
+        self._element = element
 
     raw_bytes = property(get_raw_bytes, set_raw_bytes)
 
     def get_element(self):
+        if self._element is None:
+            self._element = self._parse(self._raw_bytes)
         return self._element
 
     def set_element(self, value):
         self._element = value
-        self._raw_bytes = ElementTree.tostring(
-            self._element, xml_declaration=True, encoding="UTF-8", pretty_print=True
-        )
+        self._raw_bytes = None
 
     element = property(get_element, set_element)
 
@@ -81,25 +173,151 @@ class xml_document(object):
         # Return the encoding that lxml detected for the raw_bytes we're
         # carrying. Note we need to construct an ElementTree and use that;
         # can't read from the element directly.
-        return ElementTree.ElementTree(self._element).docinfo.encoding
+        return ElementTree.ElementTree(self.element).docinfo.encoding
+
+    @staticmethod
+    def sniff_role(raw_bytes):
+        """
+        Find the role of the document in raw_bytes without parsing it.
+
+        Returns the role and the offset of the end of the root element's start
+        tag, or ``(None, -1)`` if they could not be determined. The document is
+        not checked for well-formedness.
+        """
+        # Skip the XML declaration, processing instructions and comments which
+        # may precede the root element. Documents with a doctype declaration
+        # are left to the parser.
+        start = raw_bytes.find(b"<")
+        while start >= 0 and raw_bytes.startswith((b"<?", b"<!--"), start):
+            terminator = b"-->" if raw_bytes.startswith(b"<!--", start) else b"?>"
+            end = raw_bytes.find(terminator, start)
+            start = raw_bytes.find(b"<", end) if end >= 0 else -1
+        if start < 0 or raw_bytes.startswith(b"<!", start):
+            return None, -1
+        end = raw_bytes.find(b">", start)
+        if end < 0:
+            return None, -1
+        # Searching for the attribute name first is much faster than a regular
+        # expression search.
+        position = raw_bytes.find(b"role", start, end)
+        while position >= 0:
+            match = ROLE_ATTRIBUTE.match(raw_bytes, position - 1, end)
+            if match:
+                break
+            position = raw_bytes.find(b"role", position + 1, end)
+        else:
+            return None, -1
+        # Make sure that the match is not within the value of another attribute:
+        # preceding values must all be delimited by the same kind of quote.
+        double = raw_bytes.count(b'"', start, position)
+        single = raw_bytes.count(b"'", start, position)
+        if (double and single) or (double + single) % 2:
+            return None, -1
+        role = match.group(1) if match.group(1) is not None else match.group(2)
+        if not role:
+            return None, -1
+        try:
+            return role.decode("ascii"), end
+        except UnicodeDecodeError:
+            return None, -1
+
+    @classmethod
+    def _unparsed(cls, raw_bytes, role):
+        """Construct from raw_bytes with the given role, without parsing them."""
+        xmldoc = cls.__new__(cls)
+        xmldoc._raw_bytes = raw_bytes
+        xmldoc._element = None
+        xmldoc._role = role
+        return xmldoc
+
+    @classmethod
+    def _from_parsed(cls, raw_bytes, element):
+        """Construct from raw_bytes and the element already parsed from them."""
+        xmldoc = cls.__new__(cls)
+        xmldoc._raw_bytes = raw_bytes
+        xmldoc._element = element
+        return xmldoc
 
     @staticmethod
     def infer_type(raw_bytes):
         """Given a payload, attempt to infer its message type."""
-        # The double-parse is unfortunate.
-        xmldoc = xml_document(raw_bytes)
-        if xmldoc.role in VOEVENT_ROLES:
+        # Transport messages may not need to be parsed at all.
+        if isinstance(raw_bytes, bytes):
+            role, end = xml_document.sniff_role(raw_bytes)
+            if role in TRANSPORT_ROLES:
+                from comet.protocol import TransportMessage
+
+                message = TransportMessage.from_sniffed(raw_bytes, role, end)
+                if message is not None:
+                    return message
+
+        return xml_document._from_element(raw_bytes, xml_document._parse(raw_bytes))
+
+    @staticmethod
+    def _from_element(raw_bytes, element):
+        """Construct a document of the type appropriate to a parsed payload."""
+        role = element.get("role")
+        if role in VOEVENT_ROLES:
             from comet.utility.voevent import VOEventMessage
 
-            return VOEventMessage(raw_bytes)
-        elif xmldoc.role in TRANSPORT_ROLES:
+            return VOEventMessage._from_parsed(raw_bytes, element)
+        elif role in TRANSPORT_ROLES:
             from comet.protocol import TransportMessage
 
-            return TransportMessage(raw_bytes)
+            return TransportMessage._from_parsed(raw_bytes, element)
         else:
-            raise ParseError(f"Unknown role: {xmldoc.role}")
+            raise ParseError(f"Unknown role: {role}")
 
     @staticmethod
     def from_stream(stream):
         """Give an IO stream, return an appropriate xml_document subclass."""
         return xml_document.infer_type(stream.read())
+
+
+class StreamingParser(object):
+    """
+    Parse a document incrementally, as its bytes arrive.
+
+    Bytes are passed to `feed` as they are received, and are parsed
+    immediately, so that the complete payload is never held other than as
+    a list of the chunks received and the tree being built. Once the start
+    tag of a VOEvent or Transport root element has been parsed, it is
+    available (without its children) as `root`, so that its role and IVORN
+    may be checked before the rest of the document arrives. When all the
+    bytes have been fed, `close` returns a document as
+    `xml_document.infer_type` would.
+
+    Errors are reported by raising ParseError from `feed` or `close`; after
+    an error, the parser should be discarded.
+    """
+
+    def __init__(self):
+        self.root = None
+        self._chunks = []
+        self._parser = ElementTree.XMLPullParser(
+            events=("start",),
+            tag=ROOT_TAGS,
+            resolve_entities=False,
+            **parser_pool.options,
+        )
+
+    def feed(self, data):
+        self._chunks.append(data)
+        try:
+            self._parser.feed(data)
+        except ElementTree.ParseError as e:
+            raise ParseError(str(e))
+        if self.root is None:
+            for _, element in self._parser.read_events():
+                xml_document._check_doctype(element)
+                self.root = element
+                break
+
+    def close(self):
+        try:
+            element = self._parser.close()
+        except ElementTree.ParseError as e:
+            raise ParseError(str(e))
+        xml_document._check_doctype(element)
+        raw_bytes, self._chunks = b"".join(self._chunks), None
+        return xml_document._from_element(raw_bytes, element)
@@ -3,7 +3,7 @@
 
 from zope.interface import implementer
 from comet.icomet import IValidator
-from comet.utility import parse_ivoid
+from comet.utility import VOEventHeader
 
 __all__ = ["CheckIVOID"]
 
@@ -18,7 +18,7 @@ class CheckIVOID(object):
     """
 
     def __call__(self, event):
-        # parse_ivoid() raises if whatever it is passed is unparseable.
-        auth, rsrc, local_ID = parse_ivoid(event.element.attrib["ivorn"])
+        # ivorn_parts raises if the IVORN is unparseable.
+        auth, rsrc, local_ID = VOEventHeader.of(event).ivorn_parts
         if not local_ID:
             raise Exception("No per-event local ID")
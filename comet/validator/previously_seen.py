@@ -1,7 +1,7 @@
 # Comet VOEvent Broker.
 # Check for previously seen events.
 
-from twisted.internet.threads import deferToThread
+from twisted.internet.defer import maybeDeferred, succeed
 from zope.interface import implementer
 
 from comet.icomet import IValidator
@@ -12,8 +12,35 @@ __all__ = ["CheckPreviouslySeen"]
 
 @implementer(IValidator)
 class CheckPreviouslySeen(object):
-    def __init__(self, event_db):
+    """
+    Check events against an `~comet.utility.Event_DB`.
+
+    If ``recent_events`` (a `~comet.utility.RecentEvents`) is supplied, it is
+    consulted first, on the reactor thread: events found there are rejected
+    without touching the database. Other events are added to it before being
+    checked against (and recorded in) the database in another thread.
+    """
+
+    def __init__(self, event_db, recent_events=None):
         self.event_db = event_db
+        self.recent_events = recent_events
+
+    def _check_event(self, event):
+        if self.recent_events is None:
+            return self.event_db.defer_check_event(event)
+
+        db_path, key = self.event_db.event_details(event)
+        if key in self.recent_events:
+            log.debug("Event found in recently seen events")
+            return succeed(False)
+        self.recent_events.add(key)
+
+        def forget_key(failure):
+            # We don't know whether this event has been recorded.
+            self.recent_events.discard(key)
+            return failure
+
+        return self.event_db.defer_check_key(db_path, key).addErrback(forget_key)
 
     def __call__(self, event):
         def check_validity(is_valid):
@@ -29,7 +56,6 @@ class CheckPreviouslySeen(object):
             log.warn(failure.getTraceback())
             return failure
 
-        return deferToThread(
-            self.event_db.check_event,
-            event,
-        ).addCallbacks(check_validity, db_failure)
+        return maybeDeferred(self._check_event, event).addCallbacks(
+            check_validity, db_failure
+        )
@@ -8,7 +8,7 @@ from twisted.trial import unittest
 
 from comet.testutils import DummyEvent
 from comet.icomet import IValidator
-from comet.utility import Event_DB
+from comet.utility import Event_DB, RecentEvents
 from comet.validator import CheckPreviouslySeen
 
 
@@ -53,3 +53,54 @@ class CheckPreviouslySeenTestCase(unittest.TestCase):
 
     def tearDown(self):
         shutil.rmtree(self.event_db_dir)
+
+
+class CheckPreviouslySeenRecentTestCase(unittest.TestCase):
+    def setUp(self):
+        self.event_db_dir = tempfile.mkdtemp()
+        self.recent_events = RecentEvents()
+        self.checker = CheckPreviouslySeen(
+            Event_DB(self.event_db_dir), self.recent_events
+        )
+        self.event = DummyEvent()
+        self.key = Event_DB._get_event_details(self.event)[1]
+
+    def _mock_check_key(self, *args, **kwargs):
+        raise LookupError("Simulated DB failure.")
+
+    def test_unseen(self):
+        d = self.checker(self.event)
+        d.addCallback(self.assertTrue)
+        d.addCallback(lambda _: self.assertIn(self.key, self.recent_events))
+        return d
+
+    def test_previously_checked(self):
+        # Previously recorded in the database, but not recently seen.
+        self.checker.event_db.check_event(self.event)
+        return self.assertFailure(self.checker(self.event), Exception)
+
+    def test_recently_seen(self):
+        # Recently seen events are rejected without consulting the database.
+        self.recent_events.add(self.key)
+        self.checker.event_db.check_key = self._mock_check_key
+        d = self.checker(self.event)
+        self.assertTrue(d.called)
+        return self.assertFailure(d, Exception)
+
+    def test_concurrent_duplicate(self):
+        # A duplicate arriving while the first copy is still being checked is
+        # rejected.
+        first, second = self.checker(self.event), self.checker(self.event)
+        return self.assertFailure(second, Exception).addCallback(lambda _: first)
+
+    def test_db_failure(self):
+        # If the database fails, the event is not remembered.
+        def catch_lookup_error(failure):
+            failure.trap(LookupError)
+            self.assertNotIn(self.key, self.recent_events)
+
+        self.checker.event_db.check_key = self._mock_check_key
+        return self.checker(self.event).addErrback(catch_lookup_error)
+
+    def tearDown(self):
+        shutil.rmtree(self.event_db_dir)